@@ -0,0 +1,606 @@
+#!/usr/bin/env python3
+# Stand-in kubernetes apiserver for the benchmarks of the segmenter tools.
+# It serves in memory the segmenter unit deployments, pods and services, the mongo services, statefulsets and
+# volume claims of N namespaces x M groups x K units, with the LIST (label selectors, limit/continue), WATCH, GET,
+# PATCH and DELETE requests used by the tools. A patched deployment replaces its pods: the old pods are terminated
+# and the new ones become ready after a delay. The ainode upstreamgroup API is served through the service proxy.
+# The API calls are counted per verb and resource: GET /_stats returns the counts, GET /_state a summary of the
+# cluster state.
+import argparse
+import bisect
+import hashlib
+import heapq
+import itertools
+import json
+import random
+import re
+import sys
+import threading
+import time
+from copy import deepcopy
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+# Served resources: resource => (api version, kind).
+RESOURCES = {"deployments":             ("apps/v1", "Deployment"),
+             "statefulsets":            ("apps/v1", "StatefulSet"),
+             "pods":                    ("v1",      "Pod"),
+             "services":                ("v1",      "Service"),
+             "persistentvolumeclaims":  ("v1",      "PersistentVolumeClaim")}
+
+# Lists merged by name in a strategic merge patch.
+MERGE_BY_NAME = ("containers", "volumes", "volumeClaimTemplates")
+
+# Name of the segmenter ainode service.
+AINODE_NAME = "segmenter-ainode"
+
+# Image of the segmenter units.
+UNIT_IMAGE = "quortex/segmenter"
+
+TIMESTAMP = "2026-01-01T00:00:00Z"
+
+SELECTOR_TERM = re.compile(r'^\s*(!?)\s*([\w./-]+)\s*(?:(==|=|!=)\s*([\w./-]*)|\s+(in|notin)\s*\(([^)]*)\))?\s*$')
+
+
+###########################################
+### LABEL SELECTORS #######################
+###########################################
+def split_selector(selector):
+    # Split on the commas which are not in a set: "a in (x,y),b" => ["a in (x,y)", "b"].
+    terms = list()
+    depth = 0
+    term = ""
+    for char in selector or "":
+        if char == "," and depth == 0:
+            terms.append(term)
+            term = ""
+            continue
+        depth += {"(": 1, ")": -1}.get(char, 0)
+        term += char
+    if term.strip():
+        terms.append(term)
+    return terms
+
+def parse_selector(selector):
+    # Label selector => function(labels) returning whether the labels match.
+    checks = list()
+    for term in split_selector(selector):
+        match = SELECTOR_TERM.match(term)
+        if match is None:
+            raise ValueError(f"Invalid label selector term {term!r}")
+        negate, key, operator, value, set_operator, values = match.groups()
+        if set_operator:
+            values = set(val.strip() for val in values.split(","))
+            if set_operator == "in":
+                checks.append(lambda labels, key=key, values=values: labels.get(key) in values)
+            else:
+                checks.append(lambda labels, key=key, values=values: labels.get(key) not in values)
+        elif operator == "!=":
+            checks.append(lambda labels, key=key, value=value: labels.get(key) != value)
+        elif operator:
+            checks.append(lambda labels, key=key, value=value: labels.get(key) == value)
+        elif negate:
+            checks.append(lambda labels, key=key: key not in labels)
+        else:
+            checks.append(lambda labels, key=key: key in labels)
+    return lambda labels: all(check(labels or dict()) for check in checks)
+
+def merge_patch(target, patch, strategic=False):
+    # JSON merge patch, the strategic merge patch also merges the lists of named items (containers, volumes).
+    for key, val in patch.items():
+        if val is None:
+            target.pop(key, None)
+        elif isinstance(val, dict) and isinstance(target.get(key), dict):
+            merge_patch(target[key], val, strategic)
+        elif strategic and key in MERGE_BY_NAME and isinstance(val, list) and isinstance(target.get(key), list):
+            for item in val:
+                current = next((cur for cur in target[key] if cur.get("name") == item.get("name")), None)
+                if current is None:
+                    target[key].append(deepcopy(item))
+                else:
+                    merge_patch(current, item, strategic)
+        else:
+            target[key] = deepcopy(val)
+    return target
+
+
+###########################################
+### CLUSTER ###############################
+###########################################
+class Cluster:
+    # In memory objects, change events (for the watches) and pods lifecycle.
+    def __init__(self, ready_delay=0.2, terminate_delay=0.1):
+        self.ready_delay = ready_delay
+        self.terminate_delay = terminate_delay
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.objects = dict((resource, dict()) for resource in RESOURCES)
+        self.owners = dict()
+        self.version = 0
+        self.events = dict((resource, list()) for resource in RESOURCES)
+        self.event_versions = dict((resource, list()) for resource in RESOURCES)
+        self.timers = list()
+        self.sequence = itertools.count()
+        self.upstreamgroups = dict()
+        self.upstreamgroups_version = 0
+        self.counts = dict()
+        threading.Thread(target=self.timer_loop, daemon=True).start()
+
+    def count(self, call):
+        with self.lock:
+            self.counts[call] = self.counts.get(call, 0) + 1
+
+    # Objects and events.
+    def store(self, resource, obj, event="ADDED"):
+        with self.lock:
+            self.version += 1
+            obj["metadata"]["resourceVersion"] = str(self.version)
+            obj["metadata"].setdefault("creationTimestamp", TIMESTAMP)
+            key = (obj["metadata"].get("namespace"), obj["metadata"]["name"])
+            if event == "DELETED":
+                self.objects[resource].pop(key, None)
+                self.owners.pop(key, None)
+            else:
+                self.objects[resource][key] = obj
+            self.events[resource].append((event, deepcopy(obj)))
+            self.event_versions[resource].append(self.version)
+            self.changed.notify_all()
+
+    def select(self, resource, namespace=None, label_selector=None):
+        # Resource version of the list and objects matching the label selector.
+        match = parse_selector(label_selector)
+        with self.lock:
+            return self.version, [obj for key, obj in sorted(self.objects[resource].items())
+                                  if (namespace is None or key[0] == namespace) and match(obj["metadata"].get("labels"))]
+
+    def events_since(self, resource, version):
+        # Events of the resource following the version, and the version of the last one.
+        with self.lock:
+            start = bisect.bisect_right(self.event_versions[resource], version)
+            if start == len(self.events[resource]):
+                return version, list()
+            return self.event_versions[resource][-1], self.events[resource][start:]
+
+    # Delayed actions (pods readiness and termination).
+    def schedule(self, delay, func, *args):
+        with self.lock:
+            heapq.heappush(self.timers, (time.monotonic() + delay, next(self.sequence), func, args))
+            self.changed.notify_all()
+
+    def timer_loop(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                due = list()
+                while self.timers and self.timers[0][0] <= now:
+                    due.append(heapq.heappop(self.timers))
+                for _when, _seq, func, args in due:
+                    func(*args)
+            time.sleep(0.01)
+
+    # Pods lifecycle.
+    def create_pod(self, namespace, name, owner, template):
+        labels = dict(template["metadata"].get("labels") or dict())
+        spec = deepcopy(template["spec"])
+        image_hash = hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:10]
+        labels.setdefault("pod-template-hash", image_hash)
+        pod = {"metadata": {"name": name, "namespace": namespace, "labels": labels, "uid": f"{namespace}-{name}"},
+               "spec": spec,
+               "status": {"phase": "Pending",
+                          "containerStatuses": [{"name": container["name"], "image": container["image"], "imageID": "",
+                                                 "ready": False, "restartCount": 0}
+                                                for container in spec["containers"]]}}
+        self.owners[(namespace, name)] = owner
+        self.store("pods", pod)
+        self.schedule(self.ready_delay, self.set_pod_ready, namespace, name)
+
+    def set_pod_ready(self, namespace, name):
+        pod = self.objects["pods"].get((namespace, name))
+        if pod is None or pod["metadata"].get("deletionTimestamp"):
+            return
+        pod = deepcopy(pod)
+        pod["status"]["phase"] = "Running"
+        for status in pod["status"]["containerStatuses"]:
+            status["ready"] = True
+        self.store("pods", pod, "MODIFIED")
+
+    def terminate_pod(self, namespace, name, then=None):
+        pod = self.objects["pods"].get((namespace, name))
+        if pod is None or pod["metadata"].get("deletionTimestamp"):
+            return
+        pod = deepcopy(pod)
+        pod["metadata"]["deletionTimestamp"] = TIMESTAMP
+        self.store("pods", pod, "MODIFIED")
+        self.schedule(self.terminate_delay, self.delete_pod, namespace, name, then)
+
+    def delete_pod(self, namespace, name, then=None):
+        pod = self.objects["pods"].get((namespace, name))
+        if pod is not None:
+            self.store("pods", deepcopy(pod), "DELETED")
+        if then is not None:
+            then()
+
+    def owned_pods(self, namespace, owner):
+        return [pod for key, pod in sorted(self.objects["pods"].items()) if self.owners.get(key) == owner]
+
+    def reconcile_deployment(self, namespace, name):
+        # Pods of another template are terminated, missing pods are created (not ready for ready_delay).
+        deployment = self.objects["deployments"][(namespace, name)]
+        template = deployment["spec"]["template"]
+        replicas = deployment["spec"].get("replicas", 1)
+        live = [pod for pod in self.owned_pods(namespace, ("deployments", name)) if not pod["metadata"].get("deletionTimestamp")]
+        current = list()
+        for pod in live:
+            if pod["spec"]["containers"] == template["spec"]["containers"] and len(current) < replicas:
+                current.append(pod)
+            else:
+                self.terminate_pod(namespace, pod["metadata"]["name"])
+        basename = name.rsplit("-deployment", 1)[0]
+        for _idx in range(replicas - len(current)):
+            suffix = "".join(random.choice("bcdfghjklmnpqrstvwxz2456789") for _ in range(5))
+            self.create_pod(namespace, f"{basename}-{random.randrange(10**9, 10**10)}-{suffix}", ("deployments", name), template)
+
+    def reconcile_statefulset(self, namespace, name):
+        # Rolling restart of the pods whose labels differ from the template.
+        statefulset = self.objects["statefulsets"][(namespace, name)]
+        template = statefulset["spec"]["template"]
+        for ordinal in range(statefulset["spec"].get("replicas", 1)):
+            podname = f"{name}-{ordinal}"
+            pod = self.objects["pods"].get((namespace, podname))
+            create = partial(self.create_pod, namespace, podname, ("statefulsets", name), template)
+            if pod is None:
+                create()
+            elif any(pod["metadata"]["labels"].get(key) != val for key, val in (template["metadata"].get("labels") or dict()).items()):
+                self.terminate_pod(namespace, podname, then=create)
+
+    def reconcile(self, resource, namespace, name):
+        if resource == "deployments":
+            self.reconcile_deployment(namespace, name)
+        elif resource == "statefulsets":
+            self.reconcile_statefulset(namespace, name)
+
+    # Ainode upstreamgroups.
+    def get_upstreamgroup_etag(self, uuid=None):
+        if uuid is None:
+            return f'"{self.upstreamgroups_version}"'
+        return f'"{uuid}-{self.upstreamgroups[uuid][0]}"'
+
+    def put_upstreamgroup(self, uuid, conf):
+        with self.lock:
+            self.upstreamgroups_version += 1
+            self.upstreamgroups[uuid] = (self.upstreamgroups_version, conf)
+
+
+def populate(cluster, namespaces, groups, units, replicas=1, legacy_groups=0, orphan_pvcs=1):
+    # Segmenter objects of groups x units spread over the namespaces, the first legacy_groups groups have no group
+    # label on their deployments metadata.
+    namespace_names = ["reference"] + [f"segmenter-{idx}" for idx in range(1, namespaces)]
+    ainode_namespace = namespace_names[0]
+    cluster.store("services", {"metadata": {"name": AINODE_NAME, "namespace": ainode_namespace,
+                                            "labels": {"app.kubernetes.io/name": AINODE_NAME, "app.quortex.io/type": "ainode"}},
+                               "spec": {"ports": [{"name": "api", "port": 8080}]}})
+    for group in range(groups):
+        groupid = f"g{group}"
+        namespace = namespace_names[group % len(namespace_names)]
+        upstreams = list()
+        for unit in range(units):
+            unitname = f"segmenter-{groupid}-u{unit}"
+            template_labels = {"app": unitname, "group": f"segmenter-{groupid}-group", "type": "unit", "vendor": "quortex"}
+            labels = {"app": unitname, "type": "unit", "vendor": "quortex"}
+            if group >= legacy_groups:
+                labels["group"] = f"segmenter-{groupid}-group"
+            cluster.store("deployments", {"metadata": {"name": f"{unitname}-deployment", "namespace": namespace, "labels": labels},
+                                          "spec": {"replicas": replicas,
+                                                   "selector": {"matchLabels": {"app": unitname, "type": "unit"}},
+                                                   "template": {"metadata": {"labels": template_labels},
+                                                                "spec": {"containers": [{"name": "segmenter-unit",
+                                                                                         "image": f"{UNIT_IMAGE}:v1"}]}}}})
+            cluster.reconcile("deployments", namespace, f"{unitname}-deployment")
+            cluster.store("services", {"metadata": {"name": f"{unitname}-service", "namespace": namespace,
+                                                    "labels": {"app": unitname, "type": "unit"}},
+                                       "spec": {"selector": {"app": unitname}, "ports": [{"name": "api", "port": 8080}]}})
+            upstreams.append({"address": f"http://{unitname}-service.{namespace}:8080/live"})
+        cluster.put_upstreamgroup(f"uuid-{groupid}", {"uuid": f"uuid-{groupid}", "location": f"/segmenter-{groupid}-group/live",
+                                                      "upstream": upstreams})
+
+        # Mongo database of the group: service, statefulset and volume claims (mounted and orphans).
+        mongoname = f"segmenter-{groupid}-mongo"
+        cluster.store("services", {"metadata": {"name": mongoname, "namespace": namespace, "labels": {"app": mongoname}},
+                                   "spec": {"selector": {"app": mongoname}, "ports": [{"name": "mongo", "port": 27017}]}})
+        cluster.store("statefulsets", {"metadata": {"name": mongoname, "namespace": namespace,
+                                                    "labels": {"app": mongoname, "type": "dbase", "vendor": "quortex"}},
+                                       "spec": {"replicas": 1, "serviceName": mongoname,
+                                                "selector": {"matchLabels": {"app": mongoname}},
+                                                "template": {"metadata": {"labels": {"app": mongoname}},
+                                                             "spec": {"containers": [{"name": "mongo", "image": "mongo:4.4"}],
+                                                                      "volumes": [{"name": "data", "persistentVolumeClaim":
+                                                                                   {"claimName": f"data-{mongoname}-0"}}]}},
+                                                "volumeClaimTemplates": [{"metadata": {"name": "data"}}]}})
+        for claim in [f"data-{mongoname}-0"] + [f"data-{mongoname}-orphan-{idx}" for idx in range(orphan_pvcs)]:
+            cluster.store("persistentvolumeclaims", {"metadata": {"name": claim, "namespace": namespace, "labels": {"app": mongoname},
+                                                                  "uid": f"{namespace}-{claim}"},
+                                                     "spec": {"accessModes": ["ReadWriteOnce"],
+                                                              "resources": {"requests": {"storage": "10Gi"}}},
+                                                     "status": {"phase": "Bound"}})
+        cluster.reconcile("statefulsets", namespace, mongoname)
+
+    # Pods ready from the start.
+    with cluster.lock:
+        for (namespace, name) in list(cluster.objects["pods"]):
+            cluster.set_pod_ready(namespace, name)
+    return namespace_names
+
+
+###########################################
+### HTTP SERVER ###########################
+###########################################
+class ApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    cluster = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body, separators=(",", ":")).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, val in (headers or dict()).items():
+            self.send_header(key, val)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_status(self, code, reason, message=""):
+        self.send_json(code, {"kind": "Status", "apiVersion": "v1", "metadata": {}, "status": "Failure",
+                              "reason": reason, "message": message, "code": code})
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def route(self):
+        # (resource, namespace, name, subpath) of the request path, None if not served.
+        parts = [unquote(part) for part in urlsplit(self.path).path.strip("/").split("/")]
+        if parts[:2] == ["api", "v1"]:
+            parts = parts[2:]
+        elif parts[:3] == ["apis", "apps", "v1"]:
+            parts = parts[3:]
+        else:
+            return None
+        namespace = None
+        if len(parts) >= 3 and parts[0] == "namespaces":
+            namespace = parts[1]
+            parts = parts[2:]
+        if not parts or parts[0] not in RESOURCES:
+            return None
+        return parts[0], namespace, parts[1] if len(parts) > 1 else None, "/".join(parts[2:])
+
+    def do_GET(self):
+        query = parse_qs(urlsplit(self.path).query)
+        path = urlsplit(self.path).path
+        if path == "/_stats":
+            with self.cluster.lock:
+                return self.send_json(200, dict(sorted(self.cluster.counts.items())))
+        if path == "/_state":
+            return self.send_json(200, self.get_state())
+
+        route = self.route()
+        if route is None:
+            return self.send_status(404, "NotFound", path)
+        resource, namespace, name, subpath = route
+        if subpath.startswith("proxy"):
+            return self.proxy("GET", resource, namespace, name, subpath[len("proxy/"):])
+        if name is not None:
+            self.cluster.count(f"GET {resource}")
+            obj = self.cluster.objects[resource].get((namespace, name))
+            if obj is None:
+                return self.send_status(404, "NotFound", f"{resource} {name} not found")
+            return self.send_json(200, obj)
+        if query.get("watch", ["false"])[0].lower() in ("true", "1"):
+            self.cluster.count(f"WATCH {resource}")
+            return self.watch(resource, namespace, query)
+
+        self.cluster.count(f"LIST {resource}")
+        try:
+            version, items = self.cluster.select(resource, namespace, query.get("labelSelector", [""])[0])
+        except ValueError as e:
+            return self.send_status(400, "BadRequest", str(e))
+        start = int(query.get("continue", ["0"])[0])
+        limit = int(query.get("limit", ["0"])[0])
+        metadata = {"resourceVersion": str(version)}
+        if limit and start + limit < len(items):
+            metadata["continue"] = str(start + limit)
+        items = items[start:start + limit] if limit else items[start:]
+        api_version, kind = RESOURCES[resource]
+        self.send_json(200, {"kind": f"{kind}List", "apiVersion": api_version, "metadata": metadata, "items": items})
+
+    def watch(self, resource, namespace, query):
+        # Chunked stream of the events following the resource version, until timeoutSeconds.
+        match = parse_selector(query.get("labelSelector", [""])[0])
+        version = int(query.get("resourceVersion", ["0"])[0] or 0)
+        deadline = time.monotonic() + int(query.get("timeoutSeconds", ["30"])[0])
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            while time.monotonic() < deadline:
+                with self.cluster.changed:
+                    version_end, events = self.cluster.events_since(resource, version)
+                    if not events:
+                        self.cluster.changed.wait(min(1, max(0, deadline - time.monotonic())))
+                        version_end, events = self.cluster.events_since(resource, version)
+                lines = b""
+                for event, obj in events:
+                    if namespace is not None and obj["metadata"].get("namespace") != namespace:
+                        continue
+                    if not match(obj["metadata"].get("labels")):
+                        continue
+                    lines += json.dumps({"type": event, "object": obj}, separators=(",", ":")).encode() + b"\n"
+                version = version_end
+                if lines:
+                    self.wfile.write(f"{len(lines):x}\r\n".encode() + lines + b"\r\n")
+                    self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def do_PATCH(self):
+        route = self.route()
+        if route is None or route[2] is None:
+            return self.send_status(404, "NotFound", self.path)
+        resource, namespace, name, _subpath = route
+        content_type = self.headers.get("Content-Type", "").split(";")[0]
+        # Server side apply: merged as a strategic merge patch, without the fields ownership.
+        self.cluster.count(f"{'APPLY' if content_type == 'application/apply-patch+yaml' else 'PATCH'} {resource}")
+        patch = json.loads(self.read_body() or b"{}")
+        with self.cluster.lock:
+            obj = self.cluster.objects[resource].get((namespace, name))
+            if obj is None:
+                return self.send_status(404, "NotFound", f"{resource} {name} not found")
+            if content_type == "application/json-patch+json":
+                return self.send_status(415, "UnsupportedMediaType", content_type)
+            obj = merge_patch(deepcopy(obj), patch, strategic=content_type in ("application/strategic-merge-patch+json",
+                                                                               "application/apply-patch+yaml"))
+            self.cluster.store(resource, obj, "MODIFIED")
+            self.cluster.reconcile(resource, namespace, name)
+        self.send_json(200, obj)
+
+    def do_PUT(self):
+        route = self.route()
+        if route is None or not route[3].startswith("proxy"):
+            return self.send_status(405, "MethodNotAllowed", self.path)
+        resource, namespace, name, subpath = route
+        return self.proxy("PUT", resource, namespace, name, subpath[len("proxy/"):])
+
+    def do_DELETE(self):
+        route = self.route()
+        if route is None or route[2] is None:
+            return self.send_status(404, "NotFound", self.path)
+        resource, namespace, name, _subpath = route
+        self.cluster.count(f"DELETE {resource}")
+        options = json.loads(self.read_body() or b"{}")
+        with self.cluster.lock:
+            obj = self.cluster.objects[resource].get((namespace, name))
+            if obj is None:
+                return self.send_status(404, "NotFound", f"{resource} {name} not found")
+            uid = (options.get("preconditions") or dict()).get("uid")
+            if uid is not None and uid != obj["metadata"].get("uid"):
+                return self.send_status(409, "Conflict", f"Precondition failed: UID in precondition: {uid}")
+            if resource == "pods":
+                self.cluster.terminate_pod(namespace, name)
+            else:
+                self.cluster.store(resource, deepcopy(obj), "DELETED")
+        self.send_json(200, {"kind": "Status", "apiVersion": "v1", "metadata": {}, "status": "Success"})
+
+    def proxy(self, method, resource, namespace, name, path):
+        # Ainode upstreamgroup API behind the ainode service, any other proxied path answers "ok".
+        body = self.read_body()
+        if resource == "pods":
+            self.cluster.count(f"PROXY {method} pods")
+            if path == "die":
+                with self.cluster.lock:
+                    self.cluster.delete_pod(namespace, name.split(":", 1)[0])
+            return self.send_json(200, {"status": "ok"})
+        if name.split(":", 1)[0] != AINODE_NAME:
+            self.cluster.count(f"PROXY {method} services")
+            return self.send_json(200, {"status": "ok"})
+
+        parts = path.split("/")
+        if parts[:2] != ["1.0", "upstreamgroup"]:
+            return self.send_status(404, "NotFound", path)
+        uuid = parts[2] if len(parts) > 2 else None
+        self.cluster.count(f"AINODE {method} {'upstreamgroups' if uuid is None else 'upstreamgroup'}")
+        with self.cluster.lock:
+            if uuid is not None and uuid not in self.cluster.upstreamgroups:
+                return self.send_status(404, "NotFound", f"upstreamgroup {uuid} not found")
+            etag = self.cluster.get_upstreamgroup_etag(uuid)
+            if method == "GET":
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if uuid is None:
+                    confs = [conf for _version, conf in self.cluster.upstreamgroups.values()]
+                else:
+                    confs = self.cluster.upstreamgroups[uuid][1]
+                return self.send_json(200, confs, {"ETag": etag})
+            if uuid is None:
+                return self.send_status(405, "MethodNotAllowed", path)
+            if self.headers.get("If-Match") and self.headers.get("If-Match") != etag:
+                return self.send_status(412, "PreconditionFailed", f"upstreamgroup {uuid} modified")
+            conf = json.loads(body)
+            self.cluster.put_upstreamgroup(uuid, conf)
+            return self.send_json(200, conf, {"ETag": self.cluster.get_upstreamgroup_etag(uuid)})
+
+    def get_state(self):
+        # Summary of the cluster: deployments per image, pods per phase, upstreams per upstreamgroup.
+        with self.cluster.lock:
+            images = dict()
+            for deployment in self.cluster.objects["deployments"].values():
+                image = deployment["spec"]["template"]["spec"]["containers"][0]["image"]
+                images[image] = images.get(image, 0) + 1
+            phases = dict()
+            for pod in self.cluster.objects["pods"].values():
+                phase = "Terminating" if pod["metadata"].get("deletionTimestamp") else pod["status"]["phase"]
+                phases[phase] = phases.get(phase, 0) + 1
+            return {"deployments": images,
+                    "pods": phases,
+                    "services": len(self.cluster.objects["services"]),
+                    "persistentvolumeclaims": len(self.cluster.objects["persistentvolumeclaims"]),
+                    "upstreams": sum(len(conf["upstream"]) for _version, conf in self.cluster.upstreamgroups.values())}
+
+
+class ApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Connections closed by the clients (stopped watches) are expected.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def write_kubeconfig(filename, server):
+    # JSON is valid YAML for the kube config loader.
+    kubeconfig = {"apiVersion": "v1", "kind": "Config", "current-context": "fake",
+                  "clusters": [{"name": "fake", "cluster": {"server": server}}],
+                  "users": [{"name": "fake", "user": {"token": "fake"}}],
+                  "contexts": [{"name": "fake", "context": {"cluster": "fake", "user": "fake"}}]}
+    with open(filename, "w") as kubefile:
+        json.dump(kubeconfig, kubefile)
+
+
+if __name__ == '__main__':
+    # Parse argument
+    parser = argparse.ArgumentParser()
+    required = parser.add_argument_group('required arguments')
+    required.add_argument("--port",                 default=0,                              help="Listening port (default is 0: any free port, printed on stdout)", type=int)
+    required.add_argument("--namespaces",           default=1,                              help="Number of namespaces of the segmenters (default is 1)", type=int)
+    required.add_argument("--groups",               default=1,                              help="Number of segmenter groups (default is 1)", type=int)
+    required.add_argument("--units",                default=10,                             help="Number of units per group (default is 10)", type=int)
+    required.add_argument("--replicas",             default=1,                              help="Number of pods per unit (default is 1)", type=int)
+    required.add_argument("--legacy-groups",        default=0,                              help="Number of groups without group label on their deployments metadata (default is 0)", type=int)
+    required.add_argument("--orphan-pvcs",          default=1,                              help="Number of unmounted volume claims per group (default is 1)", type=int)
+    required.add_argument("--ready-delay",          default=0.2,                            help="Delay in seconds before a new pod is ready (default is 0.2)", type=float)
+    required.add_argument("--terminate-delay",      default=0.1,                            help="Delay in seconds before a terminated pod is deleted (default is 0.1)", type=float)
+    required.add_argument("--kubeconfig",           default=None,                           help="Write a kube config file targeting the server")
+
+    # Get arguments
+    args = parser.parse_args()
+
+    cluster = Cluster(ready_delay=args.ready_delay, terminate_delay=args.terminate_delay)
+    populate(cluster, args.namespaces, args.groups, args.units, args.replicas, args.legacy_groups, args.orphan_pvcs)
+    ApiHandler.cluster = cluster
+    server = ApiServer(("127.0.0.1", args.port), ApiHandler)
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    if args.kubeconfig:
+        write_kubeconfig(args.kubeconfig, url)
+    print(url, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
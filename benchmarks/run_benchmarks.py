@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# Benchmarks of the segmenter tools against the stand-in apiserver (fake_apiserver.py).
+# For each size (number of units) and scenario, a fresh fake cluster is started and the tool is run against it:
+# the wall time, the peak RSS of the tool process and the API calls received by the fake apiserver are reported.
+# The results can be saved (--json) and compared to previous ones (--baseline): the run fails when a measure is
+# worse than the baseline by more than the tolerance.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+SCENARIOS = ["status", "labels", "labels-batch", "pvc", "upgrade"]
+
+# Compared measures: result key => minimum absolute difference considered (noise floor).
+MEASURES = {"wall": 0.5, "rss_mb": 5, "api_calls": 0}
+
+
+###########################################
+### FAKE CLUSTER ##########################
+###########################################
+def start_fake_apiserver(workdir, groups, user_args):
+    kubeconfig = os.path.join(workdir, "kubeconfig.json")
+    command = [sys.executable, os.path.join(BENCH_DIR, "fake_apiserver.py"),
+               "--namespaces",      str(user_args.namespaces),
+               "--groups",          str(groups),
+               "--units",           str(user_args.units_per_group),
+               "--orphan-pvcs",     str(user_args.orphan_pvcs),
+               "--ready-delay",     str(user_args.ready_delay),
+               "--terminate-delay", str(user_args.terminate_delay),
+               "--kubeconfig",      kubeconfig]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    url = process.stdout.readline().strip()
+    if not url:
+        process.kill()
+        raise RuntimeError("Fake apiserver did not start")
+    return process, url, kubeconfig
+
+def get_json(url):
+    with urllib.request.urlopen(url) as response:
+        return json.loads(response.read())
+
+
+###########################################
+### SCENARIOS #############################
+###########################################
+def get_scenario(scenario, groups, workdir, user_args):
+    # Command line, stdin and check of the final cluster state of a scenario.
+    # The groups of the "reference" namespace are the ones of index multiple of the number of namespaces.
+    reference_groups = [f"g{group}" for group in range(0, groups, user_args.namespaces)]
+    units = groups * user_args.units_per_group
+    if scenario == "status":
+        return (["update_segmenter.py", "--output", "json"], None,
+                lambda state: True)
+    if scenario == "labels":
+        # The statefulset patch waits for <ENTER>.
+        return (["update_newlabels.py", "-s", "reference", "-u", "-g"] + reference_groups, "\n" * len(reference_groups),
+                lambda state: True)
+    if scenario == "labels-batch":
+        return (["update_newlabels.py", "-s", "reference", "-u", "--batch", "-g"] + reference_groups, None,
+                lambda state: True)
+    if scenario == "pvc":
+        return (["clean_pvc.py", "--run", "--all-namespaces", "--grace-period", "0",
+                 "--state-file", os.path.join(workdir, "pvc_state.json")], None,
+                lambda state: state["persistentvolumeclaims"] == groups)
+    if scenario == "upgrade":
+        return (["update_segmenter.py", "--upgrade", "--parallel", "--version", "v2",
+                 "--max-parallel", str(user_args.max_parallel), "--max-per-group", str(user_args.max_per_group),
+                 "--stats-file", os.path.join(workdir, "stats.json"), "-l", os.path.join(workdir, "upgrade.log")], None,
+                lambda state: state["deployments"] == {"quortex/segmenter:v2": units} and state["upstreams"] == units)
+    raise ValueError(f"Unknown scenario {scenario}")
+
+def run_scenario(scenario, units, user_args):
+    groups = max(1, units // user_args.units_per_group)
+    with tempfile.TemporaryDirectory() as workdir:
+        server, url, kubeconfig = start_fake_apiserver(workdir, groups, user_args)
+        try:
+            command, stdin, check = get_scenario(scenario, groups, workdir, user_args)
+            env = dict(os.environ, KUBECONFIG=kubeconfig, HOME=workdir)
+            with open(os.path.join(workdir, "output.log"), "w+") as output:
+                start = time.monotonic()
+                process = subprocess.Popen([sys.executable] + command, cwd=REPO_DIR, env=env, text=True,
+                                           stdin=subprocess.PIPE, stdout=output, stderr=subprocess.STDOUT)
+                if stdin:
+                    process.stdin.write(stdin)
+                process.stdin.close()
+                # wait4 gives the resources of this process only (peak RSS in KB on Linux).
+                deadline = start + user_args.timeout
+                while True:
+                    pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+                    if pid:
+                        break
+                    if time.monotonic() > deadline:
+                        process.kill()
+                        pid, status, rusage = os.wait4(process.pid, 0)
+                        break
+                    time.sleep(0.05)
+                wall = time.monotonic() - start
+                process.returncode = os.waitstatus_to_exitcode(status)
+                output.seek(0)
+                tail = output.read()[-2000:]
+
+            calls = get_json(f"{url}/_stats")
+            state = get_json(f"{url}/_state")
+        finally:
+            server.kill()
+            server.wait()
+
+    ok = process.returncode == 0 and check(state)
+    if not ok:
+        print(f"WARNING: {scenario} with {units} units failed (exit code {process.returncode}, state {state})\n{tail}",
+              file=sys.stderr)
+    return {"scenario":     scenario,
+            "units":        groups * user_args.units_per_group,
+            "ok":           ok,
+            "wall":         round(wall, 3),
+            "rss_mb":       round(rusage.ru_maxrss / 1024, 1),
+            "api_calls":    sum(calls.values()),
+            "calls":        calls}
+
+
+###########################################
+### REPORT ################################
+###########################################
+def print_results(results, verbose=False):
+    print(f"{'SCENARIO':<10} {'UNITS':>6} {'OK':>4} {'WALL(s)':>9} {'RSS(MB)':>9} {'API CALLS':>10}")
+    for result in results:
+        print(f"{result['scenario']:<10} {result['units']:>6} {'yes' if result['ok'] else 'NO':>4} "
+              f"{result['wall']:>9.2f} {result['rss_mb']:>9.1f} {result['api_calls']:>10}")
+        if verbose:
+            for call, count in sorted(result["calls"].items(), key=lambda item: -item[1]):
+                print(f"{'':<12}{call:<40} {count:>8}")
+
+def compare_results(results, baseline, tolerance):
+    # Measures worse than the baseline by more than tolerance (ratio) and the noise floor of the measure.
+    previous = dict(((result["scenario"], result["units"]), result) for result in baseline)
+    regressions = list()
+    for result in results:
+        base = previous.get((result["scenario"], result["units"]))
+        if base is None:
+            continue
+        if base["ok"] and not result["ok"]:
+            regressions.append(f"{result['scenario']} with {result['units']} units: failed")
+        for measure, floor in MEASURES.items():
+            if result[measure] > base[measure] * (1 + tolerance) and result[measure] - base[measure] > floor:
+                regressions.append(f"{result['scenario']} with {result['units']} units: {measure} "
+                                   f"{base[measure]} => {result[measure]}")
+    return regressions
+
+
+if __name__ == '__main__':
+    # Parse argument
+    parser = argparse.ArgumentParser()
+    required = parser.add_argument_group('required arguments')
+    required.add_argument("-s", "--sizes",          default=[10, 100, 1000],                help="Numbers of units of the benchmarks (default is 10 100 1000)", nargs='+', type=int)
+    required.add_argument("--scenarios",            default=SCENARIOS,                      help=f"Benchmarked scenarios (default is {' '.join(SCENARIOS)})", nargs='+', choices=SCENARIOS)
+    required.add_argument("--namespaces",           default=2,                              help="Number of namespaces of the segmenters (default is 2)", type=int)
+    required.add_argument("--units-per-group",      default=10,                             help="Number of units per group (default is 10)", type=int)
+    required.add_argument("--orphan-pvcs",          default=1,                              help="Number of unmounted volume claims per group (default is 1)", type=int)
+    required.add_argument("--ready-delay",          default=0.2,                            help="Delay in seconds before a new pod is ready (default is 0.2)", type=float)
+    required.add_argument("--terminate-delay",      default=0.1,                            help="Delay in seconds before a terminated pod is deleted (default is 0.1)", type=float)
+    required.add_argument("--max-parallel",         default=50,                             help="Maximum number of units upgraded at the same time (default is 50)", type=int)
+    required.add_argument("--max-per-group",        default=1,                              help="Maximum number of units of a group upgraded at the same time (default is 1)", type=int)
+    required.add_argument("--timeout",              default=1800,                           help="Timeout in seconds of a benchmark run (default is 1800)", type=int)
+    required.add_argument("--json",                 default=None,                           help="Save the results in this JSON file")
+    required.add_argument("--baseline",             default=None,                           help="Compare the results to the ones of this JSON file, exit with an error on regression")
+    required.add_argument("--tolerance",            default=0.25,                           help="Accepted degradation ratio compared to the baseline (default is 0.25)", type=float)
+    required.add_argument("-v", "--verbose",        default=False,                          help="Print the API calls per verb and resource", action='store_true')
+
+    # Get arguments
+    args = parser.parse_args()
+
+    results = list()
+    for size in args.sizes:
+        for scenario in args.scenarios:
+            print(f"=> {scenario} with {size} units", file=sys.stderr)
+            results.append(run_scenario(scenario, size, args))
+    print_results(results, args.verbose)
+
+    if args.json:
+        with open(args.json, "w") as jsonfile:
+            json.dump(results, jsonfile, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as jsonfile:
+            regressions = compare_results(results, json.load(jsonfile), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+    if not all(result["ok"] for result in results):
+        sys.exit(1)
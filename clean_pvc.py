@@ -1,37 +1,362 @@
 from kubernetes import config, client
 import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import threading
+import time
+from functools import partial
+
+from kube_utils import (PodRecord, PvcRecord, StatefulSetRecord, get_raw_path, list_pods_raw, list_pvcs_raw,
+                        list_statefulsets_raw, list_then_watch)
+
+# Default number of deletions sent at the same time.
+DEFAULT_WORKERS = 8
+
+# Default maximum number of deletions per second.
+DEFAULT_RATE = 50
+
+# Default file of the unmounted pvcs tracking.
+DEFAULT_STATE_FILE = os.path.expanduser("~/.clean_pvc_state.json")
+
+# Default duration in seconds a pvc stays unmounted before being deleted.
+DEFAULT_GRACE_PERIOD = 24 * 3600
+
+# Default period in seconds of the expired pvcs check in watch mode.
+DEFAULT_SWEEP_INTERVAL = 30
+
+# Maximum duration in seconds of a watch request.
+WATCH_TIMEOUT = 300
+
+# Delay in seconds before a failed watch is started again.
+WATCH_RETRY_DELAY = 5
 
 def parse_args():
-    parser = argparse.ArgumentParser(prog="clean_pvc.py", description="Clean unbound PVCs in reference namespace")
+    parser = argparse.ArgumentParser(prog="clean_pvc.py", description="Clean unmounted PVCs, in reference namespace by default")
     parser.add_argument('--run', action='store_true', default=False, help="Run pvc deletion, default is false (=dry run)")
+    parser.add_argument('-n', '--namespace', nargs='+', default=["reference"], help="Namespaces of the pvcs, default is reference")
+    parser.add_argument('-A', '--all-namespaces', action='store_true', default=False, help="Clean the pvcs of all namespaces")
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS, help=f"Number of deletions sent at the same time, default is {DEFAULT_WORKERS}")
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE, help=f"Maximum number of deletions per second, default is {DEFAULT_RATE} (0: no limit)")
+    parser.add_argument('--state-file', default=DEFAULT_STATE_FILE, help=f"Tracking of the unmounted pvcs between runs, default is {DEFAULT_STATE_FILE}")
+    parser.add_argument('--grace-period', type=int, default=DEFAULT_GRACE_PERIOD, help=f"Seconds a pvc stays unmounted before being deleted, default is {DEFAULT_GRACE_PERIOD}")
+    parser.add_argument('--largest-first', action='store_true', default=False, help="Delete the pvcs with the biggest requested storage first")
+    parser.add_argument('--max-deletions', type=int, default=0, help="Maximum number of pvcs deleted per run, default is 0 (no limit)")
+    parser.add_argument('--watch', action='store_true', default=False, help="Run as a daemon: track the mounted claims from the watch events and delete the pvcs unmounted for the grace period")
+    parser.add_argument('--sweep-interval', type=int, default=DEFAULT_SWEEP_INTERVAL, help=f"Seconds between two expired pvcs checks in watch mode, default is {DEFAULT_SWEEP_INTERVAL}")
 
     return parser.parse_args()
 
+class RateLimiter:
+    # Minimum interval between two calls, shared by the threads.
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.lock = threading.Lock()
+        self.next_call = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            call = max(now, self.next_call)
+            self.next_call = call + self.interval
+        if call > now:
+            time.sleep(call - now)
+
+def get_claims_index(api_client, namespace=None):
+    # (namespace, claim) => pods mounting the claim, whatever their phase (a pending pod keeps its claims), in one
+    # paginated pass. The claims of the statefulsets volumeClaimTemplates (<template>-<statefulset>-<ordinal>) of
+    # the current replicas are in use as well, even without pod (restarting).
+    claims_index = dict()
+    for pod in list_pods_raw(api_client, namespace):
+        for claim in pod.claims:
+            claims_index.setdefault((pod.namespace, claim), list()).append(pod.name)
+    for statefulset in list_statefulsets_raw(api_client, namespace):
+        for template in statefulset.claim_templates:
+            for ordinal in range(statefulset.replicas or 0):
+                claims_index.setdefault((statefulset.namespace, f"{template}-{statefulset.name}-{ordinal}"), list())
+    return claims_index
+
+def get_unmounted_pvcs(api_client, namespace=None):
+    # Returns the number of pvcs, the number of pvcs in use and the unmounted pvcs records.
+    claims_index = get_claims_index(api_client, namespace)
+    pvc_list = list_pvcs_raw(api_client, namespace)
+    unmounted_pvc = [ pvc for pvc in pvc_list if (pvc.namespace, pvc.name) not in claims_index ]
+    return len(pvc_list), len(pvc_list) - len(unmounted_pvc), unmounted_pvc
+
+class PvcState:
+    # Unmounted pvcs tracking, saved in a local JSON file between runs: "namespace/name" => uid, requested size and
+    # time it was first seen unmounted. A pvc mounted again, deleted or recreated (new uid) starts over.
+    def __init__(self, filename):
+        self.filename = filename
+        self.pvcs = dict()
+        if os.path.exists(filename):
+            try:
+                with open(filename) as state:
+                    self.pvcs = json.load(state).get("pvcs", dict())
+            except (OSError, ValueError) as e:
+                print(f"Ignoring invalid state file {filename}: {e}")
+
+    def update(self, namespaces, unmounted_pvc, now):
+        # Track the unmounted pvcs of the namespaces (None: all namespaces), the pvcs of the other namespaces are kept.
+        # Returns the unmounted pvcs with the time they were first seen unmounted.
+        tracked = dict()
+        for pvc in unmounted_pvc:
+            key = f"{pvc.namespace}/{pvc.name}"
+            entry = self.pvcs.get(key)
+            if entry is None or entry.get("uid") != pvc.uid:
+                entry = {"uid": pvc.uid, "since": now}
+            entry["size"] = pvc.size
+            tracked[key] = entry
+        if None not in namespaces:
+            tracked.update((key, entry) for key, entry in self.pvcs.items()
+                           if key not in tracked and key.split("/", 1)[0] not in namespaces)
+        self.pvcs = tracked
+        return [ (pvc, tracked[f"{pvc.namespace}/{pvc.name}"]["since"]) for pvc in unmounted_pvc ]
+
+    def remove(self, pvcs):
+        for pvc in pvcs:
+            self.pvcs.pop(f"{pvc.namespace}/{pvc.name}", None)
+
+    def save(self):
+        try:
+            tmpname = f"{self.filename}.tmp"
+            with open(tmpname, "w") as state:
+                json.dump({"pvcs": self.pvcs}, state)
+            os.replace(tmpname, self.filename)
+        except OSError as e:
+            print(f"Cannot save state file {self.filename}: {e}")
+
+def get_expired_pvcs(unmounted_since, now, grace_period, largest_first=False, max_deletions=0):
+    # Pvcs unmounted for more than the grace period, by name or by decreasing requested size, at most max_deletions.
+    expired = [ pvc for pvc, since in unmounted_since if now - since >= grace_period ]
+    expired.sort(key=lambda pvc: (pvc.namespace, pvc.name))
+    if largest_first:
+        expired.sort(key=lambda pvc: pvc.size, reverse=True)
+    return expired[:max_deletions] if max_deletions > 0 else expired
+
+def delete_pvc(kube_client, rate_limiter, pvc):
+    rate_limiter.wait()
+    try:
+        # The uid precondition prevents the deletion of a pvc recreated with the same name.
+        kube_client.delete_namespaced_persistent_volume_claim(pvc.name, pvc.namespace,
+                                                              body=client.V1DeleteOptions(preconditions=client.V1Preconditions(uid=pvc.uid)))
+    except client.rest.ApiException as e:
+        # Already deleted.
+        if e.status != 404:
+            raise
+
+def delete_pvcs(kube_client, pvcs, workers=DEFAULT_WORKERS, rate=DEFAULT_RATE):
+    # Parallel deletion with at most workers calls at the same time and rate calls per second.
+    # Returns the deleted pvcs.
+    rate_limiter = RateLimiter(rate)
+    deleted = list()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict((executor.submit(delete_pvc, kube_client, rate_limiter, pvc), pvc) for pvc in pvcs)
+        for future in concurrent.futures.as_completed(futures):
+            pvc = futures[future]
+            try:
+                future.result()
+                deleted.append(pvc)
+            except client.rest.ApiException as e:
+                print(f"Error deleting pvc {pvc.namespace}/{pvc.name}: {e.status} {e.reason}")
+    return deleted
+
+###########################################
+### WATCH MODE ############################
+###########################################
+class ClaimsTracker:
+    # Mounted claims refcounts updated from the pods, statefulsets and pvcs watch events: the cost of an event is
+    # the number of claims of the object, and the expired pvcs check only reads the claims with a zero refcount.
+    def __init__(self, state):
+        self.lock = threading.Lock()
+        self.state = state
+        # (namespace, name) of the pods and statefulsets => claims (namespace, claim) they hold.
+        self.holders = dict()
+        # (namespace, claim) => number of holders.
+        self.refcount = dict()
+        # (namespace, name) => pvc record.
+        self.pvcs = dict()
+        # (namespace, name) => time since the pvc has no holder.
+        self.unmounted = dict()
+        # Set once the first LISTs are done.
+        self.synced = False
+
+    def get_claims(self, resource, record):
+        if resource == "pods":
+            return tuple((record.namespace, claim) for claim in record.claims)
+        return tuple((record.namespace, f"{template}-{record.name}-{ordinal}")
+                     for template in record.claim_templates for ordinal in range(record.replicas or 0))
+
+    def set_unmounted(self, key, now):
+        # Start of the grace period, kept from the state file for the same pvc on startup.
+        pvc = self.pvcs[key]
+        entry = None if self.synced else self.state.pvcs.get(f"{key[0]}/{key[1]}")
+        self.unmounted[key] = entry["since"] if entry and entry.get("uid") == pvc.uid else now
+
+    def set_holder(self, resource, key, claims):
+        now = time.time()
+        previous = self.holders.pop((resource, key), ())
+        if claims:
+            self.holders[(resource, key)] = claims
+        for claim in set(claims) - set(previous):
+            self.refcount[claim] = self.refcount.get(claim, 0) + 1
+            self.unmounted.pop(claim, None)
+        for claim in set(previous) - set(claims):
+            self.refcount[claim] -= 1
+            if not self.refcount[claim]:
+                del self.refcount[claim]
+                if claim in self.pvcs:
+                    self.set_unmounted(claim, now)
+
+    def set_pvc(self, pvc):
+        key = (pvc.namespace, pvc.name)
+        previous = self.pvcs.get(key)
+        self.pvcs[key] = pvc
+        if key not in self.refcount and (previous is None or previous.uid != pvc.uid):
+            self.set_unmounted(key, time.time())
+
+    def remove_pvc(self, key):
+        self.pvcs.pop(key, None)
+        self.unmounted.pop(key, None)
+
+    def apply(self, resource, event_type, record):
+        key = (record.namespace, record.name)
+        with self.lock:
+            if resource == "persistentvolumeclaims":
+                if event_type == "DELETED":
+                    self.remove_pvc(key)
+                else:
+                    self.set_pvc(record)
+            else:
+                self.set_holder(resource, key, () if event_type == "DELETED" else self.get_claims(resource, record))
+
+    def reset(self, resource, namespace, records):
+        # Content of a new LIST: the objects of the namespace (None: all) not listed anymore are removed.
+        listed = set((record.namespace, record.name) for record in records)
+        with self.lock:
+            if resource == "persistentvolumeclaims":
+                for key in [ key for key in self.pvcs if namespace in (None, key[0]) and key not in listed ]:
+                    self.remove_pvc(key)
+            else:
+                for _resource, key in [ holder for holder in self.holders if holder[0] == resource ]:
+                    if namespace in (None, key[0]) and key not in listed:
+                        self.set_holder(resource, key, ())
+        for record in records:
+            self.apply(resource, "ADDED", record)
+
+    def get_unmounted_since(self):
+        # Unmounted pvcs with the time they have no holder.
+        with self.lock:
+            since = [ (self.pvcs[key], unmounted) for key, unmounted in self.unmounted.items() ]
+            # Tracked in the state file, so that a restart of the daemon does not restart the grace periods.
+            self.state.pvcs = dict((f"{pvc.namespace}/{pvc.name}", {"uid": pvc.uid, "since": unmounted, "size": pvc.size})
+                                   for pvc, unmounted in since)
+        return since
+
+
+# Resource => record of the watched resources.
+WATCHED_RESOURCES = {"pods": PodRecord, "statefulsets": StatefulSetRecord, "persistentvolumeclaims": PvcRecord}
+
+def watch_resource(api_client, tracker, resource, namespace, synced):
+    # LIST then WATCH from its resource version, a new LIST is done when the resource version is too old.
+    path, path_params = get_raw_path(resource, namespace)
+    record = WATCHED_RESOURCES[resource]
+    # Only the first successful LIST counts for the startup barrier of run_watch.
+    listed = False
+
+    def on_list(records):
+        nonlocal listed
+        tracker.reset(resource, namespace, records)
+        if not listed:
+            listed = True
+            synced.release()
+
+    while True:
+        try:
+            list_then_watch(api_client, path, record, on_list, partial(tracker.apply, resource), lambda: False,
+                            path_params=path_params, timeout_seconds=WATCH_TIMEOUT)
+        except Exception as e:
+            print(f"Error watching {resource} ({namespace or 'all namespaces'}): {e}")
+            time.sleep(WATCH_RETRY_DELAY)
+
+def run_watch(kube_client, namespaces, args):
+    # Daemon: the pvcs without holder for the grace period are deleted every sweep interval.
+    state = PvcState(args.state_file)
+    tracker = ClaimsTracker(state)
+    synced = threading.Semaphore(0)
+    watchers = [ (resource, namespace) for namespace in namespaces for resource in WATCHED_RESOURCES ]
+    for resource, namespace in watchers:
+        threading.Thread(target=watch_resource, args=(kube_client.api_client, tracker, resource, namespace, synced),
+                         daemon=True).start()
+    # The refcounts are only complete once all the first LISTs are done.
+    for _watcher in watchers:
+        synced.acquire()
+    with tracker.lock:
+        tracker.synced = True
+    print(f"Tracking {len(tracker.pvcs)} pvcs, {len(tracker.unmounted)} unmounted")
+
+    reported = set()
+    try:
+        while True:
+            now = time.time()
+            expired_pvc = get_expired_pvcs(tracker.get_unmounted_since(), now, args.grace_period,
+                                           args.largest_first, args.max_deletions)
+            for pvc in expired_pvc:
+                if (pvc.namespace, pvc.name, pvc.uid) not in reported:
+                    print("Deleting pvc :", f"{pvc.namespace}/{pvc.name}", f"({pvc.size // 2**20}Mi)")
+                    reported.add((pvc.namespace, pvc.name, pvc.uid))
+            if args.run and expired_pvc:
+                deleted = delete_pvcs(kube_client, expired_pvc, args.workers, args.rate)
+                print(f"Deleted {len(deleted)} pvcs ({sum(pvc.size for pvc in deleted) // 2**30}Gi)")
+                # Not deleted again before the DELETED event.
+                with tracker.lock:
+                    for pvc in deleted:
+                        tracker.unmounted.pop((pvc.namespace, pvc.name), None)
+            state.save()
+            time.sleep(args.sweep_interval)
+    except KeyboardInterrupt:
+        state.save()
+
 if __name__ == "__main__":
-    
-    run = vars(parse_args())['run']
+
+    args = parse_args()
+    run = args.run
     print("Not dry-run, pvc will be deleted") if run else print("Running in dry-run mode")
-    NAMESPACE = "reference"
+    namespaces = [None] if args.all_namespaces else args.namespace
     config.load_kube_config()
     kube_client = client.CoreV1Api()
-    pvc_list = []
-
-    for pvc in kube_client.list_namespaced_persistent_volume_claim(NAMESPACE).items:
-        pvc_list.append(pvc.metadata.name)
-        mounted_pvc_list = []
-    for pod in kube_client.list_namespaced_pod(NAMESPACE).items:
-        if str(pod.spec.volumes) != "None":
-            for volume in pod.spec.volumes:
-                if str(volume.persistent_volume_claim) != "None":
-                    mounted_pvc_list.append(volume.persistent_volume_claim.claim_name)
-
-    unmounted_pvc = set(pvc_list) - set(mounted_pvc_list)
-    print("Total: ",len(pvc_list))
-    print("Mounted: ",len(mounted_pvc_list))
-    print("Unmounted: ",len(unmounted_pvc))
-
-    for pvc in sorted(list(unmounted_pvc)):
-        print("Deleting pvc :",pvc)
-        if run:
-            kube_client.delete_namespaced_persistent_volume_claim(pvc, NAMESPACE)
 
+    if args.watch:
+        run_watch(kube_client, namespaces, args)
+        sys.exit(0)
+
+    # Only the names of the claims and of the mounted claims are read from the raw LIST responses.
+    total = 0
+    mounted = 0
+    unmounted_pvc = list()
+    for namespace in namespaces:
+        ns_total, ns_mounted, ns_unmounted = get_unmounted_pvcs(kube_client.api_client, namespace)
+        total += ns_total
+        mounted += ns_mounted
+        unmounted_pvc.extend(ns_unmounted)
+    print("Total: ", total)
+    print("Mounted: ", mounted)
+    print("Unmounted: ", len(unmounted_pvc))
+
+    # Only the pvcs unmounted for more than the grace period, on this run and the previous ones, are deleted.
+    now = time.time()
+    state = PvcState(args.state_file)
+    unmounted_since = state.update(namespaces, unmounted_pvc, now)
+    expired_pvc = get_expired_pvcs(unmounted_since, now, args.grace_period, args.largest_first, args.max_deletions)
+    print("Expired: ", len(expired_pvc), f"(unmounted for more than {args.grace_period}s)")
+
+    for pvc in expired_pvc:
+        print("Deleting pvc :", f"{pvc.namespace}/{pvc.name}", f"({pvc.size // 2**20}Mi)")
+    if run and expired_pvc:
+        start = time.monotonic()
+        deleted = delete_pvcs(kube_client, expired_pvc, args.workers, args.rate)
+        print(f"Deleted {len(deleted)} pvcs ({sum(pvc.size for pvc in deleted) // 2**30}Gi) in {time.monotonic() - start:.1f}s "
+              f"({len(expired_pvc) - len(deleted)} errors)")
+        state.remove(deleted)
+    state.save()
@@ -26,6 +26,8 @@
 # https://docs.aws.amazon.com/general/latest/gr/sigv4-signed-request-examples.html
 
 import argparse
+import concurrent.futures
+import json, random, time
 import sys, os, base64, datetime, hashlib, hmac, urllib
 import requests # pip install requests
 
@@ -35,22 +37,24 @@ from configparser import NoOptionError
 from configparser import NoSectionError
 
 
-# ************* PARSE ARGUMENTS *************
-
-parser = argparse.ArgumentParser(description="Enable additional metrics on the AWS CloudFront distribution")
-parser.add_argument("distribution_id", help="id of the CloudFront distribution") 
-parser.add_argument("enabled", choices=['true', 'false'], help="\"true\" if the additional metrics should be enabled, \"false\" otherwise") 
-args = parser.parse_args()
-
-
 # ************* REQUEST VALUES *************
 method = 'POST'
 service = 'cloudfront'
 host = 'cloudfront.amazonaws.com'
 region = 'us-east-1'
-endpoint = 'https://cloudfront.amazonaws.com/2019-03-26/distributions/' + args.distribution_id + '/monitoring-subscription'
-uri = '/2019-03-26/distributions/' + args.distribution_id + '/monitoring-subscription'
+api_version = '2019-03-26'
 action = 'updateMonitoringSubscription'
+endpoint = 'https://' + host
+
+# ************* BULK MODE VALUES *************
+default_workers = 8
+default_retries = 5
+# Backoff delays in seconds: base * 2^attempt with jitter, at most max.
+backoff_base = 0.5
+backoff_max = 20
+# Responses retried: throttling (HTTP status or error code of the XML body) and server errors.
+retry_status = (429, 500, 502, 503, 504)
+retry_codes = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'ServiceUnavailable')
 
 request_body =  '''<?xml version="1.0" encoding="UTF-8"?>
 <MonitoringSubscriptionConfig xmlns=\"http://cloudfront.amazonaws.com/doc/2019-03-26/\">
@@ -58,7 +62,7 @@ request_body =  '''<?xml version="1.0" encoding="UTF-8"?>
         <SubscriptionStatus>{}</SubscriptionStatus>
     </RealtimeMetricsSubscriptionConfig>
 </MonitoringSubscriptionConfig>
-'''.format("Enabled" if args.enabled == "true" else "Disabled")
+'''
 
 
 # Key derivation functions. See:
@@ -79,10 +83,11 @@ def getSignatureKey(key, dateStamp, regionName, serviceName):
 def get_profile_credentials(profile_name):
     from os import path
     config = ConfigParser()
-    config.read([path.join(path.expanduser("~"),'.aws/credentials')])
+    config.read([os.environ.get('AWS_SHARED_CREDENTIALS_FILE', path.join(path.expanduser("~"),'.aws/credentials'))])
     try:
         aws_access_key_id = config.get(profile_name, 'aws_access_key_id')
         aws_secret_access_key = config.get(profile_name, 'aws_secret_access_key')
+        aws_session_token = config.get(profile_name, 'aws_session_token', fallback=None)
     except ParsingError:
         print('Error parsing config file')
         raise
@@ -90,75 +95,200 @@ def get_profile_credentials(profile_name):
         try:
             aws_access_key_id = config.get('default', 'aws_access_key_id')
             aws_secret_access_key = config.get('default', 'aws_secret_access_key')
+            aws_session_token = config.get('default', 'aws_session_token', fallback=None)
         except (NoSectionError, NoOptionError):
             print('Unable to find valid AWS credentials')
             raise
-    return aws_access_key_id, aws_secret_access_key
-
-access_key, secret_key = get_profile_credentials('default')
-if access_key is None or secret_key is None:
-    print('No access key is available.')
-    sys.exit()
-
-# Create a date for headers and the credential string
-t = datetime.datetime.utcnow()
-amz_date = t.strftime('%Y%m%dT%H%M%SZ') # Format date as YYYYMMDD'T'HHMMSS'Z'
-datestamp = t.strftime('%Y%m%d') # Date w/o time, used in credential scope
-
-
-# ************* TASK 1: CREATE A CANONICAL REQUEST *************
-# http://docs.aws.amazon.com/general/latest/gr/sigv4-create-canonical-request.html
-
-canonical_uri = uri
-canonical_headers = 'host:' + host + '\n'
-signed_headers = 'host'
-
-# Match the algorithm to the hashing algorithm you use, either SHA-1 or SHA-256 (recommended)
-algorithm = 'AWS4-HMAC-SHA256'
-credential_scope = datestamp + '/' + region + '/' + service + '/' + 'aws4_request'
-
-# Create the canonical query string.
-canonical_querystring = 'Action=' + action +'&Version=2019-03-26'
-canonical_querystring += '&X-Amz-Algorithm=AWS4-HMAC-SHA256'
-canonical_querystring += '&X-Amz-Credential=' + urllib.parse.quote_plus(access_key + '/' + credential_scope)
-canonical_querystring += '&X-Amz-Date=' + amz_date
-canonical_querystring += '&X-Amz-Expires=30'
-canonical_querystring += '&X-Amz-SignedHeaders=' + signed_headers
-
-# Create payload hash. 
-payload_hash = hashlib.sha256(request_body.encode('utf-8')).hexdigest()
-
-# Combine elements to create canonical request
-canonical_request = method + '\n' + canonical_uri + '\n' + canonical_querystring + '\n' + canonical_headers + '\n' + signed_headers + '\n' + payload_hash
-
-
-# ************* TASK 2: CREATE THE STRING TO SIGN*************
-string_to_sign = algorithm + '\n' +  amz_date + '\n' +  credential_scope + '\n' +  hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()
-
-
-# ************* TASK 3: CALCULATE THE SIGNATURE *************
-# Create the signing key
-signing_key = getSignatureKey(secret_key, datestamp, region, service)
-
-# Sign the string_to_sign using the signing_key
-signature = hmac.new(signing_key, (string_to_sign).encode("utf-8"), hashlib.sha256).hexdigest()
-
-
-# ************* TASK 4: ADD SIGNING INFORMATION TO THE REQUEST *************
-canonical_querystring += '&X-Amz-Signature=' + signature
+    return aws_access_key_id, aws_secret_access_key, aws_session_token
+
+def get_credentials(profile_name=None):
+    # Credentials of the env. variables (AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY and the optional AWS_SESSION_TOKEN
+    # of temporary credentials), else of the profile (AWS_PROFILE, default by default) of the credentials file.
+    if os.environ.get('AWS_ACCESS_KEY_ID') and os.environ.get('AWS_SECRET_ACCESS_KEY'):
+        return os.environ['AWS_ACCESS_KEY_ID'], os.environ['AWS_SECRET_ACCESS_KEY'], os.environ.get('AWS_SESSION_TOKEN')
+    return get_profile_credentials(profile_name or os.environ.get('AWS_PROFILE', 'default'))
+
+
+# ************* SIGNER *************
+class SigV4Signer:
+    # Query string (presigned URL) signature version 4 of the requests. The signing key only changes with the date,
+    # it is derived once per (date, region, service) and reused for the following requests.
+    algorithm = 'AWS4-HMAC-SHA256'
+
+    def __init__(self, access_key, secret_key, session_token=None, region=region, service=service):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.session_token = session_token
+        self.region = region
+        self.service = service
+        self.signing_keys = dict()
+
+    def get_signing_key(self, datestamp, region, service):
+        key = (datestamp, region, service)
+        if key not in self.signing_keys:
+            self.signing_keys[key] = getSignatureKey(self.secret_key, datestamp, region, service)
+        return self.signing_keys[key]
+
+    def presign_url(self, method, host, uri, params, body='', expires=30, region=None, service=None, now=None, scheme='https'):
+        # URL of the request with its signature in the query string, params being the request query parameters.
+        region = region or self.region
+        service = service or self.service
+        t = now or datetime.datetime.utcnow()
+        amz_date = t.strftime('%Y%m%dT%H%M%SZ') # Format date as YYYYMMDD'T'HHMMSS'Z'
+        datestamp = t.strftime('%Y%m%d') # Date w/o time, used in credential scope
+
+        # ************* TASK 1: CREATE A CANONICAL REQUEST *************
+        # http://docs.aws.amazon.com/general/latest/gr/sigv4-create-canonical-request.html
+        canonical_headers = 'host:' + host + '\n'
+        signed_headers = 'host'
+        credential_scope = datestamp + '/' + region + '/' + service + '/' + 'aws4_request'
+
+        # Create the canonical query string, sorted by parameter name.
+        query = dict(params)
+        query['X-Amz-Algorithm'] = self.algorithm
+        query['X-Amz-Credential'] = self.access_key + '/' + credential_scope
+        query['X-Amz-Date'] = amz_date
+        query['X-Amz-Expires'] = str(expires)
+        query['X-Amz-SignedHeaders'] = signed_headers
+        if self.session_token:
+            query['X-Amz-Security-Token'] = self.session_token
+        canonical_querystring = '&'.join(urllib.parse.quote(name, safe='-_.~') + '=' + urllib.parse.quote(value, safe='-_.~')
+                                         for name, value in sorted(query.items()))
+
+        # Create payload hash.
+        payload_hash = hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+        # Combine elements to create canonical request
+        canonical_request = method + '\n' + uri + '\n' + canonical_querystring + '\n' + canonical_headers + '\n' + signed_headers + '\n' + payload_hash
+
+        # ************* TASK 2: CREATE THE STRING TO SIGN*************
+        string_to_sign = self.algorithm + '\n' +  amz_date + '\n' +  credential_scope + '\n' +  hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()
+
+        # ************* TASK 3: CALCULATE THE SIGNATURE *************
+        signature = hmac.new(self.get_signing_key(datestamp, region, service), (string_to_sign).encode("utf-8"), hashlib.sha256).hexdigest()
+
+        # ************* TASK 4: ADD SIGNING INFORMATION TO THE REQUEST *************
+        return scheme + '://' + host + uri + '?' + canonical_querystring + '&X-Amz-Signature=' + signature
 
 
 # ************* SEND THE REQUEST *************
-# The 'host' header is added automatically by the Python 'request' lib. But it must exist as a header in the request.
-request_url = endpoint + "?" + canonical_querystring
-
-r = requests.post(request_url, data=request_body)
-
-if not r.ok:
-    print('Request URL = ' + request_url, file=sys.stderr)
-    print('Response code: %d' % r.status_code, file=sys.stderr)
-    print('Response data:')
-    print(r.text, file=sys.stderr)
-    sys.exit(1)
-else:
-    print('Successfully enabled additional metrics on CDN distribution ' + args.distribution_id)
+def set_additional_metrics(signer, distribution_id, enabled, session=requests, endpoint=endpoint):
+    # The 'host' header is added automatically by the Python 'request' lib. But it must exist as a header in the request.
+    url = urllib.parse.urlsplit(endpoint)
+    uri = url.path.rstrip('/') + '/' + api_version + '/distributions/' + distribution_id + '/monitoring-subscription'
+    body = request_body.format("Enabled" if enabled else "Disabled")
+    request_url = signer.presign_url(method, url.netloc, uri, [('Action', action), ('Version', api_version)], body,
+                                     scheme=url.scheme)
+    return request_url, session.post(request_url, data=body)
+
+
+# ************* BULK MODE *************
+def read_distribution_ids(filename):
+    # One distribution id per line of the file (- for stdin), empty lines and # comments are ignored.
+    stream = sys.stdin if filename == '-' else open(filename)
+    try:
+        ids = [ line.split('#', 1)[0].strip() for line in stream ]
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    return list(dict.fromkeys(id for id in ids if id))
+
+def is_retried(response):
+    if response.status_code in retry_status:
+        return True
+    return response.status_code == 400 and any('<Code>' + code + '</Code>' in response.text for code in retry_codes)
+
+def get_backoff_delay(attempt, response=None):
+    # Retry-After of the response when given, else exponential backoff with full jitter.
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after and retry_after.isdigit():
+        return min(int(retry_after), backoff_max)
+    return random.uniform(0, min(backoff_max, backoff_base * 2 ** attempt))
+
+def update_distribution(signer, session, distribution_id, enabled, retries, endpoint=endpoint):
+    # Request of one distribution, retried on throttling, server and connection errors (signed again at each
+    # attempt). Returns its result report.
+    start = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        response = None
+        try:
+            _request_url, response = set_additional_metrics(signer, distribution_id, enabled, session, endpoint)
+            if response.ok:
+                return {'distribution_id': distribution_id, 'ok': True, 'status': response.status_code,
+                        'attempts': attempt, 'duration': round(time.monotonic() - start, 3), 'error': None}
+            error = response.text.strip()
+            retried = is_retried(response)
+        except requests.RequestException as e:
+            error = str(e)
+            retried = True
+        if not retried or attempt > retries:
+            return {'distribution_id': distribution_id, 'ok': False,
+                    'status': response.status_code if response is not None else None,
+                    'attempts': attempt, 'duration': round(time.monotonic() - start, 3), 'error': error}
+        time.sleep(get_backoff_delay(attempt - 1, response))
+
+def update_distributions(signer, distribution_ids, enabled, workers=default_workers, retries=default_retries,
+                         endpoint=endpoint):
+    # Concurrent requests, at most workers at the same time, over the keep-alive connections of one session.
+    # Returns the result reports in the order of the distribution ids.
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    with session, concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(lambda distribution_id: update_distribution(signer, session, distribution_id, enabled,
+                                                                           retries, endpoint), distribution_ids)
+        return list(results)
+
+def print_report(results, output=None):
+    print(f"{'DISTRIBUTION':<20} {'RESULT':<7} {'STATUS':>6} {'ATTEMPTS':>8} {'TIME(s)':>8}  ERROR")
+    for result in results:
+        error = ' '.join((result['error'] or '').split())[:120]
+        print(f"{result['distribution_id']:<20} {'OK' if result['ok'] else 'FAILED':<7} {str(result['status']):>6} "
+              f"{result['attempts']:>8} {result['duration']:>8.2f}  {error}")
+    failed = sum(1 for result in results if not result['ok'])
+    print(f"{len(results) - failed} succeeded, {failed} failed")
+    if output:
+        with open(output, 'w') as report:
+            json.dump(results, report, indent=2)
+
+
+if __name__ == '__main__':
+    # ************* PARSE ARGUMENTS *************
+    parser = argparse.ArgumentParser(description="Enable additional metrics on the AWS CloudFront distribution")
+    parser.add_argument("distribution_id", nargs='?', help="id of the CloudFront distribution")
+    parser.add_argument("enabled", choices=['true', 'false'], help="\"true\" if the additional metrics should be enabled, \"false\" otherwise")
+    parser.add_argument("--profile", default=None, help="AWS credentials profile, default is AWS_PROFILE or \"default\" (the AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY and AWS_SESSION_TOKEN env. variables are used first)")
+    parser.add_argument("-f", "--file", default=None, help="Bulk mode: file of the distribution ids, one per line (- for stdin)")
+    parser.add_argument("-w", "--workers", type=int, default=default_workers, help=f"Bulk mode: number of requests sent at the same time, default is {default_workers}")
+    parser.add_argument("--retries", type=int, default=default_retries, help=f"Maximum number of retries of a request on throttling or server error, default is {default_retries}")
+    parser.add_argument("--endpoint", default=endpoint, help=f"CloudFront API endpoint, default is {endpoint}")
+    parser.add_argument("--report", default=None, help="Bulk mode: save the result of each distribution in this JSON file")
+    args = parser.parse_args()
+    if (args.distribution_id is None) == (args.file is None):
+        parser.error("one of distribution_id or --file is required")
+
+    access_key, secret_key, session_token = get_credentials(args.profile)
+    if access_key is None or secret_key is None:
+        print('No access key is available.')
+        sys.exit()
+
+    signer = SigV4Signer(access_key, secret_key, session_token)
+    if args.file:
+        results = update_distributions(signer, read_distribution_ids(args.file), args.enabled == "true",
+                                       args.workers, args.retries, args.endpoint)
+        print_report(results, args.report)
+        sys.exit(0 if all(result['ok'] for result in results) else 1)
+
+    request_url, r = set_additional_metrics(signer, args.distribution_id, args.enabled == "true", endpoint=args.endpoint)
+
+    if not r.ok:
+        print('Request URL = ' + request_url, file=sys.stderr)
+        print('Response code: %d' % r.status_code, file=sys.stderr)
+        print('Response data:')
+        print(r.text, file=sys.stderr)
+        sys.exit(1)
+    else:
+        print('Successfully enabled additional metrics on CDN distribution ' + args.distribution_id)
@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+# Kubernetes helpers shared by the segmenter tools (update_segmenter.py, update_newlabels.py, clean_pvc.py).
+import codecs
+import json
+import re
+from types import SimpleNamespace
+
+from kubernetes.utils.quantity import parse_quantity
+
+# Default number of items per page of the LIST requests.
+DEFAULT_PAGE_LIMIT = 500
+
+# Default format of the group label value of the segmenter objects.
+DEFAULT_GROUP_LABEL_FORMAT = "{name}-{groupid}-group"
+
+# Size in bytes of the chunks read from a raw LIST response.
+RAW_CHUNK_SIZE = 64 * 1024
+
+# Start of the items array in a LIST response body.
+RAW_ITEMS_MARKER = re.compile(r'"items"\s*:\s*')
+
+
+def join_selectors(*selectors):
+    return ",".join(selector for selector in selectors if selector)
+
+
+def list_all(list_func, *args, limit=DEFAULT_PAGE_LIMIT, **kwargs):
+    # Items of a LIST request, fetched by pages of limit items (limit/continue).
+    items = list()
+    _continue = None
+    while True:
+        if _continue:
+            kwargs["_continue"] = _continue
+        result = list_func(*args, limit=limit, **kwargs)
+        items.extend(result.items)
+        _continue = result.metadata._continue
+        if not _continue:
+            return items
+
+
+def get_group_label_values(name, groupids, group_format=DEFAULT_GROUP_LABEL_FORMAT):
+    # Group label value => group id.
+    return dict((group_format.format(name=name, groupid=groupid), groupid) for groupid in groupids)
+
+
+def list_by_groups(list_func, *args, label_selector="", groups=None, match=None, limit=DEFAULT_PAGE_LIMIT, **kwargs):
+    # Objects of the groups selected server side with "group in (...)" (groups: group label value => group id).
+    # The client side filter match(item, groupids) is only applied to the legacy objects: the ones without group
+    # label, and the ones of the groups not found (group label value in another format).
+    if not groups:
+        return list_all(list_func, *args, label_selector=label_selector, limit=limit, **kwargs)
+
+    group_selector = f"group in ({','.join(sorted(groups.keys()))})"
+    items = list_all(list_func, *args, label_selector=join_selectors(label_selector, group_selector), limit=limit, **kwargs)
+    found = set(groups[item.metadata.labels["group"]] for item in items)
+    groupids = list(dict.fromkeys(groups.values()))
+    missing = [groupid for groupid in groupids if groupid not in found]
+
+    legacy_selector = "" if missing else "!group"
+    known = set((item.metadata.namespace, item.metadata.name) for item in items)
+    for item in list_all(list_func, *args, label_selector=join_selectors(label_selector, legacy_selector), limit=limit, **kwargs):
+        if (item.metadata.namespace, item.metadata.name) in known:
+            continue
+        labelled = "group" in (item.metadata.labels or dict())
+        if match(item, missing if labelled else groupids):
+            items.append(item)
+    return items
+
+
+###########################################
+### RAW LIST ##############################
+###########################################
+# The LIST responses are parsed from the raw JSON body into compact records holding only the fields read by the
+# tools, instead of being deserialized into the kubernetes client models.
+class DeploymentRecord:
+    __slots__ = ("name", "namespace", "labels", "match_labels", "template_labels")
+
+    def __init__(self, item):
+        metadata = item.get("metadata") or dict()
+        spec = item.get("spec") or dict()
+        self.name = metadata.get("name")
+        self.namespace = metadata.get("namespace")
+        self.labels = metadata.get("labels") or dict()
+        self.match_labels = (spec.get("selector") or dict()).get("matchLabels") or dict()
+        self.template_labels = ((spec.get("template") or dict()).get("metadata") or dict()).get("labels") or dict()
+
+
+class PodRecord:
+    __slots__ = ("name", "namespace", "labels", "terminating", "phase", "images", "ready", "claims")
+
+    def __init__(self, item):
+        metadata = item.get("metadata") or dict()
+        spec = item.get("spec") or dict()
+        status = item.get("status") or dict()
+        self.name = metadata.get("name")
+        self.namespace = metadata.get("namespace")
+        self.labels = metadata.get("labels") or dict()
+        self.terminating = metadata.get("deletionTimestamp") is not None
+        self.phase = status.get("phase")
+        # (container name, image) of the containers.
+        self.images = tuple((container.get("name", ""), container.get("image", "")) for container in spec.get("containers") or ())
+        self.ready = sum(1 for container in status.get("containerStatuses") or () if container.get("ready") is True)
+        # Names of the mounted persistent volume claims.
+        self.claims = tuple(volume["persistentVolumeClaim"]["claimName"] for volume in spec.get("volumes") or ()
+                            if volume.get("persistentVolumeClaim"))
+
+
+class StatefulSetRecord:
+    __slots__ = ("name", "namespace", "replicas", "claim_templates")
+
+    def __init__(self, item):
+        metadata = item.get("metadata") or dict()
+        spec = item.get("spec") or dict()
+        self.name = metadata.get("name")
+        self.namespace = metadata.get("namespace")
+        self.replicas = spec.get("replicas", 1)
+        # Names of the volume claim templates, the claims of the pods are <template>-<statefulset>-<ordinal>.
+        self.claim_templates = tuple((template.get("metadata") or dict()).get("name")
+                                     for template in spec.get("volumeClaimTemplates") or ())
+
+
+class PvcRecord:
+    __slots__ = ("name", "namespace", "uid", "phase", "size")
+
+    def __init__(self, item):
+        metadata = item.get("metadata") or dict()
+        spec = item.get("spec") or dict()
+        self.name = metadata.get("name")
+        self.namespace = metadata.get("namespace")
+        self.uid = metadata.get("uid")
+        self.phase = (item.get("status") or dict()).get("phase")
+        # Requested storage in bytes, 0 when unknown.
+        try:
+            self.size = int(parse_quantity(((spec.get("resources") or dict()).get("requests") or dict()).get("storage", 0)))
+        except ValueError:
+            self.size = 0
+
+
+def read_raw_list(response, record, chunk_size=RAW_CHUNK_SIZE):
+    # Incremental parser of a LIST response: the items are decoded one by one while the body is read, so that only
+    # one item is held as JSON at a time. Returns the list metadata (serialized before the items by the apiserver)
+    # and the records built from the items.
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    parser = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buffer, pos, eof
+        if eof:
+            raise ValueError("Truncated LIST response")
+        chunk = response.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[pos:] + decoder.decode(chunk, final=eof)
+        pos = 0
+
+    # List header up to the items.
+    match = None
+    while match is None:
+        match = RAW_ITEMS_MARKER.search(buffer)
+        if match is None:
+            if eof:
+                # No items array: small body, parsed at once.
+                body = json.loads(buffer)
+                return body.get("metadata") or dict(), [ record(item) for item in body.get("items") or () ]
+            fill()
+    metadata = json.loads(buffer[:match.start()].rstrip().rstrip(",") + "}").get("metadata") or dict()
+    pos = match.end()
+
+    records = list()
+    while len(buffer[pos:].lstrip()) < 4 and not eof:
+        fill()
+    pos = len(buffer) - len(buffer[pos:].lstrip())
+    if buffer.startswith("null", pos):
+        return metadata, records
+    pos += 1
+
+    while True:
+        # Skip the separators between the items.
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos == len(buffer):
+            fill()
+            continue
+        if buffer[pos] == "]":
+            return metadata, records
+        try:
+            item, end = parser.raw_decode(buffer, pos)
+        except ValueError:
+            # Item not fully received yet.
+            fill()
+            continue
+        records.append(record(item))
+        pos = end
+
+
+def list_raw_with_version(api_client, path, record, path_params=None, label_selector=None, field_selector=None,
+                          limit=DEFAULT_PAGE_LIMIT):
+    # Records of a LIST request fetched by pages of limit items, without the models deserialization, and the
+    # resource version of the list (start of a watch).
+    records = list()
+    _continue = None
+    while True:
+        query_params = [("limit", limit)]
+        if label_selector:
+            query_params.append(("labelSelector", label_selector))
+        if field_selector:
+            query_params.append(("fieldSelector", field_selector))
+        if _continue:
+            query_params.append(("continue", _continue))
+        response = api_client.call_api(path, "GET",
+                                       path_params or dict(),
+                                       query_params,
+                                       {"Accept": "application/json"},
+                                       auth_settings=["BearerToken"],
+                                       _return_http_data_only=True,
+                                       _preload_content=False)
+        try:
+            metadata, page = read_raw_list(response, record)
+        finally:
+            response.release_conn()
+        records.extend(page)
+        _continue = metadata.get("continue")
+        if not _continue:
+            return records, metadata.get("resourceVersion")
+
+
+def list_raw(api_client, path, record, **kwargs):
+    return list_raw_with_version(api_client, path, record, **kwargs)[0]
+
+
+class WatchError(Exception):
+    # ERROR event of a watch, code 410 when the resource version is too old (a new LIST is needed).
+    def __init__(self, status):
+        super().__init__(status.get("message", "watch error"))
+        self.code = status.get("code")
+
+
+def watch_raw(api_client, path, record, path_params=None, resource_version=None, label_selector=None,
+              timeout_seconds=None):
+    # Events (type, record, resource version) of a WATCH request, decoded line by line from the raw response.
+    query_params = [("watch", "true"), ("allowWatchBookmarks", "true")]
+    if resource_version:
+        query_params.append(("resourceVersion", resource_version))
+    if label_selector:
+        query_params.append(("labelSelector", label_selector))
+    if timeout_seconds:
+        query_params.append(("timeoutSeconds", timeout_seconds))
+    response = api_client.call_api(path, "GET",
+                                   path_params or dict(),
+                                   query_params,
+                                   {"Accept": "application/json"},
+                                   auth_settings=["BearerToken"],
+                                   _return_http_data_only=True,
+                                   _preload_content=False)
+    try:
+        buffer = b""
+        for chunk in response.stream(RAW_CHUNK_SIZE):
+            buffer += chunk
+            lines = buffer.split(b"\n")
+            buffer = lines.pop()
+            for line in lines:
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                obj = event.get("object") or dict()
+                if event.get("type") == "ERROR":
+                    raise WatchError(obj)
+                yield event.get("type"), record(obj), (obj.get("metadata") or dict()).get("resourceVersion")
+    finally:
+        response.release_conn()
+
+
+def get_model_record(api_client, model):
+    # Record building the kubernetes client model of an item (ex: V1Pod), for the callers working on the models.
+    return lambda item: api_client.deserialize(SimpleNamespace(data=json.dumps(item)), model)
+
+
+def list_then_watch(api_client, path, record, on_list, on_event, stop, path_params=None, label_selector=None,
+                    resource_version=None, timeout_seconds=None, on_watch_end=None, list_runner=None):
+    # LIST then WATCH from the resource version of the list (or from the given one), again from a new LIST when the
+    # resource version is too old. on_list(records) is called with the listed records and on_event(type, record)
+    # with each watch event, bookmarks excluded. The loop ends when stop() returns True, checked after the list,
+    # after each event and after each watch request (on_watch_end() is called at its end). timeout_seconds is the
+    # timeout of the watch requests or a function returning it, list_runner(func, *args, **kwargs) runs the LISTs.
+    while not stop():
+        if resource_version is None:
+            if list_runner is None:
+                records, resource_version = list_raw_with_version(api_client, path, record, path_params=path_params,
+                                                                  label_selector=label_selector)
+            else:
+                records, resource_version = list_runner(list_raw_with_version, api_client, path, record,
+                                                        path_params=path_params, label_selector=label_selector)
+            on_list(records)
+            if stop():
+                return
+        events = watch_raw(api_client, path, record, path_params=path_params, resource_version=resource_version,
+                           label_selector=label_selector,
+                           timeout_seconds=timeout_seconds() if callable(timeout_seconds) else timeout_seconds)
+        try:
+            for event_type, item, item_version in events:
+                resource_version = item_version or resource_version
+                if event_type == "BOOKMARK":
+                    continue
+                on_event(event_type, item)
+                if stop():
+                    return
+        except WatchError as e:
+            # Resource version too old, restart from a new list.
+            if e.code != 410:
+                raise
+            resource_version = None
+            continue
+        finally:
+            events.close()
+        if on_watch_end is not None:
+            on_watch_end()
+
+
+# Resource => API paths (namespaced, all namespaces) of the raw requests.
+RAW_PATHS = {"deployments":            ("/apis/apps/v1/namespaces/{namespace}/deployments", "/apis/apps/v1/deployments"),
+             "statefulsets":           ("/apis/apps/v1/namespaces/{namespace}/statefulsets", "/apis/apps/v1/statefulsets"),
+             "pods":                   ("/api/v1/namespaces/{namespace}/pods", "/api/v1/pods"),
+             "persistentvolumeclaims": ("/api/v1/namespaces/{namespace}/persistentvolumeclaims", "/api/v1/persistentvolumeclaims")}
+
+
+def get_raw_path(resource, namespace=None):
+    # (path, path parameters) of the resource, in a namespace or in all namespaces.
+    namespaced, cluster = RAW_PATHS[resource]
+    if namespace:
+        return namespaced, {"namespace": namespace}
+    return cluster, dict()
+
+
+def list_deployments_raw(api_client, namespace=None, **kwargs):
+    path, path_params = get_raw_path("deployments", namespace)
+    return list_raw(api_client, path, DeploymentRecord, path_params=path_params, **kwargs)
+
+
+def list_pods_raw(api_client, namespace=None, **kwargs):
+    path, path_params = get_raw_path("pods", namespace)
+    return list_raw(api_client, path, PodRecord, path_params=path_params, **kwargs)
+
+
+def list_statefulsets_raw(api_client, namespace=None, **kwargs):
+    path, path_params = get_raw_path("statefulsets", namespace)
+    return list_raw(api_client, path, StatefulSetRecord, path_params=path_params, **kwargs)
+
+
+def list_pvcs_raw(api_client, namespace=None, **kwargs):
+    path, path_params = get_raw_path("persistentvolumeclaims", namespace)
+    return list_raw(api_client, path, PvcRecord, path_params=path_params, **kwargs)
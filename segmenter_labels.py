@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# Label reconciliation of the segmenter objects, shared by update_newlabels.py and update_segmenter.py.
+# The labels managed by the tools are described by rules: the minimal delta of an object (its missing labels) is
+# computed from its current labels, the objects without delta are skipped without API call, and the others are
+# updated with a server side apply owned by FIELD_MANAGER, so that a relabelling can be re-run on the whole fleet.
+import json
+
+# Field manager of the labels applied by the tools.
+FIELD_MANAGER = "segmenter-tools"
+
+# Labels path => attributes of the labels in the kubernetes client models.
+LABEL_PATHS = {"metadata": ("metadata", "labels"),
+               "template": ("spec", "template", "metadata", "labels")}
+
+# Kind => (apiVersion, kind, API path, client model) of the reconciled objects.
+KINDS = {"service":     ("v1", "Service", "/api/v1/namespaces/{namespace}/services/{name}", "V1Service"),
+         "statefulset": ("apps/v1", "StatefulSet", "/apis/apps/v1/namespaces/{namespace}/statefulsets/{name}", "V1StatefulSet"),
+         "deployment":  ("apps/v1", "Deployment", "/apis/apps/v1/namespaces/{namespace}/deployments/{name}", "V1Deployment")}
+
+
+###########################################
+### RULES #################################
+###########################################
+# A rule is (label, source): the label is set to source(labels, maps) when it is missing and the source gives a
+# value, labels being the labels of the rule path and maps the labels of every path of the object.
+def constant(value):
+    return lambda labels, maps: value
+
+
+def copy_label(key, path=None):
+    # Value of another label, of the same path by default.
+    return lambda labels, maps: (labels if path is None else maps.get(path, dict())).get(key)
+
+
+def get_service_rules(app_name, app_managed, app_type=None, set_group=False):
+    rules = [("app.kubernetes.io/instance",      copy_label("app")),
+             ("app.kubernetes.io/name",          constant(app_name)),
+             ("app.kubernetes.io/managed-by",    constant(app_managed)),
+             ("vendor",                          constant("quortex"))]
+    if app_type:
+        rules.append(("type", constant(app_type)))
+    if set_group:
+        rules.append(("group", copy_label("app")))
+    return {"metadata": rules}
+
+
+def get_stateful_set_rules(app_name, app_managed, app_type=None):
+    template = [("app.kubernetes.io/instance",   copy_label("app")),
+                ("app.kubernetes.io/name",       constant(app_name))]
+    if app_type:
+        template.append(("type", constant(app_type)))
+    template.append(("vendor", constant("quortex")))
+    metadata = [("app.kubernetes.io/instance",   copy_label("app")),
+                ("app.kubernetes.io/name",       constant(app_name)),
+                ("app.kubernetes.io/managed-by", constant(app_managed)),
+                ("group",                        copy_label("app"))]
+    return {"template": template, "metadata": metadata}
+
+
+def get_deployment_rules(app_name, app_managed):
+    template = [("app.kubernetes.io/instance",   copy_label("app")),
+                ("app.kubernetes.io/name",       constant(app_name))]
+    metadata = [("app.kubernetes.io/instance",   copy_label("app")),
+                ("app.kubernetes.io/name",       constant(app_name)),
+                ("app.kubernetes.io/managed-by", constant(app_managed)),
+                ("vendor",                       constant("quortex")),
+                ("group",                        copy_label("group", "template"))]
+    return {"template": template, "metadata": metadata}
+
+
+###########################################
+### RECONCILIATION ########################
+###########################################
+def get_labels(obj, path):
+    value = obj
+    for attribute in LABEL_PATHS[path]:
+        value = getattr(value, attribute, None)
+        if value is None:
+            return dict()
+    return value
+
+
+def get_label_state(obj, rules):
+    # (delta, managed): the labels to add per path, and the values of all the labels managed by the rules (the
+    # current ones and the added ones) per path. The existing labels are never changed.
+    maps = dict((path, dict(get_labels(obj, path))) for path in rules)
+    delta = dict()
+    managed = dict()
+    for path, path_rules in rules.items():
+        labels = maps[path]
+        for key, source in path_rules:
+            if key not in labels:
+                value = source(labels, maps)
+                if not value:
+                    continue
+                labels[key] = value
+                delta.setdefault(path, dict())[key] = value
+            managed.setdefault(path, dict())[key] = labels[key]
+    return delta, managed
+
+
+def format_label_delta(delta, path):
+    return " ".join(f"{key}={value}" for key, value in delta.get(path, dict()).items())
+
+
+def get_apply_config(kind, obj, managed):
+    # Applied configuration: identity of the object and all its managed labels, the labels not sent anymore would
+    # be removed from the fields of FIELD_MANAGER.
+    api_version, kind_name, _path, _model = KINDS[kind]
+    config = {"apiVersion": api_version, "kind": kind_name,
+              "metadata": {"name": obj.metadata.name, "namespace": obj.metadata.namespace}}
+    if managed.get("metadata"):
+        config["metadata"]["labels"] = managed["metadata"]
+    if managed.get("template"):
+        config["spec"] = {"template": {"metadata": {"labels": managed["template"]}}}
+    return config
+
+
+def apply_config(api_client, kind, obj, config, field_manager=FIELD_MANAGER, force=True):
+    # Server side apply of the configuration, returns the updated object.
+    _api_version, _kind, path, model = KINDS[kind]
+    return api_client.call_api(path, "PATCH",
+                               {"namespace": obj.metadata.namespace, "name": obj.metadata.name},
+                               [("fieldManager", field_manager), ("force", "true" if force else "false")],
+                               {"Accept": "application/json", "Content-Type": "application/apply-patch+yaml"},
+                               # JSON is YAML: the body is sent as is by the client for this content type.
+                               body=json.dumps(config),
+                               response_type=model,
+                               auth_settings=["BearerToken"],
+                               _return_http_data_only=True)
+
@@ -1,223 +1,283 @@
 #!/usr/bin/env python3
 import argparse
+import concurrent.futures
 import sys
+import time
 
 from kubernetes import client, config
 
-
-def get_uniq_group_ids(groupids):
-    # Specific correct identification of the group ID: tf1 => -tf1- to prevent getting tf1sf groupId.
-    if groupids is None:
-        exact_groupids = list()
+from kube_utils import (DEFAULT_GROUP_LABEL_FORMAT, get_group_label_values, get_model_record, get_raw_path, list_all,
+                        list_by_groups, list_then_watch)
+from segmenter_labels import (apply_config, format_label_delta, get_apply_config, get_label_state, get_service_rules,
+                              get_stateful_set_rules)
+
+# Labels of the segmenter objects.
+UNIT_SERVICE_RULES = get_service_rules("segmenter-unit", "segmenter-daemon")
+MONGO_SERVICE_RULES = get_service_rules("segmenter-mongo", "segmenter-daemon", app_type="dbase", set_group=True)
+MONGO_STATEFULSET_RULES = get_stateful_set_rules("ssegmenter-mongo", "segmenter-daemon", app_type="dbase")
+
+# Default number of label patches sent at the same time in batch mode.
+DEFAULT_WORKERS = 8
+
+# Default timeout in seconds of the wait for the mongo pods restart in batch mode.
+DEFAULT_ROLLOUT_TIMEOUT = 600
+
+# Maximum duration in seconds of a pods watch request.
+ROLLOUT_WATCH_TIMEOUT = 60
+
+
+# Suffixes of the label values of the group objects: <name>-<groupid>-<mongo|group>.
+GROUP_SUFFIXES = ("-mongo", "-group")
+
+def get_group_token(name, value, groupids):
+    # Group ID of a label value, exact match of the value without its <name>- prefix and its known suffix so that
+    # tf1 does not match tf1sf and 1 does not match segmenter-tf-1-mongo (dashed IDs are supported):
+    # <name>-<groupid>-<mongo|group>, <name>-<unitid>-<groupid>-unit or <name>-<groupid>-<unitid>.
+    if not value.startswith(f"{name}-"):
+        return None
+    value = value[len(name) + 1:]
+    for suffix in GROUP_SUFFIXES:
+        if value.endswith(suffix):
+            value = value[:-len(suffix)]
+            return value if value in groupids else None
+    if value in groupids:
+        return value
+    if value.endswith("-unit"):
+        token = value[:-len("-unit")].split("-", 1)[-1]
     else:
-        exact_groupids = [ f"-{idval}-" for idval in groupids ]
-
-    return exact_groupids
-
-def get_segmenter_deployments_namespaces(name, groupids):
+        token = value.rsplit("-", 1)[0]
+    return token if token in groupids else None
+
+def index_segmenter_groups(name, items, groups, label):
+    # Group ID => items of the group, in one pass over the items. The group of an item is given by its group label
+    # when it is one of the groups label values (groups: group label value => group id), else by the group token of
+    # the given label. The items of the other groups are dropped.
+    groupids = set(groups.values())
+    group_index = dict()
+    for item in items:
+        labels = item.metadata.labels or dict()
+        groupid = groups.get(labels.get("group")) or get_group_token(name, labels.get(label, ""), groupids)
+        if groupid is not None:
+            group_index.setdefault(groupid, list()).append(item)
+    return group_index
+
+def get_segmenter_deployments_namespaces(name, groupids, group_format=DEFAULT_GROUP_LABEL_FORMAT):
     clientappsv1 = client.AppsV1Api()
-    result = clientappsv1.list_deployment_for_all_namespaces(label_selector=f"type=unit,vendor=quortex")
-    segmenterdeps = list()
-    seg_namspaces = set()
-    for item in result.items:
-        # Keep deployments starting with good basename. default is "segmenter"
-        if item.metadata.name.startswith(f"{name}-"):
-            # Filter groups depending groupids filter
-            if groupids:
-                for groupid in groupids:
-                    if "group" in item.spec.template.metadata.labels:
-                        if groupid in item.spec.template.metadata.labels["group"]:
-                            segmenterdeps.append(item)
-                            seg_namspaces.add(item.metadata.namespace)
-                            break
-            else:
-                segmenterdeps.append(item)
-                seg_namspaces.add(item.metadata.namespace)
-    return segmenterdeps, list(seg_namspaces)
+    groups = get_group_label_values(name, groupids or list(), group_format)
+    result = list_by_groups(clientappsv1.list_deployment_for_all_namespaces, label_selector="type=unit,vendor=quortex",
+                            groups=groups, match=lambda item, ids: item.metadata.name.startswith(f"{name}-") and
+                            get_group_token(name, (item.spec.template.metadata.labels or dict()).get("group", ""), set(ids)) is not None)
+    # Keep deployments starting with good basename. default is "segmenter"
+    segmenterdeps = [ item for item in result if item.metadata.name.startswith(f"{name}-") ]
+    return segmenterdeps, list(set(item.metadata.namespace for item in segmenterdeps))
 
 
-def get_segmenter_unit_services(name, namespace, groupids):
+def get_segmenter_unit_services(name, namespace, groupids, group_format=DEFAULT_GROUP_LABEL_FORMAT):
     clientcorev1 = client.CoreV1Api()
-    result = clientcorev1.list_namespaced_service(namespace, label_selector="type=unit")
-    services = list()
-    map_access = dict()
-    for item in result.items:
-        # Keep services starting with good basename. default is "segmenter"
-        if item.metadata.name.startswith(f"{name}-"):
-            # Filter groups depending groupids filter
-            if groupids:
-                for groupid in groupids:
-                    if "app" in item.metadata.labels:
-                        if groupid in item.metadata.labels["app"]:
-                            prety_group = groupid.replace('-', '')
-                            if prety_group not in map_access:
-                                map_access[prety_group] =  list()
-                            map_access[prety_group].append(len(services))
-                            services.append(item)
-                            break
-            else:
-                services.append(item)
+    groups = get_group_label_values(name, groupids or list(), group_format)
+    # The unit services have no group label, they are listed once and indexed by the group token of their app label.
+    result = list_all(clientcorev1.list_namespaced_service, namespace, label_selector="type=unit")
+    # Keep services starting with good basename. default is "segmenter"
+    services = [ item for item in result if item.metadata.name.startswith(f"{name}-") ]
+    return index_segmenter_groups(name, services, groups, "app")
 
-    return services, map_access
 
-
-def get_segmenter_mongo_services(name, namespace, groupids):
+def get_segmenter_mongo_services(name, namespace, groupids, group_format=DEFAULT_GROUP_LABEL_FORMAT):
     clientcorev1 = client.CoreV1Api()
-    result = clientcorev1.list_namespaced_service(namespace)
-    services = list()
-    map_access = dict()
-    for item in result.items:
-        # Keep services starting with good basename. default is "segmenter" and the label with mongo
-        if item.metadata.name.startswith(f"{name}-") and "mongo" in item.metadata.labels.get("app", ""):
-            # Filter groups depending groupids filter
-            if groupids:
-                for groupid in groupids:
-                    if groupid in item.metadata.labels["app"]:
-                        prety_group = groupid.replace('-', '')
-                        if prety_group not in map_access:
-                            map_access[prety_group] =  list()
-                        map_access[prety_group].append(len(services))
-                        services.append(item)
-                        break
-            else:
-                services.append(item)
-
-    return services, map_access
+    groups = get_group_label_values(name, groupids or list(), group_format)
+    # The group label of the mongo objects is not in the group label format (-mongo suffix), they are listed once.
+    result = list_all(clientcorev1.list_namespaced_service, namespace)
+    # Keep services starting with good basename. default is "segmenter" and the label with mongo
+    services = [ item for item in result if item.metadata.name.startswith(f"{name}-") and
+                 "mongo" in (item.metadata.labels or dict()).get("app", "") ]
+    return index_segmenter_groups(name, services, groups, "app")
 
 
-def get_segmenter_mongo_statefulset(name, namespace, groupids):
+def get_segmenter_mongo_statefulset(name, namespace, groupids, group_format=DEFAULT_GROUP_LABEL_FORMAT):
     clientappsv1 = client.AppsV1Api()
-    result = clientappsv1.list_namespaced_stateful_set(namespace, label_selector=f"type=dbase,vendor=quortex")
-    statefulset = list()
-    map_access = dict()
-    for item in result.items:
-        # Keep services starting with good basename. default is "segmenter"
-        if item.metadata.name.startswith(f"{name}-"):
-            # Filter groups depending groupids filter
-            if groupids:
-                for groupid in groupids:
-                    if "app" in item.metadata.labels:
-                        if groupid in item.metadata.labels["app"]:
-                            prety_group = groupid.replace('-', '')
-                            if prety_group not in map_access:
-                                map_access[prety_group] =  list()
-                            map_access[prety_group].append(len(statefulset))
-                            statefulset.append(item)
-                            break
-            else:
-                statefulset.append(item)
-
-    return statefulset, map_access
-
-def patch_segmenter_service(service, do_update, custom_parameters):
-    clientcorev1 = client.CoreV1Api()
-    patch = {"metadata": {"labels": dict()}}
-    # Basic check of custom parametes: some are mandatory app_name, app_managed.
-    if not custom_parameters:
-        return
-
-    # Add the new labels if some are missing.
-    new_labels = service.metadata.labels
-    label_patch_info = ""
-    if 'app.kubernetes.io/instance' not in new_labels and 'app' in new_labels:
-        new_labels['app.kubernetes.io/instance'] = new_labels['app']
-        label_patch_info = f"app.kube.instance={new_labels['app.kubernetes.io/instance']}"
-    if custom_parameters.get('app_name') and 'app.kubernetes.io/name' not in new_labels:
-        new_labels['app.kubernetes.io/name'] = custom_parameters['app_name']
-        label_patch_info = f"{label_patch_info} app.kube.name={new_labels['app.kubernetes.io/name']}"
-    if custom_parameters.get('app_managed') and 'app.kubernetes.io/managed-by' not in new_labels:
-        new_labels['app.kubernetes.io/managed-by'] = custom_parameters['app_managed']
-        label_patch_info = f"{label_patch_info} app.kube.managed={new_labels['app.kubernetes.io/managed-by']}"
-    if 'vendor' not in new_labels:
-        new_labels['vendor'] = 'quortex'
-        label_patch_info = f"{label_patch_info} vendor={new_labels['vendor']}"
-    if custom_parameters.get('app_type') and 'type' not in new_labels:
-        new_labels['type'] = custom_parameters['app_type']
-        label_patch_info = f"{label_patch_info} type={new_labels['type']}"
-    if custom_parameters.get('set_group', False) and 'group' not in new_labels and 'app' in new_labels:
-        new_labels['group'] = new_labels['app']
-        label_patch_info = f"{label_patch_info} group={new_labels['group']}"
-
-    if label_patch_info and new_labels:
-        # Aply the label update.
-        print(f"{'(DRY_RUN)' if not do_update else ''}SERVICE <{service.metadata.name}>: updating labels with the following")
-        print(f"- labels: {label_patch_info}")
-        if do_update:
-            patch['metadata']['labels'] = new_labels
-            clientcorev1.patch_namespaced_service(service.metadata.name, service.metadata.namespace, patch)
-
-            # Check labels are applied correctly.
-            new_service = clientcorev1.read_namespaced_service(service.metadata.name,  service.metadata.namespace)
-            if new_service.metadata.labels != new_labels:
-                print(f"ERROR: SERVICE {service.metadata.name} on patching label: expected={new_labels} read={new_service.metadata.labels}")
+    groups = get_group_label_values(name, groupids or list(), group_format)
+    result = list_all(clientappsv1.list_namespaced_stateful_set, namespace, label_selector="type=dbase,vendor=quortex")
+    # Keep statefulsets starting with good basename. default is "segmenter"
+    statefulset = [ item for item in result if item.metadata.name.startswith(f"{name}-") ]
+    return index_segmenter_groups(name, statefulset, groups, "app")
+
+def get_label_patch(kind, obj, do_update, rules):
+    # Applied configuration adding the missing labels of the object, None when its labels are up to date.
+    delta, managed = get_label_state(obj, rules)
+    if not delta:
+        print(f"{kind.upper()} {obj.metadata.name}: no update labels")
+        return None
+
+    print(f"{'(DRY_RUN)' if not do_update else ''}{kind.upper()} <{obj.metadata.name}>: updating labels with the following")
+    if kind == "statefulset":
+        print(f"- labels template: {format_label_delta(delta, 'template')}")
+        print(f"- labels metadata: {format_label_delta(delta, 'metadata')}")
     else:
-        print(f"SERVICE {service.metadata.name}: no update labels")
-
-
-def patch_segmenter_stateful_set(statefullset, do_update, custom_parameters):
+        print(f"- labels: {format_label_delta(delta, 'metadata')}")
+    return get_apply_config(kind, obj, managed)
+
+
+def patch_segmenter_object(kind, obj, do_update, rules):
+    label_config = get_label_patch(kind, obj, do_update, rules)
+    if label_config and do_update:
+        # Aply the labels update, the response is the updated object.
+        new_obj = apply_config(client.ApiClient(), kind, obj, label_config)
+
+        # Check labels are applied correctly.
+        missing = get_missing_labels(label_config, new_obj)
+        if missing:
+            print(f"ERROR: {kind.upper()} {obj.metadata.name} on patching label: missing={missing}")
+        elif kind == "statefulset":
+            input("Press <ENTER> after all MONGO deployments are restarted (done after statefulset label update)")
+
+
+###########################################
+### BATCH MODE ############################
+###########################################
+def apply_label_patches(patches, workers):
+    # Apply the patches with at most workers requests at the same time, on the connections pool of one API client.
+    # Return the patched objects, the failed patches are reported.
+    api_client = client.ApiClient()
+    patched = list()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict((executor.submit(apply_config, api_client, kind, obj, patch), (kind, obj))
+                       for kind, obj, patch in patches)
+        for future in concurrent.futures.as_completed(futures):
+            kind, obj = futures[future]
+            try:
+                patched.append((kind, future.result()))
+            except client.rest.ApiException as e:
+                print(f"ERROR: {kind.upper()} {obj.metadata.name} on patching label: {e.status} {e.reason}")
+    return patched
+
+
+def get_missing_labels(patch, obj):
+    # Labels of the patch not found on the object: {"metadata"|"template": {key: expected value}}.
+    missing = dict()
+    labels = patch.get("metadata", dict()).get("labels", dict())
+    current = obj.metadata.labels or dict()
+    if any(current.get(key) != val for key, val in labels.items()):
+        missing["metadata"] = dict((key, val) for key, val in labels.items() if current.get(key) != val)
+    labels = patch.get("spec", dict()).get("template", dict()).get("metadata", dict()).get("labels", dict())
+    if labels:
+        current = obj.spec.template.metadata.labels or dict()
+        if any(current.get(key) != val for key, val in labels.items()):
+            missing["template"] = dict((key, val) for key, val in labels.items() if current.get(key) != val)
+    return missing
+
+
+def verify_label_patches(patches):
+    # Check the labels with one LIST per kind and namespace instead of a read per object.
+    clientcorev1 = client.CoreV1Api()
     clientappsv1 = client.AppsV1Api()
-    # Basic check of custom parametes: some are mandatory app_name, app_managed.
-    if not custom_parameters:
-        return
-
-    # Spec.template labels update new labels if needed.
-    spec_new_labels = statefullset.spec.template.metadata.labels
-    spec_label_patch_info = ""
-    if 'app.kubernetes.io/instance' not in spec_new_labels and 'app' in spec_new_labels:
-        spec_new_labels['app.kubernetes.io/instance'] = spec_new_labels['app']
-        spec_label_patch_info = f"app.kube.instance={spec_new_labels['app.kubernetes.io/instance']}"
-    if custom_parameters.get('app_name') and 'app.kubernetes.io/name' not in spec_new_labels:
-        spec_new_labels['app.kubernetes.io/name'] = custom_parameters['app_name']
-        spec_label_patch_info = f"{spec_label_patch_info} app.kube.name={spec_new_labels['app.kubernetes.io/name']}"
-    if custom_parameters.get('app_type') and 'type' not in spec_new_labels:
-        spec_new_labels['type'] = custom_parameters['app_type']
-        spec_label_patch_info = f"{spec_label_patch_info} type={spec_new_labels['type']}"
-    if 'vendor' not in spec_new_labels:
-        spec_new_labels['vendor'] = 'quortex'
-        spec_label_patch_info = f"{spec_label_patch_info} vendor={spec_new_labels['vendor']}"
-
-    # metadata labels update new labels if needed.
-    metadata_new_labels = statefullset.metadata.labels
-    metadata_label_patch_info = ""
-    if 'app.kubernetes.io/instance' not in metadata_new_labels and 'app' in metadata_new_labels:
-        metadata_new_labels['app.kubernetes.io/instance'] = metadata_new_labels['app']
-        metadata_label_patch_info = f"app.kube.instance={metadata_new_labels['app.kubernetes.io/instance']}"
-    if custom_parameters.get('app_name') and 'app.kubernetes.io/name' not in metadata_new_labels:
-        metadata_new_labels['app.kubernetes.io/name'] = custom_parameters['app_name']
-        metadata_label_patch_info = f"{metadata_label_patch_info} app.kube.name={metadata_new_labels['app.kubernetes.io/name']}"
-    if custom_parameters.get('app_managed') and 'app.kubernetes.io/managed-by' not in metadata_new_labels:
-        metadata_new_labels['app.kubernetes.io/managed-by'] = custom_parameters['app_managed']
-        metadata_label_patch_info = f"{metadata_label_patch_info} app.kube.managed={metadata_new_labels['app.kubernetes.io/managed-by']}"
-    if 'group' not in metadata_new_labels and 'app' in metadata_new_labels:
-        metadata_new_labels['group'] = metadata_new_labels['app']
-        metadata_label_patch_info = f"{metadata_label_patch_info} group={metadata_new_labels['group']}"
-
-    if spec_label_patch_info and spec_new_labels or metadata_label_patch_info and metadata_new_labels:
-        # Aply the labels update.
-        print(f"{'(DRY_RUN)' if not do_update else ''}STATEFULSET <{statefullset.metadata.name}>: updating labels with the following")
-        print(f"- labels template: {spec_label_patch_info}")
-        print(f"- labels metadata: {metadata_label_patch_info}")
-        if do_update:
-            # Prepare the patch operation info and send the request.
-            patch = dict()
-            if spec_new_labels:
-                spec_patch = {"spec": {"template": {"metadata": {"labels": spec_new_labels}}}}
-                patch.update(spec_patch)
-            if metadata_new_labels:
-                metadata_patch = {"metadata": {"labels": metadata_new_labels}}
-                patch.update(metadata_patch)
-            clientappsv1.patch_namespaced_stateful_set(statefullset.metadata.name, statefullset.metadata.namespace, patch)
-
-            # Check labels are applied correctly.
-            new_statefulset = clientappsv1.read_namespaced_stateful_set(statefullset.metadata.name,  statefullset.metadata.namespace)
-            if new_statefulset.spec.template.metadata.labels == spec_new_labels or new_statefulset.metadata.labels == metadata_new_labels:
-                input("Press <ENTER> after all MONGO deployments are restarted (done after statefulset label update)")
+    listed = dict()
+    errors = 0
+    for kind, obj, patch in patches:
+        key = (kind, obj.metadata.namespace)
+        if key not in listed:
+            list_func = clientcorev1.list_namespaced_service if kind == "service" else clientappsv1.list_namespaced_stateful_set
+            listed[key] = dict((item.metadata.name, item) for item in list_all(list_func, obj.metadata.namespace))
+        current = listed[key].get(obj.metadata.name)
+        missing = get_missing_labels(patch, current) if current is not None else {"object": "not found"}
+        if missing:
+            errors += 1
+            print(f"ERROR: {kind.upper()} {obj.metadata.name} on patching label: missing={missing}")
+    return errors
+
+
+def get_common_set_selector(match_labels_list):
+    # Selector of the pods of all the selectors: set-based on the keys shared by all of them.
+    keys = set.intersection(*(set(match_labels) for match_labels in match_labels_list))
+    terms = list()
+    for key in sorted(keys):
+        values = sorted(set(match_labels[key] for match_labels in match_labels_list))
+        terms.append(f"{key}={values[0]}" if len(values) == 1 else f"{key} in ({','.join(values)})")
+    return ",".join(terms)
+
+
+def is_stateful_set_rolled(statefulset, pods):
+    # All the pods of the statefulset run its pods template labels and are ready.
+    match_labels = statefulset.spec.selector.match_labels or dict()
+    template_labels = statefulset.spec.template.metadata.labels or dict()
+    selected = [pod for pod in pods.values()
+                if all((pod.metadata.labels or dict()).get(key) == val for key, val in match_labels.items())]
+    if len(selected) != (statefulset.spec.replicas or 0):
+        return False
+    for pod in selected:
+        if pod.metadata.deletion_timestamp is not None:
+            return False
+        if any((pod.metadata.labels or dict()).get(key) != val for key, val in template_labels.items()):
+            return False
+        if not pod.status.container_statuses or not all(status.ready for status in pod.status.container_statuses):
+            return False
+    return True
+
+
+def wait_stateful_sets_rollout(statefulsets, timeout):
+    # Wait for the pods of the statefulsets to be restarted with the new labels, one pod list and watch per
+    # namespace. Return the statefulsets not rolled out before the timeout.
+    api_client = client.CoreV1Api().api_client
+    deadline = time.monotonic() + timeout
+    namespaces = dict()
+    for statefulset in statefulsets:
+        namespaces.setdefault(statefulset.metadata.namespace, list()).append(statefulset)
+
+    pending = list()
+    for namespace, items in namespaces.items():
+        selector = get_common_set_selector([statefulset.spec.selector.match_labels or dict() for statefulset in items])
+        path, path_params = get_raw_path("pods", namespace)
+        pods = dict()
+
+        def on_list(listed):
+            pods.clear()
+            pods.update((pod.metadata.name, pod) for pod in listed)
+            report()
+
+        def on_event(event_type, pod):
+            if event_type == "DELETED":
+                pods.pop(pod.metadata.name, None)
             else:
-                print(f"ERROR: STATEFULSET {statefullset.metadata.name} on patching label:")
-                print(f"-templace expected={spec_new_labels} read={new_statefulset.spec.template.metadata.labels }")
-                print(f"-metadata expected={metadata_new_labels} read={new_statefulset.metadata.labels}")
-    else:
-        print(f"STATEFULSET {statefullset.metadata.name}: no update labels")
+                pods[pod.metadata.name] = pod
+
+        def get_waiting():
+            return [statefulset for statefulset in items if not is_stateful_set_rolled(statefulset, pods)]
+
+        def report():
+            waiting = get_waiting()
+            if waiting:
+                print(f"Waiting for the restart of {len(waiting)} statefulsets in namespace {namespace}")
+
+        list_then_watch(api_client, path, get_model_record(api_client, "V1Pod"), on_list, on_event,
+                        lambda: not get_waiting() or time.monotonic() >= deadline, path_params=path_params,
+                        label_selector=selector,
+                        timeout_seconds=lambda: max(1, int(min(ROLLOUT_WATCH_TIMEOUT, deadline - time.monotonic()))),
+                        on_watch_end=report)
+        pending.extend(get_waiting())
+    return pending
+
+
+def process_label_patches(patches, workers, rollout_timeout):
+    # Batch mode: the label configurations computed up front are applied concurrently, verified at once, then the restart of
+    # the mongo pods (statefulset pods template labels) is awaited.
+    print(f"\n=> Applying {len(patches)} label patches ({workers} workers)")
+    patched = apply_label_patches(patches, workers)
+    print(f"{len(patched)} objects patched.")
+
+    print("=> Checking labels")
+    errors = verify_label_patches(patches)
+    if not errors:
+        print("All labels applied.")
+
+    statefulsets = [obj for kind, obj in patched if kind == "statefulset"]
+    if statefulsets:
+        print(f"=> Waiting for the MONGO pods restart of {len(statefulsets)} statefulsets")
+        pending = wait_stateful_sets_rollout(statefulsets, rollout_timeout)
+        for statefulset in pending:
+            print(f"ERROR: STATEFULSET {statefulset.metadata.name}: pods not restarted after {rollout_timeout} seconds")
+        errors += len(pending)
+        if not pending:
+            print("All MONGO pods restarted.")
+    return errors + len(patches) - len(patched)
 
 
 def process_new_labels_update(user_args):
@@ -226,64 +286,70 @@ def process_new_labels_update(user_args):
     groupids = user_args.group
     namespace_select = user_args.namespace
     do_update = user_args.update
+    group_format = user_args.group_label_format
+    batch = user_args.batch
 
     print(f"=>{'(!!! DRY_RUN !!!)' if not do_update else ''} Updating segmenter labels for groups: {','.join(groupids)} (namespace={namespace_select})")
-    # Setup unique group id name.
-    unique_groupids = get_uniq_group_ids(groupids)
-
     # Get the Segmenter service unit.
     print("=> Parsing service segmenter UNIT")
-    segmenter_services, seg_service_groups = get_segmenter_unit_services(name, namespace_select, unique_groupids)
+    seg_service_groups = get_segmenter_unit_services(name, namespace_select, groupids, group_format)
     if seg_service_groups:
-        print(f"Found {len(segmenter_services)} services.")
+        print(f"Found {sum(len(items) for items in seg_service_groups.values())} services.")
     else:
         print("No Service found, exit")
         sys.exit(-1)
 
     # Get the Segmenter service mongo.
     print("=> Parsing service segmenter MONGO")
-    mongo_services, mongo_service_groups = get_segmenter_mongo_services(name, namespace_select, unique_groupids)
+    mongo_service_groups = get_segmenter_mongo_services(name, namespace_select, groupids, group_format)
     if mongo_service_groups:
-        print(f"Found {len(mongo_services)} services.")
+        print(f"Found {sum(len(items) for items in mongo_service_groups.values())} services.")
     else:
         print("No Service found, exit")
         sys.exit(-1)
 
     # Get the Segmenter statefulset mongo.
     print("=> Parsing statefulset segmenter MONGO")
-    mongo_statefulset, mongo_statefulset_groups = get_segmenter_mongo_statefulset(name, namespace_select, unique_groupids)
+    mongo_statefulset_groups = get_segmenter_mongo_statefulset(name, namespace_select, groupids, group_format)
     if mongo_statefulset_groups:
-        print(f"Found {len(mongo_statefulset)} statefulset.")
+        print(f"Found {sum(len(items) for items in mongo_statefulset_groups.values())} statefulset.")
     else:
         print("No Statefulset found, exit")
         sys.exit(-1)
 
     # Loop all groups to patch/update the service labels.
+    patches = list()
     for group_name in groupids:
         print(f"\n=> Updating labels for group: {group_name}")
+        objects = list()
         # Servive UNIT label patching
-        parameters = {'app_name': 'segmenter-unit', 'app_managed': 'segmenter-daemon'}
-        for srv_idx in seg_service_groups.get(group_name, list()):
-            patch_segmenter_service(segmenter_services[srv_idx], do_update, parameters)
+        for service in seg_service_groups.get(group_name, list()):
+            objects.append(("service", service, UNIT_SERVICE_RULES))
 
         # Servive MONGO label patching
         if len(mongo_service_groups.get(group_name, list())) == 1:
-            parameters = {'app_name': 'segmenter-mongo', 'app_managed': 'segmenter-daemon',
-                          'app_type': 'dbase', 'set_group': True}
-            srv_idx = mongo_service_groups[group_name][0]
-            patch_segmenter_service(mongo_services[srv_idx], do_update, parameters)
+            objects.append(("service", mongo_service_groups[group_name][0], MONGO_SERVICE_RULES))
         else:
             print(f"WARNING: bypassing MONGO service patch (nb_services={len(mongo_service_groups.get(group_name, list()))})")
 
         # Statefulset MONGO label patching
         if len(mongo_statefulset_groups.get(group_name, list())) == 1:
-            parameters = {'app_name': 'ssegmenter-mongo', 'app_managed': 'segmenter-daemon',
-                          'app_type': 'dbase'}
-            sts_idx = mongo_statefulset_groups[group_name][0]
-            patch_segmenter_stateful_set(mongo_statefulset[sts_idx], do_update, parameters)
+            objects.append(("statefulset", mongo_statefulset_groups[group_name][0], MONGO_STATEFULSET_RULES))
         else:
             print(f"WARNING: bypassing MONGO statefulset patch (nb_services={len(mongo_statefulset_groups.get(group_name, list()))})")
 
+        for kind, obj, rules in objects:
+            if batch:
+                patches.append((kind, obj, get_label_patch(kind, obj, do_update, rules)))
+            else:
+                patch_segmenter_object(kind, obj, do_update, rules)
+
+    # Batch mode: apply all the patches computed.
+    patches = [ (kind, obj, patch) for kind, obj, patch in patches if patch ]
+    if batch and do_update and patches:
+        if process_label_patches(patches, user_args.workers, user_args.rollout_timeout):
+            sys.exit(-1)
+
 
 if __name__ == '__main__':
     # Parse argument
@@ -292,7 +358,11 @@ if __name__ == '__main__':
     required.add_argument("-g", "--group",          default=None,                           help="Specify the list of group to update",     nargs='+')
     required.add_argument("-n", "--name",           default="segmenter",                    help="Specify the basename of the segmenters")
     required.add_argument("-s", "--namespace",      default="reference",                    help="Specify the namespace og th segmenters")
+    required.add_argument("--group-label-format",   default=DEFAULT_GROUP_LABEL_FORMAT,     help=f"Format of the group label value selected server side, legacy labels are filtered client side (default is {DEFAULT_GROUP_LABEL_FORMAT})")
     required.add_argument("-u", "--update",         default=False,                          help="Do the update labels operation",          action='store_true')
+    required.add_argument("-b", "--batch",          default=False,                          help="Compute all the label patches first, then apply them concurrently and wait for the MONGO pods restart (no prompt)", action='store_true')
+    required.add_argument("-w", "--workers",        default=DEFAULT_WORKERS,                help=f"Number of label patches sent at the same time in batch mode (default is {DEFAULT_WORKERS})", type=int)
+    required.add_argument("--rollout-timeout",      default=DEFAULT_ROLLOUT_TIMEOUT,        help=f"Timeout in seconds of the wait for the MONGO pods restart in batch mode (default is {DEFAULT_ROLLOUT_TIMEOUT})", type=int)
 
     # Get arguments
     args = parser.parse_args()
@@ -1,19 +1,44 @@
 #!/usr/bin/env python3
 import argparse
-import ast
 import asyncio
+import concurrent.futures
 import curses
 import json
 import os
+import signal
 import sys
 import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
 from copy import deepcopy
+from functools import partial
 
 from kubernetes import client, config
 
+from kube_utils import (DEFAULT_GROUP_LABEL_FORMAT, DeploymentRecord, PodRecord, get_group_label_values, get_model_record,
+                        get_raw_path, list_by_groups, list_deployments_raw, list_pods_raw, list_then_watch)
+from segmenter_labels import apply_config, format_label_delta, get_apply_config, get_deployment_rules, get_label_state
+
+# Optional dependency, only required by the metrics endpoint.
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
 # Default name service of the segmenter Ainode.
 DEFAULT_SVC_SEGMENTER_AINODE = "segmenter-ainode"
 
+# Label selector of the segmenter unit deployments.
+UNIT_LABEL_SELECTOR = "type=unit,vendor=quortex"
+
+# Period in seconds of the health probe of the canary units.
+CANARY_PROBE_PERIOD = 10
+
+# Server side timeout of a watch request, the watch is restarted from the last resource version after it.
+WATCH_TIMEOUT_SECONDS = 30
+
 ###########################################
 ### LOGGER WRAPPER API ####################
 ###########################################
@@ -51,6 +76,9 @@ LOGGER = LoggerWrapper()
 active = True
 status = None
 
+# Stream of the information messages, stderr when the status is exported on stdout.
+INFO_STREAM = sys.stdout
+
 # To customize for column size
 GROUPID_COLUMN_SIZE     = 0.075
 ID_COLUMN_SIZE          = 0.075
@@ -73,42 +101,465 @@ STATUS_COLUMN_START     = 0
 
 BASELINE_OFFSET         = 0
 
+# Set on terminal resize (SIGWINCH), the column layout is only computed again after it.
+RESIZED                 = True
+
+
+###########################################
+### KUBERNETES CALLS ######################
+###########################################
+# Default number of blocking kubernetes client calls running at the same time.
+DEFAULT_API_CONCURRENCY = 8
+
+# Executors running the blocking kubernetes client calls out of the event loop: short requests and long pod waits
+# (watch) use their own pool so that waiting upgrades never starve the other requests. The wait pool is sized by the
+# number of upgrades running at the same time (init_wait_executor), not by the API concurrency: a unit scaled down
+# must not queue for a wait slot.
+KUBE_EXECUTOR = None
+WAIT_EXECUTOR = None
+
+def init_kube_executors(api_concurrency=DEFAULT_API_CONCURRENCY):
+    global KUBE_EXECUTOR
+
+    KUBE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=api_concurrency, thread_name_prefix="kube")
+    init_wait_executor(1)
+
+def init_wait_executor(waits):
+    global WAIT_EXECUTOR
+
+    if WAIT_EXECUTOR is not None:
+        WAIT_EXECUTOR.shutdown(wait=False)
+    WAIT_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, waits), thread_name_prefix="kube-wait")
+
+async def kube_call(func, *args, **kwargs):
+    # Run a blocking kubernetes call in the bounded executor and wait its result without blocking the event loop.
+    if KUBE_EXECUTOR is None:
+        init_kube_executors()
+    return await asyncio.get_event_loop().run_in_executor(KUBE_EXECUTOR, partial(func, *args, **kwargs))
+
+def kube_request(func, *args, **kwargs):
+    # Blocking kubernetes call from a wait thread, run in the executor of kube_call so that it counts in the API
+    # concurrency. The watches themselves are long waits, they are not sent through it.
+    return KUBE_EXECUTOR.submit(func, *args, **kwargs).result()
+
+async def kube_wait(func, *args, **kwargs):
+    # Same as kube_call for the long running waits.
+    if WAIT_EXECUTOR is None:
+        init_kube_executors()
+    return await asyncio.get_event_loop().run_in_executor(WAIT_EXECUTOR, partial(func, *args, **kwargs))
+
+
+###########################################
+### METRICS ###############################
+###########################################
+# Buckets of the upgrade phases durations (seconds).
+PHASE_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 1200, 1800)
+
+class Metrics:
+    # Prometheus metrics of the upgrade progress and of the kubernetes API calls, served on /metrics.
+    def __init__(self, port, address="127.0.0.1"):
+        self.api_calls = prometheus_client.Counter("segmenter_tool_kube_api_calls_total", "Kubernetes API calls", ["call"])
+        self.api_errors = prometheus_client.Counter("segmenter_tool_kube_api_errors_total", "Kubernetes API calls in error", ["call"])
+        self.api_latency = prometheus_client.Histogram("segmenter_tool_kube_api_call_duration_seconds", "Kubernetes API calls latency", ["call"])
+        self.phase_duration = prometheus_client.Histogram("segmenter_upgrade_phase_duration_seconds", "Duration of the upgrade phases",
+                                                          ["group", "phase"], buckets=PHASE_BUCKETS)
+        self.unit_phase_duration = prometheus_client.Gauge("segmenter_upgrade_unit_phase_duration_seconds", "Duration of the upgrade phases per unit",
+                                                           ["group", "deployment", "phase"])
+        self.unit_phase_started = prometheus_client.Gauge("segmenter_upgrade_unit_phase_started_timestamp_seconds", "Start time of the ongoing upgrade phases per unit",
+                                                          ["group", "deployment", "phase"])
+        self.unit_duration = prometheus_client.Histogram("segmenter_upgrade_unit_duration_seconds", "Duration of the unit upgrades",
+                                                         ["group"], buckets=PHASE_BUCKETS)
+        self.units = prometheus_client.Gauge("segmenter_upgrade_units", "Units to upgrade per version (old or new)", ["version"])
+        prometheus_client.start_http_server(port, addr=address)
+
+# Metrics of the process, None when the metrics endpoint is not enabled.
+METRICS = None
+
+def init_metrics(port, address="127.0.0.1"):
+    global METRICS
+
+    if prometheus_client is None:
+        raise RuntimeError("The prometheus_client package is required by the metrics endpoint (pip3 install prometheus_client)")
+    METRICS = Metrics(port, address)
+    # Every request sent by the kubernetes clients (and the ainode requests through the service proxy) is observed.
+    client.ApiClient.call_api = observed_call_api(client.ApiClient.call_api)
+
+def get_api_call_name(resource_path, method, query_params):
+    # Observed call of a request: verb and resource of its path.
+    # ex: /apis/apps/v1/namespaces/{namespace}/deployments/{name} => PATCH deployments
+    #     /api/v1/namespaces/{namespace}/services/{name}/proxy/{path} => PUT services/proxy
+    segments = resource_path.strip("/").split("/")
+    segments = segments[2:] if segments[0] == "api" else segments[3:]
+    if segments[:2] == ["namespaces", "{namespace}"]:
+        segments = segments[2:]
+    resource = "/".join(segment for segment in segments if not segment.startswith("{"))
+    # The watch parameter is True for the client watches and "true" for the raw ones.
+    if dict(query_params or list()).get("watch") in (True, "true"):
+        method = "WATCH"
+    return f"{method} {resource}"
+
+def observed_call_api(call_api):
+    def observed(self, resource_path, method, path_params=None, query_params=None, *args, **kwargs):
+        with observe_api_call(get_api_call_name(resource_path, method, query_params)):
+            return call_api(self, resource_path, method, path_params, query_params, *args, **kwargs)
+    return observed
+
+@contextmanager
+def observe_api_call(call):
+    if METRICS is None:
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    except Exception:
+        METRICS.api_errors.labels(call).inc()
+        raise
+    finally:
+        METRICS.api_calls.labels(call).inc()
+        METRICS.api_latency.labels(call).observe(time.monotonic() - start)
+
+@contextmanager
+def upgrade_phase(deployment, phase):
+    # Measure an upgrade phase for the metrics and the phases history (successful phases only).
+    if METRICS is None and STATS is None:
+        yield
+        return
+    group = get_group(deployment)
+    name = deployment.metadata.name
+    start = time.monotonic()
+    if METRICS is not None:
+        METRICS.unit_phase_started.labels(group, name, phase).set(time.time())
+    try:
+        yield
+        if STATS is not None:
+            STATS.add(phase, time.monotonic() - start)
+    finally:
+        duration = time.monotonic() - start
+        if METRICS is not None:
+            METRICS.unit_phase_started.remove(group, name, phase)
+            METRICS.unit_phase_duration.labels(group, name, phase).set(duration)
+            METRICS.phase_duration.labels(group, phase).observe(duration)
+
+def set_units_versions(deployments, newversion):
+    if METRICS is None:
+        return
+    new = len([dep for dep in deployments if extract_name(dep.spec.template.spec.containers[0].image)[1] == newversion])
+    METRICS.units.labels("new").set(new)
+    METRICS.units.labels("old").set(len(deployments) - new)
+
+def count_upgraded_unit(deployment, duration):
+    if METRICS is None:
+        return
+    METRICS.units.labels("old").dec()
+    METRICS.units.labels("new").inc()
+    METRICS.unit_duration.labels(get_group(deployment)).observe(duration)
+
+
+###########################################
+### AINODE CLIENT #########################
+###########################################
+# Cached upstreamgroups younger than this (in seconds) are returned without any request.
+AINODE_CACHE_MAX_AGE = 1.0
+
+# Number of attempts of an upstreamgroup edition rejected because of a concurrent modification.
+AINODE_EDIT_RETRIES = 5
+
+class AinodeClient:
+    # Client of the ainode upstreamgroup API through the kubernetes service proxy. The ainode service is discovered
+    # once, all the requests share the same api client (connection pool) and the upstreamgroups are cached: the cache
+    # is revalidated with the ETag of the last response and updated with the confs sent.
+    def __init__(self, seg_ainode_name=DEFAULT_SVC_SEGMENTER_AINODE, max_age=AINODE_CACHE_MAX_AGE):
+        self.seg_ainode_name = seg_ainode_name
+        self.max_age = max_age
+        self.clientcorev1 = client.CoreV1Api()
+        self.lock = threading.Lock()
+        self.service = None
+        self.upstreamgroups = None
+        self.etag = None
+        self.fetched = 0
+        self.edit_locks = dict()
+
+    def discover(self):
+        if self.service is None:
+            services = self.clientcorev1.list_service_for_all_namespaces(label_selector=f"app.kubernetes.io/name={self.seg_ainode_name},app.quortex.io/type=ainode")
+            if len(services.items):
+                self.service = services.items[0]
+        return self.service
+
+    def request(self, method, path, body=None, headers=None):
+        # Raw request through the service proxy, the response is not deserialized by the kubernetes client.
+        service = self.discover()
+        if service is None:
+            return None
+        path_params = {"name": f"{service.metadata.name}:api",
+                       "namespace": service.metadata.namespace,
+                       "path": path}
+        header_params = {"Accept": "application/json", "Content-Type": "application/json"}
+        header_params.update(headers or dict())
+        return self.clientcorev1.api_client.call_api('/api/v1/namespaces/{namespace}/services/{name}/proxy/{path}', method,
+                                                     path_params,
+                                                     [],
+                                                     header_params,
+                                                     body=body,
+                                                     post_params=[],
+                                                     files={},
+                                                     response_type=None,
+                                                     auth_settings=["BearerToken"],
+                                                     async_req=False,
+                                                     _return_http_data_only=True,
+                                                     _preload_content=False,
+                                                     _request_timeout=None,
+                                                     collection_formats={})
+
+    def get_upstreamgroups(self, refresh=False):
+        # Return the cached upstreamgroups, revalidated when older than max_age or when refresh is requested.
+        with self.lock:
+            if not refresh and self.upstreamgroups is not None and time.monotonic() - self.fetched < self.max_age:
+                return list(self.upstreamgroups)
+            headers = {"If-None-Match": self.etag} if self.etag and self.upstreamgroups is not None else None
+            try:
+                response = self.request("GET", "1.0/upstreamgroup", headers=headers)
+            except client.rest.ApiException as e:
+                if e.status != 304:
+                    raise
+                response = None
+            else:
+                if response is None:
+                    self.upstreamgroups = list()
+                else:
+                    self.upstreamgroups = json.loads(response.data)
+                    self.etag = response.headers.get("ETag")
+            self.fetched = time.monotonic()
+            return list(self.upstreamgroups)
+
+    def put(self, conf, etag=None):
+        # With the etag of the conf read, the PUT is rejected if the upstreamgroup was modified since.
+        headers = {"If-Match": etag} if etag else None
+        response = self.request("PUT", f"1.0/upstreamgroup/{conf['uuid']}", body=conf, headers=headers)
+        if response is not None:
+            # The body of the raw response is not read, give the connection back to the pool.
+            response.release_conn()
+        with self.lock:
+            # The cache is updated with the new conf (copy on write, returned lists are not modified).
+            if self.upstreamgroups is not None:
+                self.upstreamgroups = [conf if cur['uuid'] == conf['uuid'] else cur for cur in self.upstreamgroups]
+            self.etag = None
+        return response
+
+    def edit(self, uuid, edit_func):
+        # Optimistic concurrency edition of an upstreamgroup: read the current conf, apply edit_func on it (None
+        # when there is nothing to change) and put it conditionally, again from the read on conflict.
+        # The editions of the same upstreamgroup by this process are serialized.
+        with self.lock:
+            edit_lock = self.edit_locks.setdefault(uuid, threading.Lock())
+        with edit_lock:
+            for attempt in range(AINODE_EDIT_RETRIES):
+                response = self.request("GET", f"1.0/upstreamgroup/{uuid}")
+                conf = edit_func(json.loads(response.data))
+                if conf is None:
+                    return None
+                etag = response.headers.get("ETag")
+                if not etag:
+                    LOGGER.warning(f"Upstreamgroup {uuid} read without ETag, updated without If-Match: only the editions of this process are serialized")
+                try:
+                    self.put(conf, etag)
+                    return conf
+                except client.rest.ApiException as e:
+                    if e.status not in (409, 412):
+                        raise
+                    LOGGER.warning(f"Upstreamgroup {uuid} modified concurrently, retrying ({attempt + 1}/{AINODE_EDIT_RETRIES})")
+                    time.sleep(0.1 * (attempt + 1))
+            raise RuntimeError(f"Upstreamgroup {uuid} edition failed after {AINODE_EDIT_RETRIES} concurrent modifications")
+
+    def drain_service(self, svcname, uuids, on_drained=None):
+        # Remove the upstreams of the service from the upstreamgroups which keep other upstreams.
+        # Return the removed upstreams per upstreamgroup uuid: [[position, upstream], ...].
+        return self.drain_services({svcname: uuids}, on_drained).get(svcname, dict())
+
+    def drain_services(self, services, on_drained=None):
+        # Drain of several services (service name => upstreamgroup uuids) with one edition per upstreamgroup: the
+        # upstreams of the services are removed in order while the upstreamgroup keeps other upstreams.
+        # on_drained(svcname, uuid, upstreams) is called once the upstreamgroup is put, before the next edition.
+        # Return the removed upstreams per service name and upstreamgroup uuid.
+        svcnames = dict()
+        for svcname, uuids in services.items():
+            for uuid in uuids:
+                svcnames.setdefault(uuid, list()).append(svcname)
+
+        removed = dict()
+        for uuid, names in svcnames.items():
+            drained = dict()
+            def remove(conf):
+                # The positions are the ones of the read conf, where restore_upstreams puts the upstreams back.
+                drained.clear()
+                kept = conf["upstream"]
+                for svcname in names:
+                    upstreams = [[pos, upstream] for pos, upstream in enumerate(conf["upstream"])
+                                 if get_upstream_service(upstream["address"]) == svcname]
+                    others = [upstream for upstream in kept if get_upstream_service(upstream["address"]) != svcname]
+                    if not upstreams or not others:
+                        continue
+                    kept = others
+                    drained[svcname] = upstreams
+                if not drained:
+                    return None
+                conf["upstream"] = kept
+                return conf
+            self.edit(uuid, remove)
+            for svcname, upstreams in drained.items():
+                removed.setdefault(svcname, dict())[uuid] = upstreams
+                if on_drained is not None:
+                    on_drained(svcname, uuid, upstreams)
+        return removed
+
+    def restore_upstreams(self, removed):
+        # Put back the upstreams removed by drain_service at their initial position, if not already there.
+        for uuid, upstreams in removed.items():
+            def restore(conf):
+                addresses = set(upstream["address"] for upstream in conf["upstream"])
+                missing = [[pos, upstream] for pos, upstream in upstreams if upstream["address"] not in addresses]
+                if not missing:
+                    return None
+                for pos, upstream in sorted(missing, key=lambda item: item[0]):
+                    conf["upstream"].insert(min(pos, len(conf["upstream"])), upstream)
+                return conf
+            self.edit(uuid, restore)
+
+class DrainBatch:
+    # Drains of the units starting a wave together (requested in the same event loop iteration) coalesced into one
+    # drain_services call, so one conditional PUT per upstreamgroup for the whole wave.
+    def __init__(self, ainode_client):
+        self.ainode_client = ainode_client
+        self.pending = dict()
+
+    async def drain(self, svcname, uuids, on_drained=None):
+        future = asyncio.get_event_loop().create_future()
+        if not self.pending:
+            asyncio.get_event_loop().call_soon(lambda: asyncio.ensure_future(self.flush()))
+        self.pending[svcname] = (uuids, on_drained, future)
+        return await future
+
+    async def flush(self):
+        pending = self.pending
+        self.pending = dict()
+
+        def on_drained(svcname, uuid, upstreams):
+            callback = pending[svcname][1]
+            if callback is not None:
+                callback(svcname, uuid, upstreams)
+
+        try:
+            removed = await kube_call(self.ainode_client.drain_services,
+                                      dict((svcname, uuids) for svcname, (uuids, _callback, _future) in pending.items()),
+                                      on_drained)
+        except Exception as e:
+            for _uuids, _callback, future in pending.values():
+                future.set_exception(e)
+            return
+        for svcname, (_uuids, _callback, future) in pending.items():
+            future.set_result(removed.get(svcname, dict()))
+
+def get_upstream_service(address):
+    # Service name of an upstream address: first label of its host.
+    # ex: http://segmenter-tf1-pri-service.reference:8080/live => segmenter-tf1-pri-service
+    host = address.split("://", 1)[-1].split("/", 1)[0]
+    return host.split(":", 1)[0].split(".", 1)[0]
+
+def get_service_name(depname):
+    return depname.split("deployment")[0]+"service"
+
+class UpstreamIndex:
+    # Reverse index of the upstreamgroups: service name => {upstreamgroup uuid: [positions of its upstreams]}.
+    # Built once per configuration snapshot and updated per upstreamgroup.
+    def __init__(self, upstreamgroups=None):
+        self.confs = dict()
+        self.services = dict()
+        for conf in upstreamgroups or list():
+            self.update_conf(conf)
+
+    def update_conf(self, conf):
+        # Return the services whose references changed.
+        changed = self.remove_conf(conf['uuid'])
+        self.confs[conf['uuid']] = conf
+        for position, upstream in enumerate(conf["upstream"]):
+            svcname = get_upstream_service(upstream["address"])
+            self.services.setdefault(svcname, dict()).setdefault(conf['uuid'], list()).append(position)
+            changed.add(svcname)
+        return changed
+
+    def remove_conf(self, uuid):
+        changed = set()
+        conf = self.confs.pop(uuid, None)
+        if conf is None:
+            return changed
+        for upstream in conf["upstream"]:
+            svcname = get_upstream_service(upstream["address"])
+            refs = self.services.get(svcname, dict())
+            refs.pop(uuid, None)
+            if not refs:
+                self.services.pop(svcname, None)
+            changed.add(svcname)
+        return changed
+
+    def sync(self, upstreamgroups):
+        # Update the index with a new snapshot, only the modified upstreamgroups are reindexed.
+        # Return the services whose references changed.
+        changed = set()
+        uuids = set()
+        for conf in upstreamgroups:
+            uuids.add(conf['uuid'])
+            if self.confs.get(conf['uuid']) != conf:
+                changed |= self.update_conf(conf)
+        for uuid in set(self.confs.keys()) - uuids:
+            changed |= self.remove_conf(uuid)
+        return changed
+
+    def is_used(self, svcname):
+        return svcname in self.services
+
+    def get_refs(self, svcname):
+        return self.services.get(svcname, dict())
+
+# One client per ainode service name.
+AINODE_CLIENTS = dict()
+
+def get_ainode_client(seg_ainode_name=DEFAULT_SVC_SEGMENTER_AINODE):
+    if seg_ainode_name not in AINODE_CLIENTS:
+        AINODE_CLIENTS[seg_ainode_name] = AinodeClient(seg_ainode_name)
+    return AINODE_CLIENTS[seg_ainode_name]
+
 
 ###########################################
 ### COMMON FUNCTIONS ######################
 ###########################################
 def get_ainode_all_conf(seg_ainode_name=DEFAULT_SVC_SEGMENTER_AINODE):
-    clientcorev1 = client.CoreV1Api()
-    services = clientcorev1.list_service_for_all_namespaces(label_selector=f"app.kubernetes.io/name={seg_ainode_name},app.quortex.io/type=ainode")
-    upstreamgroups = list()
-    if len(services.items):
-        service = services.items[0]
-        upstreamgroups = ast.literal_eval(clientcorev1.connect_get_namespaced_service_proxy_with_path(f"{service.metadata.name}:api",service.metadata.namespace,"1.0/upstreamgroup"))
-    return upstreamgroups
-
-def get_segmenter_deployments(name, groupids=None):
+    return get_ainode_client(seg_ainode_name).get_upstreamgroups()
+
+def match_segmenter_deployment(name, deployment, groupids):
+    # Legacy client side filter: name prefix and group ID in the group label of the pod template.
     # Specific correct identification of the group ID: tf1 => -tf1- to prevent getting tf1sf groupId.
-    if groupids is None:
-        exact_groupids = list()
+    if not deployment.metadata.name.startswith(f"{name}-"):
+        return False
+    if not groupids:
+        return True
+    labels = deployment.spec.template.metadata.labels or dict()
+    return "group" in labels and any(f"-{groupid}-" in labels["group"] for groupid in groupids)
+
+def get_segmenter_deployments(name, groupids=None, namespace=None, group_format=DEFAULT_GROUP_LABEL_FORMAT):
+    # The groups are selected server side with "group in (...)", the client side filter is only applied to the
+    # legacy deployments. The list is scoped to the namespace when given and fetched by pages.
+    clientappsv1 = client.AppsV1Api()
+    if namespace:
+        list_func = partial(clientappsv1.list_namespaced_deployment, namespace)
     else:
-        exact_groupids = [ f"-{idval}-" for idval in groupids ]
+        list_func = clientappsv1.list_deployment_for_all_namespaces
 
-    clientappsv1 = client.AppsV1Api()
-    result = clientappsv1.list_deployment_for_all_namespaces(label_selector=f"type=unit,vendor=quortex")
-    segmenterdeps = list()
-    for item in result.items:
-        # Keep deployments starting with good basename. default is "segmenter"
-        if item.metadata.name.startswith(f"{name}-"):
-            # Filter groups depending groupids filter
-            if exact_groupids:
-                for groupid in exact_groupids:
-                    if "group" in item.spec.template.metadata.labels:
-                        if groupid in item.spec.template.metadata.labels["group"]:
-                            segmenterdeps.append(item)
-                            break
-            else:
-                segmenterdeps.append(item)
-    return segmenterdeps
+    groups = get_group_label_values(name, groupids or list(), group_format)
+    result = list_by_groups(list_func, label_selector=UNIT_LABEL_SELECTOR, groups=groups,
+                            match=partial(match_segmenter_deployment, name))
+    # Keep deployments starting with good basename. default is "segmenter"
+    return [ item for item in result if item.metadata.name.startswith(f"{name}-") ]
 
 def sort_segmenter_deployments_id_name(seg_deployments, id_name):
     sorted_deployment = list()
@@ -167,7 +618,40 @@ def get_selector_string_from_dep(deployment):
             selector = selector + f",{key}={val}"
     return selector
 
+def get_match_labels(deployment):
+    # Selector of a deployment model or record.
+    if isinstance(deployment, DeploymentRecord):
+        return deployment.match_labels
+    return deployment.spec.selector.match_labels
+
+def get_namespace_labels(obj):
+    # Namespace and labels of a model or a record.
+    if isinstance(obj, (DeploymentRecord, PodRecord)):
+        return obj.namespace, obj.labels
+    return obj.metadata.namespace, obj.metadata.labels or dict()
+
+def get_common_selector_string(deployments):
+    # Build the selector matching the pods of all the deployments: labels shared by all the match labels.
+    common = None
+    for deployment in deployments:
+        labels = set(get_match_labels(deployment).items())
+        common = labels if common is None else common & labels
+    if not common:
+        return ""
+    return ",".join(f"{key}={val}" for key, val in sorted(common))
+
+def is_pod_selected(deployment, pod):
+    namespace, labels = get_namespace_labels(pod)
+    if namespace != get_namespace_labels(deployment)[0]:
+        return False
+    for key, val in get_match_labels(deployment).items():
+        if labels.get(key) != val:
+            return False
+    return True
+
 def get_group(deployment):
+    if isinstance(deployment, DeploymentRecord):
+        return deployment.template_labels['group']
     return deployment.spec.template.metadata.labels['group']
 
 ###########################################
@@ -183,7 +667,8 @@ def update_sizing(window):
     global READY_COLUMN_START
     global STATUS_COLUMN_START
 
-    width, _height = os.get_terminal_size()
+    width, height = os.get_terminal_size()
+    curses.resizeterm(height, width)
     GROUPID_COLUMN_START    = 0
     ID_COLUMN_START         = GROUPID_COLUMN_START  + int(GROUPID_COLUMN_SIZE * width)
     DEP_COLUMN_START        = ID_COLUMN_START       + int(ID_COLUMN_SIZE * width)
@@ -193,7 +678,12 @@ def update_sizing(window):
     READY_COLUMN_START      = VERSION_COLUMN_START  + int(VERSION_COLUMN_SIZE * width)
     STATUS_COLUMN_START     = READY_COLUMN_START    + int(READY_COLUMN_SIZE * width)
 
-    window.resize(50,width)
+    window.resize(height,width)
+    return width, height
+
+def on_resize(_signum, _frame):
+    global RESIZED
+    RESIZED = True
 
 def get_pod_version(pod):
     for container in pod.spec.containers:
@@ -201,12 +691,9 @@ def get_pod_version(pod):
             return container.image.rsplit(":",1)[1]
     return "unknown"
 
-def get_deployment_inuse(ainodeconf, depname):
-    svc = depname.split("deployment")[0]+"service"
-    for conf in ainodeconf:
-        for upstream in conf["upstream"]:
-            if svc in upstream["address"]:
-                return "yes"
+def get_deployment_inuse(upstream_index, depname):
+    if upstream_index.is_used(get_service_name(depname)):
+        return "yes"
     return "no"
 
 def get_ainode_conf(ainodesconfs,groupname):
@@ -216,185 +703,200 @@ def get_ainode_conf(ainodesconfs,groupname):
             groupconf.append(ainodeconf)
     return groupconf
 
-def get_segmenter_status(name, seg_ainode_name=DEFAULT_SVC_SEGMENTER_AINODE):
+def build_selector_index(deployments):
+    # Index the deployments by the least shared label of their selector: (namespace, key, value) => deployments.
+    counts = dict()
+    for deployment in deployments:
+        namespace = get_namespace_labels(deployment)[0]
+        for key, val in get_match_labels(deployment).items():
+            counts[(namespace, key, val)] = counts.get((namespace, key, val), 0) + 1
+
+    index = dict()
+    for deployment in deployments:
+        namespace = get_namespace_labels(deployment)[0]
+        match_labels = get_match_labels(deployment)
+        if not match_labels:
+            continue
+        key, val = min(match_labels.items(), key=lambda item: counts[(namespace, item[0], item[1])])
+        index.setdefault((namespace, key, val), list()).append(deployment)
+    return index
+
+def get_pod_deployments(index, pod):
+    # Deployments selecting the pod, only the deployments indexed by one of the pod labels are checked.
+    deployments = list()
+    namespace, labels = get_namespace_labels(pod)
+    for key, val in labels.items():
+        for deployment in index.get((namespace, key, val), list()):
+            if is_pod_selected(deployment, pod):
+                deployments.append(deployment)
+    return deployments
+
+def get_pod_info(pod):
+    # Status of a pod model or record.
+    if isinstance(pod, PodRecord):
+        version = "unknown"
+        for container, image in pod.images:
+            if container.endswith("-unit"):
+                version = image.rsplit(":",1)[1]
+                break
+        return {"version":  version,
+                "status":   "Terminating" if pod.terminating else pod.phase,
+                "ready":    f"{pod.ready}/{len(pod.images)}"}
+    return {"version":  get_pod_version(pod),
+            "status":   get_pod_status(pod),
+            "ready":    get_pod_ready_container(pod)}
+
+def get_segmenter_deployment_records(name, namespace=None):
+    # Records of the unit deployments starting with good basename, from the raw LIST response.
+    result = list_deployments_raw(client.CoreV1Api().api_client, namespace, label_selector=UNIT_LABEL_SELECTOR)
+    return [ item for item in result if item.name.startswith(f"{name}-") ]
+
+def get_segmenter_pods(segmenterdeps, raw=False):
+    # One pod list per namespace, filtered on the labels shared by all the deployments selectors.
+    clientcorev1 = client.CoreV1Api()
+    namespaces = dict()
+    for segmenterdep in segmenterdeps:
+        namespaces.setdefault(get_namespace_labels(segmenterdep)[0], list()).append(segmenterdep)
+
+    pods = list()
+    for namespace, deployments in namespaces.items():
+        if raw:
+            pods.extend(list_pods_raw(clientcorev1.api_client, namespace, label_selector=get_common_selector_string(deployments)))
+        else:
+            pods.extend(clientcorev1.list_namespaced_pod(namespace, label_selector=get_common_selector_string(deployments)).items)
+    return pods
+
+def get_segmenter_status(name, seg_ainode_name=DEFAULT_SVC_SEGMENTER_AINODE, bulk=True, namespace=None, raw=True):
+    # Raw mode (bulk only): the deployments and pods are records parsed from the raw LIST responses, only the
+    # displayed fields are kept instead of the kubernetes client models.
     status = dict()
     clientcorev1 = client.CoreV1Api()
+    raw = raw and bulk
 
     upstreamgroups = get_ainode_all_conf(seg_ainode_name=seg_ainode_name)
+    upstream_index = UpstreamIndex(upstreamgroups)
 
-    segmenterdeps = get_segmenter_deployments(name=name)
+    if raw:
+        segmenterdeps = get_segmenter_deployment_records(name, namespace=namespace)
+    else:
+        segmenterdeps = get_segmenter_deployments(name=name, namespace=namespace)
 
     for segmenterdep in segmenterdeps:
-        if segmenterdep.spec.template.metadata.labels['group'] not in status:
-            status[segmenterdep.spec.template.metadata.labels['group']] = {"deployments":   dict(),
-                                                                           "ainodeconf":    get_ainode_conf(upstreamgroups,segmenterdep.spec.template.metadata.labels['group'])}
-
-        if segmenterdep.metadata.name not in status[segmenterdep.spec.template.metadata.labels['group']]:
-            status[segmenterdep.spec.template.metadata.labels['group']]["deployments"][segmenterdep.metadata.name]={"pods":dict(),
-                                                                                                                    "inuse":get_deployment_inuse(status[segmenterdep.spec.template.metadata.labels['group']]["ainodeconf"],segmenterdep.metadata.name)}
-
-        pods = clientcorev1.list_pod_for_all_namespaces(label_selector=get_selector_string_from_dep(segmenterdep))
-        for pod in pods.items:
-            status[segmenterdep.spec.template.metadata.labels['group']]["deployments"][segmenterdep.metadata.name]["pods"][pod.metadata.name] = {"version":    get_pod_version(pod),
-                                                                                                                                                 "status":     get_pod_status(pod),
-                                                                                                                                                 "ready":      get_pod_ready_container(pod)}
+        group = get_group(segmenterdep)
+        depname = segmenterdep.name if raw else segmenterdep.metadata.name
+        if group not in status:
+            status[group] = {"deployments":   dict(),
+                             "ainodeconf":    get_ainode_conf(upstreamgroups,group)}
+
+        if depname not in status[group]["deployments"]:
+            status[group]["deployments"][depname] = {"pods":    dict(),
+                                                     "inuse":   get_deployment_inuse(upstream_index,depname)}
+
+        if not bulk:
+            pods = clientcorev1.list_pod_for_all_namespaces(label_selector=get_selector_string_from_dep(segmenterdep))
+            for pod in pods.items:
+                status[group]["deployments"][depname]["pods"][pod.metadata.name] = get_pod_info(pod)
+
+    # Bulk mode: all the pods are listed at once and dispatched to their deployments in memory.
+    if bulk and segmenterdeps:
+        index = build_selector_index(segmenterdeps)
+        for pod in get_segmenter_pods(segmenterdeps, raw=raw):
+            podname = pod.name if raw else pod.metadata.name
+            for segmenterdep in get_pod_deployments(index, pod):
+                depname = segmenterdep.name if raw else segmenterdep.metadata.name
+                status[get_group(segmenterdep)]["deployments"][depname]["pods"][podname] = get_pod_info(pod)
     return status
 
-def render(name, status, window, id_prio_name, newversion):
-    window.clear()
-    update_sizing(window)
-    baseline = BASELINE_OFFSET
-    if baseline >= 0:
-        try:
-            window.addstr(baseline, GROUPID_COLUMN_START,   "GROUPID")
-        except curses.error:
-            pass
-        try:
-            extra_info = ""
-            if id_prio_name is not None:
-                extra_info = f" ({id_prio_name})"
-            window.addstr(baseline, ID_COLUMN_START,        f"ID{extra_info}")
-        except curses.error:
-            pass
-        try:
-            window.addstr(baseline, DEP_COLUMN_START,       "DEPLOYMENT")
-        except curses.error:
-            pass
-        try:
-            window.addstr(baseline, INUSE_COLUMN_START,     "INUSE")
-        except curses.error:
-            pass
-        try:
-            window.addstr(baseline, POD_COLUMN_START,       "POD")
-        except curses.error:
-            pass
-        try:
-            window.addstr(baseline, VERSION_COLUMN_START,   "VERSION")
-        except curses.error:
-            pass
-        try:
-            window.addstr(baseline, READY_COLUMN_START,     "READY")
-        except curses.error:
-            pass
-        try:
-            window.addstr(baseline, STATUS_COLUMN_START,    "STATUS")
-        except curses.error:
-            pass
-    baseline += 1
-    if baseline >= 0:
-        try:
-            window.addstr(baseline, GROUPID_COLUMN_START,   "-------")
-        except curses.error:
-            pass
-        try:
-            window.addstr(baseline, ID_COLUMN_START,        "--")
-        except curses.error:
-            pass
-        try:
-            window.addstr(baseline, DEP_COLUMN_START,       "----------")
-        except curses.error:
-            pass
-        try:
-            window.addstr(baseline, INUSE_COLUMN_START,     "-----")
-        except curses.error:
-            pass
-        try:
-            window.addstr(baseline, POD_COLUMN_START,       "---")
-        except curses.error:
-            pass
-        try:
-            window.addstr(baseline, VERSION_COLUMN_START,   "-------")
-        except curses.error:
-            pass
-        try:
-            window.addstr(baseline, READY_COLUMN_START,     "-----")
-        except curses.error:
-            pass
-        try:
-            window.addstr(baseline, STATUS_COLUMN_START,    "------")
-        except curses.error:
-            pass
+def get_status_rows(name, status, id_prio_name, newversion):
+    # Rows of the display, a row is a tuple of (text, color pair) per column.
+    extra_info = ""
+    if id_prio_name is not None:
+        extra_info = f" ({id_prio_name})"
+    rows = [(("GROUPID", 0), (f"ID{extra_info}", 0), ("DEPLOYMENT", 0), ("INUSE", 0),
+             ("POD", 0), ("VERSION", 0), ("READY", 0), ("STATUS", 0)),
+            (("-------", 0), ("--", 0), ("----------", 0), ("-----", 0),
+             ("---", 0), ("-------", 0), ("-----", 0), ("------", 0))]
 
     for group, value1 in status.items():
+        groupid = group.rsplit("-",1)[0]
+        groupid = groupid.split(f"{name}-",1)[-1]
         for dep, value2 in value1["deployments"].items():
+            podid = dep.split(f"{name}-{groupid}-",1)[-1]
+            podid = podid.split("-",1)[0]
+            inuse_color = 3 if value2['inuse'] == "yes" else 1
             for pod, value3 in value2["pods"].items():
-                baseline += 1
-                if baseline >= 0:
-                    groupid = group.rsplit("-",1)[0]
-                    groupid = groupid.split(f"{name}-",1)[-1]
-                    podid = dep.split(f"{name}-{groupid}-",1)[-1]
-                    podid = podid.split("-",1)[0]
-                    try:
-                        window.addstr(baseline, GROUPID_COLUMN_START, groupid)
-                    except curses.error:
-                        pass
-                    try:
-                        window.addstr(baseline, ID_COLUMN_START, podid)
-                    except curses.error:
-                        pass
-                    try:
-                        window.addstr(baseline, DEP_COLUMN_START, dep)
-                    except curses.error:
-                        pass
-
-                    if value2['inuse'] == "yes":
-                        try:
-                            window.addstr(baseline, INUSE_COLUMN_START, value2['inuse'], curses.color_pair(3))
-                        except curses.error:
-                            pass
-                    else:
-                        try:
-                            window.addstr(baseline, INUSE_COLUMN_START, value2['inuse'], curses.color_pair(1))
-                        except curses.error:
-                            pass
-                    try:
-                        window.addstr(baseline, POD_COLUMN_START, pod)
-                    except curses.error:
-                        pass
-                    if newversion == "":
-                        try:
-                            window.addstr(baseline, VERSION_COLUMN_START, value3['version'])
-                        except curses.error:
-                            pass
-                    elif newversion == value3['version']:
-                        try:
-                            window.addstr(baseline, VERSION_COLUMN_START, value3['version'], curses.color_pair(3))
-                        except curses.error:
-                            pass
-                    else:
-                        try:
-                            window.addstr(baseline, VERSION_COLUMN_START, value3['version'], curses.color_pair(1))
-                        except curses.error:
-                            pass
-
-                    if value3['ready'] == "1/1" or value3['ready'] == "2/2":
-                        try:
-                            window.addstr(baseline, READY_COLUMN_START, value3['ready'], curses.color_pair(3))
-                        except curses.error:
-                            pass
-                    else:
-                        try:
-                            window.addstr(baseline, READY_COLUMN_START, value3['ready'], curses.color_pair(2))
-                        except curses.error:
-                            pass
-
-                    if value3['status'] == "Running":
-                        try:
-                            window.addstr(baseline, STATUS_COLUMN_START, value3['status'], curses.color_pair(3))
-                        except curses.error:
-                            pass
-                    elif value3['status'] == "Pending":
-                        try:
-                            window.addstr(baseline, STATUS_COLUMN_START, value3['status'], curses.color_pair(2))
-                        except curses.error:
-                            pass
-                    else:
-                        try:
-                            window.addstr(baseline, STATUS_COLUMN_START, value3['status'], curses.color_pair(1))
-                        except curses.error:
-                            pass
+                if newversion == "":
+                    version_color = 0
+                elif newversion == value3['version']:
+                    version_color = 3
+                else:
+                    version_color = 1
+
+                if value3['ready'] == "1/1" or value3['ready'] == "2/2":
+                    ready_color = 3
+                else:
+                    ready_color = 2
+
+                if value3['status'] == "Running":
+                    status_color = 3
+                elif value3['status'] == "Pending":
+                    status_color = 2
+                else:
+                    status_color = 1
+
+                rows.append(((groupid, 0), (podid, 0), (dep, 0), (value2['inuse'], inuse_color), (pod, 0),
+                             (value3['version'], version_color), (value3['ready'], ready_color),
+                             (value3['status'], status_color)))
+    return rows
+
+class StatusRenderer:
+    # Differential rendering: the previously drawn row of each screen line is kept and only the visible lines
+    # whose row changed are drawn again.
+    def __init__(self):
+        self.frame = dict()
+        self.width = 0
+        self.height = 0
 
-    window.refresh()
+    def draw_cell(self, window, line, start, size, text, color):
+        if size <= 0:
+            return
+        try:
+            window.addnstr(line, start, text, size, curses.color_pair(color))
+        except curses.error:
+            pass
+
+    def draw(self, window, rows):
+        global RESIZED
+
+        # Layout (columns and window size) is only computed on terminal resize.
+        if RESIZED:
+            RESIZED = False
+            self.width, self.height = update_sizing(window)
+            self.frame = dict()
+            window.clear()
+
+        columns = [GROUPID_COLUMN_START, ID_COLUMN_START, DEP_COLUMN_START, INUSE_COLUMN_START,
+                   POD_COLUMN_START, VERSION_COLUMN_START, READY_COLUMN_START, STATUS_COLUMN_START, self.width - 1]
+        for line in range(self.height):
+            idx = line - BASELINE_OFFSET
+            row = rows[idx] if idx < len(rows) else None
+            if self.frame.get(line) == row:
+                continue
+            try:
+                window.move(line, 0)
+                window.clrtoeol()
+            except curses.error:
+                pass
+            if row is not None:
+                for col, (text, color) in enumerate(row):
+                    self.draw_cell(window, line, columns[col], columns[col + 1] - columns[col], text, color)
+            self.frame[line] = row
+        window.refresh()
+
+RENDERER = StatusRenderer()
+
+def render(name, status, window, id_prio_name, newversion):
+    RENDERER.draw(window, get_status_rows(name, status, id_prio_name, newversion))
 
 async def interract(user_args, window):
     global active
@@ -408,6 +910,8 @@ async def interract(user_args, window):
     while active:
         keypressed = window.getch()
         while keypressed != -1:
+            if keypressed == curses.KEY_RESIZE:
+                on_resize(None, None)
             if keypressed == curses.KEY_DOWN:
                 BASELINE_OFFSET -= 1
             elif keypressed == curses.KEY_UP:
@@ -424,7 +928,6 @@ async def interract(user_args, window):
         await asyncio.sleep(0.2)
 
 async def display_status(user_args, window):
-    global active
     global status
 
     # Get the user parameters.
@@ -432,64 +935,630 @@ async def display_status(user_args, window):
     id_prio_name = user_args.id_prio
     newversion=user_args.version
     seg_ainode_name=user_args.ainodename
-
-    while active:
-        status = get_segmenter_status(name, seg_ainode_name=seg_ainode_name)
-        render(name, status, window, id_prio_name, newversion)
-        await asyncio.sleep(1)
+    ainode_refresh=user_args.ainode_refresh
+
+    if active:
+        # The status is maintained by watch events, only render when it changed.
+        cache = SegmenterStatusCache(name, seg_ainode_name=seg_ainode_name, ainode_refresh=ainode_refresh)
+        await kube_call(cache.start)
+        rendered_version = -1
+        while active:
+            version, status = cache.get_status()
+            if version != rendered_version or RESIZED:
+                render(name, status, window, id_prio_name, newversion)
+                rendered_version = version
+            await asyncio.sleep(1)
+        cache.stop()
 
     window.clear()
     window.refresh()
     curses.endwin()
 
 
+###########################################
+### STATUS CACHE ##########################
+###########################################
+class SegmenterStatusCache:
+    # Informer-like local cache of the segmenter status, fed by watch streams on the unit deployments and pods.
+    # The status structure (same as get_segmenter_status) is updated per received event so that a display
+    # refresh does not send any request to the apiserver.
+    def __init__(self, name, seg_ainode_name=DEFAULT_SVC_SEGMENTER_AINODE, ainode_refresh=10):
+        self.name = name
+        self.seg_ainode_name = seg_ainode_name
+        self.ainode_refresh = ainode_refresh
+        self.active = False
+        self.synced = False
+        self.lock = threading.Lock()
+        self.deployments = dict()
+        self.pods = dict()
+        self.pod_owner = dict()
+        self.selector_index = None
+        self.pod_selector = UNIT_LABEL_SELECTOR
+        self.threads = list()
+        self.upstreamgroups = list()
+        self.upstream_index = UpstreamIndex()
+        self.status = dict()
+        self.version = 0
+        self.snapshot_version = -1
+        self.snapshot = dict()
+        # Group => names of its deployments changed since the last snapshot (the group entry itself is rebuilt).
+        self.changed = dict()
+
+    def start(self):
+        clientappsv1 = client.AppsV1Api()
+        clientcorev1 = client.CoreV1Api()
+        self.active = True
+
+        # Initial synchronisation, the pod selector is built from the deployments selectors.
+        self.upstreamgroups = get_ainode_all_conf(seg_ainode_name=self.seg_ainode_name)
+        self.upstream_index.sync(self.upstreamgroups)
+        deployments = clientappsv1.list_deployment_for_all_namespaces(label_selector=UNIT_LABEL_SELECTOR)
+        self.resync("deployment", deployments.items)
+        self.pod_selector = get_common_selector_string(self.deployments.values()) or UNIT_LABEL_SELECTOR
+        pods = clientcorev1.list_pod_for_all_namespaces(label_selector=self.pod_selector)
+        self.resync("pod", pods.items)
+        self.synced = True
+
+        self.threads = [threading.Thread(target=self.watch_loop, daemon=True,
+                                         args=("deployment", deployments.metadata.resource_version)),
+                        threading.Thread(target=self.watch_loop, daemon=True,
+                                         args=("pod", pods.metadata.resource_version)),
+                        threading.Thread(target=self.ainode_loop, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        # The watch threads stop at their next event or watch timeout.
+        self.active = False
+
+    def get_status(self):
+        # Return a consistent copy of the status with its version. A new snapshot shares the entries of the
+        # deployments not changed since the previous one (never modified), only the changed ones are copied.
+        with self.lock:
+            if self.snapshot_version != self.version:
+                snapshot = dict(self.snapshot)
+                for group, depnames in self.changed.items():
+                    value = self.status.get(group)
+                    if value is None:
+                        snapshot.pop(group, None)
+                        continue
+                    previous = snapshot[group]["deployments"] if group in snapshot else dict()
+                    snapshot[group] = {"deployments": dict((depname, deepcopy(depstatus) if depname in depnames or depname not in previous
+                                                            else previous[depname])
+                                                           for depname, depstatus in value["deployments"].items()),
+                                       "ainodeconf":  deepcopy(value["ainodeconf"])}
+                self.changed = dict()
+                self.snapshot = snapshot
+                self.snapshot_version = self.version
+            return self.snapshot_version, self.snapshot
+
+    def touch(self, group, depname=None):
+        # Mark a group (and one of its deployments) as changed for the next snapshot.
+        depnames = self.changed.setdefault(group, set())
+        if depname is not None:
+            depnames.add(depname)
+
+    def watch_loop(self, kind, resource_version):
+        api_client = client.CoreV1Api().api_client
+        path, path_params = get_raw_path("pods" if kind == "pod" else "deployments")
+        record = get_model_record(api_client, "V1Pod" if kind == "pod" else "V1Deployment")
+        get_selector = lambda: self.pod_selector if kind == "pod" else UNIT_LABEL_SELECTOR
+        while self.active:
+            selector = get_selector()
+            try:
+                # Without resource version (expired one), full list to resynchronize the cache. The watch is also
+                # restarted with a full list when the pod selector changed (new deployment not matching it).
+                list_then_watch(api_client, path, record, partial(self.resync, kind), partial(self.apply_event, kind),
+                                lambda: not self.active or get_selector() != selector, path_params=path_params,
+                                label_selector=selector, resource_version=resource_version,
+                                timeout_seconds=WATCH_TIMEOUT_SECONDS)
+            except Exception as e:
+                LOGGER.warning(f"Watch {kind} failure: {e}")
+                time.sleep(1)
+            resource_version = None
+
+    def ainode_loop(self):
+        while self.active:
+            time.sleep(self.ainode_refresh)
+            try:
+                upstreamgroups = get_ainode_all_conf(seg_ainode_name=self.seg_ainode_name)
+            except Exception as e:
+                LOGGER.warning(f"Ainode configuration refresh failure: {e}")
+                continue
+            if upstreamgroups == self.upstreamgroups:
+                continue
+            with self.lock:
+                self.upstreamgroups = upstreamgroups
+                # Only the deployments whose service references changed are updated.
+                changed = self.upstream_index.sync(upstreamgroups)
+                for group, value in self.status.items():
+                    ainodeconf = get_ainode_conf(upstreamgroups, group)
+                    if ainodeconf != value["ainodeconf"]:
+                        value["ainodeconf"] = ainodeconf
+                        self.touch(group)
+                    for depname, depstatus in value["deployments"].items():
+                        if get_service_name(depname) in changed:
+                            depstatus["inuse"] = get_deployment_inuse(self.upstream_index, depname)
+                            self.touch(group, depname)
+                self.version += 1
+
+    def resync(self, kind, items):
+        objects = self.deployments if kind == "deployment" else self.pods
+        keys = set()
+        for item in items:
+            keys.add((item.metadata.namespace, item.metadata.name))
+            self.apply_event(kind, "MODIFIED", item)
+        for key in set(objects.keys()) - keys:
+            self.apply_event(kind, "DELETED", objects[key])
+
+    def apply_event(self, kind, event_type, item):
+        with self.lock:
+            if kind == "deployment":
+                self.apply_deployment(event_type, item)
+            else:
+                self.apply_pod(event_type, item)
+            self.version += 1
+
+    def apply_deployment(self, event_type, deployment):
+        key = (deployment.metadata.namespace, deployment.metadata.name)
+        # Keep deployments starting with good basename. default is "segmenter"
+        if not deployment.metadata.name.startswith(f"{self.name}-"):
+            return
+
+        previous = self.deployments.pop(key, None)
+        if previous is not None and (event_type == "DELETED" or
+                                     get_group(previous) != get_group(deployment) or
+                                     previous.spec.selector.match_labels != deployment.spec.selector.match_labels):
+            self.remove_deployment(previous)
+            self.selector_index = None
+            previous = None
+        if event_type == "DELETED":
+            return
+
+        self.deployments[key] = deployment
+        if previous is not None:
+            return
+        self.selector_index = None
+
+        # New deployment: create its status entry and attach the pods already known.
+        group = get_group(deployment)
+        if group not in self.status:
+            self.status[group] = {"deployments":   dict(),
+                                  "ainodeconf":    get_ainode_conf(self.upstreamgroups, group)}
+        self.status[group]["deployments"][deployment.metadata.name] = {"pods":  dict(),
+                                                                        "inuse": get_deployment_inuse(self.upstream_index, deployment.metadata.name)}
+        self.touch(group, deployment.metadata.name)
+        for podkey, pod in self.pods.items():
+            if podkey not in self.pod_owner and is_pod_selected(deployment, pod):
+                self.attach_pod(deployment, pod)
+
+        # Pods of this deployment are not selected by the watch: update the pod selector.
+        selector = dict(pair.split("=", 1) for pair in self.pod_selector.split(","))
+        if self.synced and any(deployment.spec.selector.match_labels.get(k) != v for k, v in selector.items()):
+            # The pod watch restarts with the new selector at its next event or timeout.
+            self.pod_selector = get_common_selector_string(self.deployments.values()) or UNIT_LABEL_SELECTOR
+
+    def remove_deployment(self, deployment):
+        group = get_group(deployment)
+        depname = deployment.metadata.name
+        self.status[group]["deployments"].pop(depname, None)
+        self.touch(group, depname)
+        if not self.status[group]["deployments"]:
+            del self.status[group]
+        for podkey, owner in list(self.pod_owner.items()):
+            if owner == (group, depname):
+                del self.pod_owner[podkey]
+
+    def apply_pod(self, event_type, pod):
+        key = (pod.metadata.namespace, pod.metadata.name)
+        if event_type == "DELETED":
+            self.pods.pop(key, None)
+            owner = self.pod_owner.pop(key, None)
+            if owner is not None:
+                self.status[owner[0]]["deployments"][owner[1]]["pods"].pop(pod.metadata.name, None)
+                self.touch(*owner)
+            return
+
+        self.pods[key] = pod
+        owner = self.pod_owner.get(key)
+        if owner is not None:
+            self.set_pod_status(owner, pod)
+            return
+        if self.selector_index is None:
+            self.selector_index = build_selector_index(self.deployments.values())
+        for deployment in get_pod_deployments(self.selector_index, pod):
+            self.attach_pod(deployment, pod)
+            break
+
+    def attach_pod(self, deployment, pod):
+        owner = (get_group(deployment), deployment.metadata.name)
+        self.pod_owner[(pod.metadata.namespace, pod.metadata.name)] = owner
+        self.set_pod_status(owner, pod)
+
+    def set_pod_status(self, owner, pod):
+        self.status[owner[0]]["deployments"][owner[1]]["pods"][pod.metadata.name] = get_pod_info(pod)
+        self.touch(*owner)
+
+
+###########################################
+### EXPORT FUNCTIONS ######################
+###########################################
+def get_status_events(previous, current):
+    # Change events between two status: ADDED, MODIFIED or DELETED group (ainodeconf), deployment (inuse) and pod.
+    # The deletion of a group or deployment is not repeated for its deployments and pods.
+    events = list()
+    for group in previous.keys() - current.keys():
+        events.append({"type": "DELETED", "kind": "group", "group": group})
+    for group, value in current.items():
+        prevgroup = previous.get(group)
+        if prevgroup is None:
+            events.append({"type": "ADDED", "kind": "group", "group": group, "ainodeconf": value["ainodeconf"]})
+            prevdeps = dict()
+        else:
+            if prevgroup["ainodeconf"] != value["ainodeconf"]:
+                events.append({"type": "MODIFIED", "kind": "group", "group": group, "ainodeconf": value["ainodeconf"]})
+            prevdeps = prevgroup["deployments"]
+
+        for dep in prevdeps.keys() - value["deployments"].keys():
+            events.append({"type": "DELETED", "kind": "deployment", "group": group, "deployment": dep})
+        for dep, depvalue in value["deployments"].items():
+            prevdep = prevdeps.get(dep)
+            if prevdep is None:
+                events.append({"type": "ADDED", "kind": "deployment", "group": group, "deployment": dep, "inuse": depvalue["inuse"]})
+                prevpods = dict()
+            else:
+                if prevdep["inuse"] != depvalue["inuse"]:
+                    events.append({"type": "MODIFIED", "kind": "deployment", "group": group, "deployment": dep, "inuse": depvalue["inuse"]})
+                prevpods = prevdep["pods"]
+
+            for pod in prevpods.keys() - depvalue["pods"].keys():
+                events.append({"type": "DELETED", "kind": "pod", "group": group, "deployment": dep, "pod": pod})
+            for pod, podvalue in depvalue["pods"].items():
+                if prevpods.get(pod) != podvalue:
+                    events.append({"type": "ADDED" if pod not in prevpods else "MODIFIED", "kind": "pod", "group": group,
+                                   "deployment": dep, "pod": pod, **podvalue})
+    return events
+
+def write_json(data):
+    sys.stdout.write(json.dumps(data) + "\n")
+    sys.stdout.flush()
+
+async def export_status(user_args):
+    # Get the user parameters.
+    name = user_args.name
+    output = user_args.output
+    seg_ainode_name=user_args.ainodename
+    ainode_refresh=user_args.ainode_refresh
+
+    # Single snapshot of the status.
+    if output == "json":
+        write_json(await kube_call(get_segmenter_status, name, seg_ainode_name=seg_ainode_name,
+                                   namespace=user_args.namespace))
+        return
+
+    # Stream: a first snapshot, then the change events of the status cache (one JSON object per line).
+    cache = SegmenterStatusCache(name, seg_ainode_name=seg_ainode_name, ainode_refresh=ainode_refresh)
+    await kube_call(cache.start)
+    exported_version, previous = cache.get_status()
+    write_json({"type": "SNAPSHOT", "time": time.time(), "status": previous})
+    while active:
+        await asyncio.sleep(1)
+        version, current = cache.get_status()
+        if version == exported_version:
+            continue
+        now = time.time()
+        for event in get_status_events(previous, current):
+            event["time"] = now
+            write_json(event)
+        exported_version, previous = version, current
+    cache.stop()
+
+
+###########################################
+### UPGRADE JOURNAL #######################
+###########################################
+class UpgradeJournal:
+    # Append-only journal of the upgrade steps of each deployment, one JSON record per line. Each record is synced
+    # to disk before the upgrade goes on, so that an interrupted upgrade can be resumed or rolled back.
+    # Data of the "start" record (initial state of the deployment), not overwritten by the following records.
+    start_data = ("version", "newversion", "replicas")
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.file = open(filename, "a")
+
+    def record(self, deployment, step, **data):
+        entry = {"time": time.time(), "namespace": deployment.metadata.namespace,
+                 "deployment": deployment.metadata.name, "step": step}
+        entry.update(data)
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def load(filename):
+        # State of each deployment: (namespace, name) => {"steps": [...], and the data of its records}.
+        # A new "start" record resets the state, a truncated last line (crash while writing) is ignored.
+        states = dict()
+        with open(filename) as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    LOGGER.warning(f"Ignoring invalid journal record: {line.strip()}")
+                    continue
+                key = (entry.pop("namespace"), entry.pop("deployment"))
+                step = entry.pop("step")
+                if step == "start" or key not in states:
+                    states[key] = {"steps": list()}
+                elif any(name in entry for name in UpgradeJournal.start_data):
+                    # The initial state is only given by the "start" record.
+                    entry = dict((name, val) for name, val in entry.items() if name not in UpgradeJournal.start_data)
+                states[key]["steps"].append(step)
+                # The upstreams are journaled per upstreamgroup while draining, then all together.
+                states[key].setdefault("upstreams", dict()).update(entry.pop("upstreams", dict()))
+                states[key].update(entry)
+        return states
+
+# Journal of the upgrade, None when not enabled.
+JOURNAL = None
+
+def journal_record(deployment, step, **data):
+    if JOURNAL is not None:
+        JOURNAL.record(deployment, step, **data)
+
+def journal_drained(deployment):
+    # on_drained callback of the drains: each upstreamgroup drained is journaled once put.
+    return lambda _svcname, uuid, upstreams: journal_record(deployment, "upstreamgroup_drained", upstreams={uuid: upstreams})
+
+
+###########################################
+### PLAN FUNCTIONS ########################
+###########################################
+# Default file of the upgrade phases durations history.
+DEFAULT_STATS_FILE = os.path.expanduser("~/.update_segmenter_stats.json")
+
+# Number of durations kept per phase in the history.
+STATS_SAMPLES = 200
+
+# Durations (seconds) used for the phases without history.
+DEFAULT_PHASE_DURATIONS = {"drain": 1, "scale_to_zero": 15, "image_patch": 1, "ready_wait": 30, "restore": 30}
+
+class PhaseStats:
+    # History of the upgrade phases durations, saved in a local JSON file after each phase.
+    def __init__(self, filename):
+        self.filename = filename
+        self.phases = dict()
+        if os.path.exists(filename):
+            try:
+                with open(filename) as stats:
+                    self.phases = json.load(stats).get("phases", dict())
+            except (OSError, ValueError) as e:
+                LOGGER.warning(f"Ignoring invalid stats file {filename}: {e}")
+
+    def add(self, phase, duration):
+        self.phases.setdefault(phase, list()).append(round(duration, 3))
+        del self.phases[phase][:-STATS_SAMPLES]
+        try:
+            tmpname = f"{self.filename}.tmp"
+            with open(tmpname, "w") as stats:
+                json.dump({"phases": self.phases}, stats)
+            os.replace(tmpname, self.filename)
+        except OSError as e:
+            LOGGER.warning(f"Cannot save stats file {self.filename}: {e}")
+
+    def estimate(self, phase):
+        # Median of the history, or the default duration.
+        durations = sorted(self.phases.get(phase, list()))
+        if not durations:
+            return DEFAULT_PHASE_DURATIONS[phase]
+        return durations[len(durations) // 2]
+
+# History of the phases durations, None when not recorded.
+STATS = None
+
+def get_upgrade_phases(deployment, upstream_index, overbw):
+    # Phases of the upgrade of a deployment, same conditions as upgrade_deployment.
+    refs = upstream_index.get_refs(get_service_name(deployment.metadata.name))
+    nbupstream = 0
+    drained = False
+    for uuid, positions in refs.items():
+        nbupstream = len(upstream_index.confs[uuid]["upstream"])
+        drained = drained or len(positions) < nbupstream
+    scaled = overbw is False or nbupstream != 1 or not refs
+    phases = ["drain"]
+    if scaled:
+        phases.append("scale_to_zero")
+    phases.extend(["image_patch", "ready_wait"])
+    if scaled or drained:
+        phases.append("restore")
+    return phases
+
+def plan_schedule(units, max_per_group=1, max_parallel=0, start=0):
+    # Simulate upgrade_groups on the units [(group, deployment, duration)] in order: a unit starts as soon as its
+    # group and the global limit allow it. Return the schedule [(start, end, group, deployment)] and its end time.
+    queues = dict()
+    for unit in units:
+        queues.setdefault(unit[0], deque()).append(unit)
+    inflight = dict((group, 0) for group in queues)
+    running = list()
+    schedule = list()
+    now = start
+    while any(queues.values()) or running:
+        started = True
+        while started:
+            started = False
+            for group, queue in queues.items():
+                if not queue or inflight[group] >= max_per_group:
+                    continue
+                if max_parallel > 0 and len(running) >= max_parallel:
+                    break
+                group, deployment, duration = queue.popleft()
+                inflight[group] += 1
+                running.append((now + duration, group))
+                schedule.append((now, now + duration, group, deployment))
+                started = True
+        running.sort()
+        now, group = running.pop(0)
+        inflight[group] -= 1
+    return schedule, now
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}h{(seconds % 3600) // 60:02d}m{seconds % 60:02d}s"
+
+async def plan_upgrade(user_args):
+    global active
+
+    # Get user arguments.
+    name=user_args.name
+    newversion=user_args.version
+    groupids=user_args.group
+    namespace=user_args.namespace
+    group_format=user_args.group_label_format
+    overbw=user_args.overbandwidth
+    parallel=user_args.parallel
+    id_prio_name=user_args.id_prio
+    seg_ainode_name=user_args.ainodename
+    max_per_group=user_args.max_per_group
+    max_parallel=user_args.max_parallel
+    canary=user_args.canary
+    canary_count=user_args.canary_count
+    canary_parallel=user_args.canary_parallel
+    canary_soak=user_args.canary_soak
+    stats = PhaseStats(user_args.stats_file)
+
+    deployments = await kube_call(get_segmenter_deployments, name=name, groupids=groupids, namespace=namespace,
+                                  group_format=group_format)
+    if id_prio_name is not None:
+        deployments = sort_segmenter_deployments_id_name(deployments, id_prio_name)
+    upstream_index = UpstreamIndex(await kube_call(get_ainode_all_conf, seg_ainode_name=seg_ainode_name))
+
+    # Estimated duration of each deployment to upgrade (the ones already on the version are skipped).
+    units = list()
+    for dep in deployments:
+        if extract_name(dep.spec.template.spec.containers[0].image)[1] == newversion:
+            continue
+        phases = get_upgrade_phases(dep, upstream_index, overbw)
+        units.append((get_group(dep), dep.metadata.name, sum(stats.estimate(phase) for phase in phases) + 1))
+
+    # Same stages as upgrade_version, the sequential mode is a single queue.
+    stages = list()
+    if canary:
+        canary_names = set(dep.metadata.name for dep in get_canaries(deployments, id_prio_name, newversion, canary_count))
+        canaries = [unit for unit in units if unit[1] in canary_names]
+        stages.append(("canary", canaries, canary_parallel))
+        units = [unit for unit in units if unit not in canaries]
+    stages.append(("rollout", units, max_parallel))
+
+    schedule = list()
+    end = 0
+    for stage, stage_units, stage_parallel in stages:
+        if parallel is True:
+            stage_schedule, end = plan_schedule(stage_units, max_per_group, stage_parallel, end)
+        else:
+            stage_schedule = list()
+            for group, dep, duration in stage_units:
+                stage_schedule.append((end, end + duration, group, dep))
+                end += duration
+        schedule.extend((stage, ) + item for item in sorted(stage_schedule))
+        if stage == "canary" and stage_units:
+            end += canary_soak
+
+    print(f"{'STAGE':<8} {'START':>10} {'END':>10}  {'GROUP':<30} DEPLOYMENT")
+    for stage, start, stop, group, dep in schedule:
+        print(f"{stage:<8} {format_duration(start):>10} {format_duration(stop):>10}  {group:<30} {dep}")
+    print("\nPhases estimates:")
+    for phase in DEFAULT_PHASE_DURATIONS:
+        print(f"- {phase}: {stats.estimate(phase)}s ({len(stats.phases.get(phase, list()))} samples)")
+    print(f"\n{len(schedule)} deployments to upgrade, estimated duration: {format_duration(end)}")
+    active = False
+
+
 ###########################################
 ### UPGRADE FUNCTIONS #####################
 ###########################################
 def send_die_to_pod(pod):
     clientcorev1 = client.CoreV1Api()
-    clientcorev1.connect_get_namespaced_pod_proxy_with_path(f"{pod.metadata.name}",f"{pod.metadata.namespace}","die")
+    kube_request(clientcorev1.connect_get_namespaced_pod_proxy_with_path, f"{pod.metadata.name}",f"{pod.metadata.namespace}","die")
 
 def extract_name(image):
     return image.rsplit(":",1)[0], image.rsplit(":",1)[1]
 
-async def put_deployment_replicas(deployment, replicas, force_die=True):
-    clientappsv1 = client.AppsV1Api()
-    clientcorev1 = client.CoreV1Api()
-    patch = {"spec":{"replicas": replicas}}
-    result = clientappsv1.patch_namespaced_deployment(deployment.metadata.name,deployment.metadata.namespace,patch)
-    deployment = clientappsv1.read_namespaced_deployment(deployment.metadata.name,deployment.metadata.namespace)
+def is_pod_ready(pod, image=None):
+    podready = get_pod_ready_container(pod)
+    if podready != "1/1" and podready != "2/2":
+        return False
+    # When an image is given, the pod must run it.
+    if image is not None and pod.spec.containers[0].image != image:
+        return False
+    return True
+
+def force_die_pod(pod, died):
+    # Accelerate termination by sending die signal
+    if get_pod_status(pod) == "Terminating":
+        if is_pod_ready(pod):
+            if pod.metadata.name not in died:
+                LOGGER.info(f"Force send DIE command on pod {pod.metadata.name}")
+                died.append(pod.metadata.name)
+                send_die_to_pod(pod)
+
+def wait_deployment_pods(deployment, image=None, force_die=False, timeout=None):
+    # Wait for the number of pods of the deployment to match its replicas with all containers up (and running the
+    # image if given). The pods are listed once and then followed with a watch resumed from the last resource version.
+    api_client = client.CoreV1Api().api_client
+    path, path_params = get_raw_path("pods", deployment.metadata.namespace)
     nbpods = deployment.spec.replicas
-    ready = False
+    deadline = None if timeout is None else time.monotonic() + timeout
+    pods = dict()
     died = list()
-    while ready is False:
-        ready = True
-        pods = clientcorev1.list_namespaced_pod(namespace=deployment.metadata.namespace, label_selector=get_selector_string_from_dep(deployment))
-
-        # If number of pods does not match the deployment, ready is false
-        if len(pods.items) != nbpods:
-            ready = False
 
-        # If all container are not up, ready is false
-        for pod in pods.items:
-            podready = get_pod_ready_container(pod)
-            if  podready != "1/1" and podready != "2/2":
-                ready = False
+    def ready():
+        return len(pods) == nbpods and all(is_pod_ready(pod, image) for pod in pods.values())
 
-            # Accelerate termination by sending die signal
+    def on_list(items):
+        pods.clear()
+        for pod in items:
+            pods[pod.metadata.name] = pod
             if force_die:
-                if get_pod_status(pod) == "Terminating":
-                    if podready == "1/1" or podready == "2/2":
-                        if pod.metadata.name not in died:
-                            LOGGER.info(f"Force send DIE command on pod {pod.metadata.name}")
-                            died.append(pod.metadata.name)
-                            send_die_to_pod(pod)
+                force_die_pod(pod, died)
 
-        await asyncio.sleep(1)
+    def on_event(event_type, pod):
+        if event_type == "DELETED":
+            pods.pop(pod.metadata.name, None)
+        else:
+            pods[pod.metadata.name] = pod
+            if force_die:
+                force_die_pod(pod, died)
+
+    def watch_timeout():
+        if deadline is None:
+            return WATCH_TIMEOUT_SECONDS
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"Deployment {deployment.metadata.name} pods not ready after {timeout} seconds")
+        return max(1, min(WATCH_TIMEOUT_SECONDS, int(remaining)))
+
+    # Stop waiting when the process is stopping (CTRL+C), the wait runs in an executor thread.
+    list_then_watch(api_client, path, get_model_record(api_client, "V1Pod"), on_list, on_event,
+                    lambda: not active or ready(), path_params=path_params,
+                    label_selector=get_selector_string_from_dep(deployment), timeout_seconds=watch_timeout,
+                    list_runner=kube_request)
+
+async def put_deployment_replicas(deployment, replicas, force_die=True, timeout=None):
+    clientappsv1 = client.AppsV1Api()
+    patch = {"spec":{"replicas": replicas}}
+    result = await kube_call(clientappsv1.patch_namespaced_deployment, deployment.metadata.name,deployment.metadata.namespace,patch)
+    deployment = await kube_call(clientappsv1.read_namespaced_deployment, deployment.metadata.name,deployment.metadata.namespace)
+    await kube_wait(wait_deployment_pods, deployment, force_die=force_die, timeout=timeout)
 
-async def put_deployment_version(deployment,newversion, kube_app_name="segmenter-unit", kube_managed="segmenter-daemon"):
+async def put_deployment_version(deployment,newversion, kube_app_name="segmenter-unit", kube_managed="segmenter-daemon", timeout=None):
     clientappsv1 = client.AppsV1Api()
-    clientcorev1 = client.CoreV1Api()
     baseimage, _version = extract_name(deployment.spec.template.spec.containers[0].image)
     newimage = f"{baseimage}:{newversion}"
     patch = {
@@ -511,141 +1580,187 @@ async def put_deployment_version(deployment,newversion, kube_app_name="segmenter
                 }
             }
 
-    # Spec.template labels update new labels if needed.
-    new_labels = deployment.spec.template.metadata.labels
-    label_patch_info = ""
-    if 'app.kubernetes.io/instance' not in new_labels and 'app' in new_labels:
-        new_labels['app.kubernetes.io/instance'] = new_labels['app']
-        label_patch_info = f"app.kube.instance={new_labels['app.kubernetes.io/instance']}"
-    if 'app.kubernetes.io/name' not in new_labels:
-        new_labels['app.kubernetes.io/name'] = kube_app_name
-        label_patch_info = f"{label_patch_info} app.kube.name={new_labels['app.kubernetes.io/name']}"
-    if label_patch_info and new_labels:
-        LOGGER.info(f"Updating labels spec.template of deployment {deployment.metadata.name}: {label_patch_info}")
-        patch['spec']['template']['metadata'] = {'labels': new_labels}
-
-    # Metadata labels update new labels if needed.
-    new_labels = deployment.metadata.labels
-    label_patch_info = ""
-    if 'app.kubernetes.io/instance' not in new_labels and 'app' in new_labels:
-        new_labels['app.kubernetes.io/instance'] = new_labels['app']
-        label_patch_info = f"app.kube.instance={new_labels['app.kubernetes.io/instance']}"
-    if 'app.kubernetes.io/name' not in new_labels:
-        new_labels['app.kubernetes.io/name'] = kube_app_name
-        label_patch_info = f"{label_patch_info} app.kube.name={new_labels['app.kubernetes.io/name']}"
-    if 'app.kubernetes.io/managed-by' not in new_labels:
-        new_labels['app.kubernetes.io/managed-by'] = kube_managed
-        label_patch_info = f"{label_patch_info} app.kube.managed={new_labels['app.kubernetes.io/managed-by']}"
-    if 'vendor' not in new_labels:
-        new_labels['vendor'] = 'quortex'
-        label_patch_info = f"{label_patch_info} vendor={new_labels['vendor']}"
-    if 'group' not in new_labels and deployment.spec.template.metadata.labels.get('group'):
-        new_labels['group'] = deployment.spec.template.metadata.labels['group']
-        label_patch_info = f"{label_patch_info} group={new_labels['group']}"
-    if label_patch_info and new_labels:
-        LOGGER.info(f"Updating labels metadata of deployment {deployment.metadata.name}: {label_patch_info}")
-        patch['metadata'] = {'labels': new_labels}
-
-    result = clientappsv1.patch_namespaced_deployment(deployment.metadata.name,deployment.metadata.namespace,patch)
-    deployment = clientappsv1.read_namespaced_deployment(deployment.metadata.name,deployment.metadata.namespace)
-    nbpods = deployment.spec.replicas
-    ready = False
-    died = list()
-    while ready is False:
-        ready = True
-        pods = clientcorev1.list_namespaced_pod(namespace=deployment.metadata.namespace, label_selector=get_selector_string_from_dep(deployment))
-        # If number of pods does not match the deployment, ready is false
-        if len(pods.items) != nbpods:
-            ready = False
-
-        # If all container are not up, ready is false
-        for pod in pods.items:
-            if pod.spec.containers[0].image != newimage:
-                ready = False
-
-            podready = get_pod_ready_container(pod)
-            if  podready != "1/1" and podready != "2/2":
-                ready = False
-
-        await asyncio.sleep(1)
+    with upgrade_phase(deployment, "image_patch"):
+        # Missing labels of the unit, nothing is sent when they are up to date. The pods template labels are sent with
+        # the image in the same patch (one rollout), the metadata labels with a server side apply.
+        delta, managed = get_label_state(deployment, get_deployment_rules(kube_app_name, kube_managed))
+        for path in delta:
+            LOGGER.info(f"Updating labels {path} of deployment {deployment.metadata.name}: {format_label_delta(delta, path)}")
+        if delta.get("template"):
+            patch["spec"]["template"]["metadata"] = {"labels": delta["template"]}
+        if delta.get("metadata"):
+            await kube_call(apply_config, clientappsv1.api_client, "deployment", deployment,
+                            get_apply_config("deployment", deployment, {"metadata": managed["metadata"]}))
+        result = await kube_call(clientappsv1.patch_namespaced_deployment, deployment.metadata.name,deployment.metadata.namespace,patch)
+        deployment = await kube_call(clientappsv1.read_namespaced_deployment, deployment.metadata.name,deployment.metadata.namespace)
+    with upgrade_phase(deployment, "ready_wait"):
+        await kube_wait(wait_deployment_pods, deployment, image=newimage, timeout=timeout)
 
 def put_ainode_conf(conf, seg_ainode_name=DEFAULT_SVC_SEGMENTER_AINODE):
-    clientcorev1 = client.CoreV1Api()
-    services = clientcorev1.list_service_for_all_namespaces(label_selector=f"app.kubernetes.io/name={seg_ainode_name},app.quortex.io/type=ainode")
-    if len(services.items):
-        service = services.items[0]
-        path_params = {"name": f"{service.metadata.name}:api",
-                       "namespace": service.metadata.namespace,
-                       "path": f"1.0/upstreamgroup/{conf['uuid']}"}
-        _response = clientcorev1.api_client.call_api('/api/v1/namespaces/{namespace}/services/{name}/proxy/{path}', 'PUT',
-                                                     path_params,
-                                                     [],
-                                                     {"Accept": "*/*","Content-Type":"application/json"},
-                                                     body=conf,
-                                                     post_params=[],
-                                                     files={},
-                                                     response_type='str',
-                                                     auth_settings=["BearerToken"],
-                                                     async_req=False,
-                                                     _return_http_data_only=True,
-                                                     _preload_content=True,
-                                                     _request_timeout=None,
-                                                     collection_formats={})
+    get_ainode_client(seg_ainode_name).put(conf)
+
+def get_scale_down(upstream_index, svcname, overbw):
+    # (scale down, number of upstreams, used) of a unit: it is scaled to 0 replica during its upgrade to avoid the
+    # overbandwidth consumption, unless allowed for a unit used by an upstreamgroup of a single upstream.
+    refs = upstream_index.get_refs(svcname)
+    nbupstream = 0
+    for uuid in refs:
+        nbupstream = len(upstream_index.confs[uuid]["upstream"])
+    return overbw is False or nbupstream != 1 or not refs, nbupstream, bool(refs)
 
-async def upgrade_deployment(deployment, ainodeconfs, newversion, overbw, force_die=False, kube_app_name="segmenter-unit",
-                             kube_app_managed="segmenter-daemon"):
+async def upgrade_deployment(deployment, upstream_index, newversion, overbw, force_die=False, kube_app_name="segmenter-unit",
+                             kube_app_managed="segmenter-daemon", ready_timeout=None, ainode_client=None, drain_batch=None):
     LOGGER.info(f"Upgrading deployment deployments={deployment.metadata.name} with version {newversion}")
     # Check if deployment is correct version
     _baseimage, version = extract_name(deployment.spec.template.spec.containers[0].image)
     if version == newversion:
         return
+    journal_record(deployment, "start", group=get_group(deployment), version=version, newversion=newversion,
+                   replicas=deployment.spec.replicas)
 
     # Check if deployment is used, for each use deactivate upstream before update
-    svcname = deployment.metadata.name.split("deployment")[0]+"service"
-    modifiedconfs = list()
-    newconfs = list()
-    nbupstream = 0
-    for conf in ainodeconfs:
-        newupstreams = list()
-        updateconf = False
-        for upstream in conf["upstream"]:
-            if svcname not in upstream["address"]:
-                newupstreams.append(upstream)
+    start = time.monotonic()
+    with upgrade_phase(deployment, "drain"):
+        svcname = get_service_name(deployment.metadata.name)
+        refs = upstream_index.get_refs(svcname)
+        scale_down, nbupstream, used = get_scale_down(upstream_index, svcname, overbw)
+
+        # The unit upstreams are removed from the upstreamgroups having other upstreams while it restarts.
+        # Each upstreamgroup drained is journaled once put, so that an interrupted drain can be restored.
+        removed = dict()
+        if ainode_client is not None and refs:
+            if drain_batch is not None:
+                removed = await drain_batch.drain(svcname, list(refs.keys()), journal_drained(deployment))
             else:
-                updateconf = True
-        if updateconf is True:
-            newconf = deepcopy(conf)
-            nbupstream = len(conf["upstream"])
-            newconf["upstream"] = newupstreams
-            newconfs.append(newconf)
-            modifiedconfs.append(conf)
-
-    # Check if deployment is used by checking the number of conf where it is used
-    if len(newconfs):
-        notused = False
-    else:
-        notused = True
+                removed = await kube_call(ainode_client.drain_service, svcname, list(refs.keys()), journal_drained(deployment))
+            if removed:
+                LOGGER.info(f"Removed upstreams of {svcname} from upstreamgroups {','.join(removed.keys())}")
+        # Recorded even without removed upstream: the resume replays the drain when it is missing.
+        journal_record(deployment, "drained", upstreams=removed)
 
     # Set replicas to zero to avoid overbandwith consumption
     # Conditions one of following:
     # 1: overbandwidth is not allowed
     # 2: number of upstream must be != 1
     # 3: the deployment is not used
-    if overbw is False or nbupstream != 1 or notused is True:
+    if scale_down:
         nbreplicas = deployment.spec.replicas
-        LOGGER.info(f"Set to O replica: OverBandwidth={overbw} NbUpstreams={nbupstream} (used={not notused}) InitReplica={nbreplicas}")
-        await put_deployment_replicas(deployment,0,force_die)
+        LOGGER.info(f"Set to O replica: OverBandwidth={overbw} NbUpstreams={nbupstream} (used={used}) InitReplica={nbreplicas}")
+        with upgrade_phase(deployment, "scale_to_zero"):
+            await put_deployment_replicas(deployment,0,force_die,ready_timeout)
+        journal_record(deployment, "scaled_down")
 
     # Upgrade version of deployment
     LOGGER.info(f"Edit deployment to new version {newversion}")
-    await put_deployment_version(deployment,newversion, kube_app_name, kube_app_managed)
+    await put_deployment_version(deployment,newversion, kube_app_name, kube_app_managed, ready_timeout)
+    journal_record(deployment, "image_patched")
+
+    # Reset replicas to nominal value, then put back the unit upstreams once the new pods are ready.
+    if scale_down or removed:
+        with upgrade_phase(deployment, "restore"):
+            if scale_down:
+                LOGGER.info(f"Restore replica to {nbreplicas}: OverBandwidth={overbw} NbUpstreams={nbupstream} (used={used}) InitReplica={nbreplicas}")
+                await put_deployment_replicas(deployment,nbreplicas,force_die,ready_timeout)
+                journal_record(deployment, "restored")
+
+            if removed:
+                LOGGER.info(f"Restore upstreams of {svcname} in upstreamgroups {','.join(removed.keys())}")
+                await kube_call(ainode_client.restore_upstreams, removed)
+                journal_record(deployment, "upstreams_restored")
+
+    journal_record(deployment, "done")
+    count_upgraded_unit(deployment, time.monotonic() - start)
+    await asyncio.sleep(1)
 
-    # Reset replicas to nominal value
-    if overbw is False or nbupstream != 1 or notused is True:
-        LOGGER.info(f"Restore replica to {nbreplicas}: OverBandwidth={overbw} NbUpstreams={nbupstream} (used={not notused}) InitReplica={nbreplicas}")
-        await put_deployment_replicas(deployment,nbreplicas,force_die)
+def soak_deployments(deployments, soak, probe_path=None, max_restarts=0, probe_period=CANARY_PROBE_PERIOD):
+    # Follow the pods of the deployments during the soak window (seconds): container restarts, ready pods becoming
+    # not ready and, every probe_period, an HTTP probe of the unit services through the kubernetes proxy.
+    # Return the problems found, the soak is stopped at the first ones.
+    clientcorev1 = client.CoreV1Api()
+    selector = get_common_selector_string(deployments) or UNIT_LABEL_SELECTOR
+    index = build_selector_index(deployments)
+    deadline = time.monotonic() + soak
+    restarts = dict()
+    ready = dict()
+    problems = dict()
+
+    def check_pod(pod):
+        if not get_pod_deployments(index, pod):
+            return
+        key = (pod.metadata.namespace, pod.metadata.name)
+        count = sum(status.restart_count for status in pod.status.container_statuses or list())
+        baseline = restarts.setdefault(key, count)
+        if count - baseline > max_restarts:
+            problems[key] = f"Pod {pod.metadata.name} restarted {count - baseline} times"
+        podready = is_pod_ready(pod)
+        if ready.get(key) is True and not podready and get_pod_status(pod) != "Terminating":
+            problems[key] = f"Pod {pod.metadata.name} is not ready anymore"
+        ready[key] = podready
+
+    def on_list(pods):
+        for pod in pods:
+            check_pod(pod)
+
+    def on_event(event_type, pod):
+        if event_type != "DELETED":
+            check_pod(pod)
+
+    def probe():
+        if not probe_path:
+            return
+        for deployment in deployments:
+            svcname = get_service_name(deployment.metadata.name)
+            try:
+                kube_request(clientcorev1.connect_get_namespaced_service_proxy_with_path, svcname, deployment.metadata.namespace, probe_path)
+            except client.rest.ApiException as e:
+                problems[(deployment.metadata.namespace, svcname)] = f"Probe {probe_path} of {svcname} failed: {e.status} {e.reason}"
+
+    # The services are probed at the end of each watch request, every probe_period.
+    path, path_params = get_raw_path("pods")
+    list_then_watch(clientcorev1.api_client, path, get_model_record(clientcorev1.api_client, "V1Pod"),
+                    on_list, on_event,
+                    lambda: not active or bool(problems) or time.monotonic() >= deadline, path_params=path_params,
+                    label_selector=selector, timeout_seconds=lambda: max(1, int(min(probe_period, deadline - time.monotonic()))),
+                    on_watch_end=probe, list_runner=kube_request)
+    return list(problems.values())
+
+def get_canaries(deployments, id_prio_name, newversion, canary_count=0):
+    # Canary deployments, same selection for the plan and the upgrade: the priority ones not yet on the new version,
+    # at most canary_count (0 is all).
+    canaries = [dep for dep in deployments if id_prio_name in dep.metadata.name and
+                extract_name(dep.spec.template.spec.containers[0].image)[1] != newversion]
+    return canaries[:canary_count] if canary_count > 0 else canaries
+
+def get_upgrade_slots(deployments, max_per_group=1, max_parallel=0):
+    # Maximum number of deployments upgraded at the same time by upgrade_groups.
+    groups = dict()
+    for dep in deployments:
+        groups[get_group(dep)] = groups.get(get_group(dep), 0) + 1
+    slots = sum(min(max_per_group, count) for count in groups.values())
+    return min(slots, max_parallel) if max_parallel > 0 else slots
+
+async def upgrade_groups(deployments, upgrade, max_per_group=1, max_parallel=0):
+    # Upgrade the deployments with at most max_per_group units of the same group and max_parallel units (0 is no
+    # limit) at the same time. The next unit of a group starts as soon as one of the group is finished.
+    groups = dict()
+    for dep in deployments:
+        groups.setdefault(get_group(dep), deque()).append(dep)
+    global_limit = asyncio.Semaphore(max_parallel) if max_parallel > 0 else None
+
+    async def group_worker(queue):
+        while queue:
+            dep = queue.popleft()
+            if global_limit is None:
+                await upgrade(dep)
+            else:
+                async with global_limit:
+                    await upgrade(dep)
 
-    await asyncio.sleep(1)
+    workers = list()
+    for queue in groups.values():
+        for _idx in range(min(max_per_group, len(queue))):
+            workers.append(group_worker(queue))
+    await asyncio.gather(*workers)
 
 async def upgrade_version(user_args):
     global active
@@ -654,6 +1769,8 @@ async def upgrade_version(user_args):
     name=user_args.name
     newversion=user_args.version
     groupids=user_args.group
+    namespace=user_args.namespace
+    group_format=user_args.group_label_format
     overbw=user_args.overbandwidth
     parallel=user_args.parallel
     id_prio_name=user_args.id_prio
@@ -661,48 +1778,149 @@ async def upgrade_version(user_args):
     force_die=user_args.force_die
     seg_kube_app_name=user_args.kube_app_name
     seg_kube_app_managed=user_args.kube_app_manged
-
-    deployments = get_segmenter_deployments(name=name,groupids=groupids)
+    ready_timeout=user_args.ready_timeout
+    max_per_group=user_args.max_per_group
+    max_parallel=user_args.max_parallel
+    canary=user_args.canary
+    canary_count=user_args.canary_count
+    canary_parallel=user_args.canary_parallel
+    canary_soak=user_args.canary_soak
+    canary_probe=user_args.canary_probe
+    canary_max_restarts=user_args.canary_max_restarts
+
+    deployments = await kube_call(get_segmenter_deployments, name=name, groupids=groupids, namespace=namespace,
+                                  group_format=group_format)
     # Sort the segmenter deployment accorging to the segmenter ID name priority if needed.
     if id_prio_name is not None:
         deployments = sort_segmenter_deployments_id_name(deployments, id_prio_name)
-    ainodeconfs = get_ainode_all_conf(seg_ainode_name=seg_ainode_name)
+    ainodeconfs = await kube_call(get_ainode_all_conf, seg_ainode_name=seg_ainode_name)
+    upstream_index = UpstreamIndex(ainodeconfs)
+    ainode_client = get_ainode_client(seg_ainode_name)
+    # The units starting a wave together are drained with one edition per upstreamgroup.
+    drain_batch = DrainBatch(ainode_client)
+    set_units_versions(deployments, newversion)
 
     if len(deployments) == 0:
         return
 
-    if parallel is True:
-        futures1 = list()
-        futures2 = list()
-        futures3 = list()
-        deplist1 = list()
-        deplist2 = list()
-        deplist3 = list()
-        for dep in deployments:
-            groupname = get_group(dep)
-            if groupname not in deplist1:
-                deplist1.append(groupname)
-                futures1.append(upgrade_deployment(dep, ainodeconfs, newversion, overbw, force_die, seg_kube_app_name, seg_kube_app_managed))
-            elif groupname not in deplist2:
-                deplist2.append(groupname)
-                futures2.append(upgrade_deployment(dep, ainodeconfs, newversion, overbw, force_die, seg_kube_app_name, seg_kube_app_managed))
-            elif groupname not in deplist3:
-                deplist3.append(groupname)
-                futures3.append(upgrade_deployment(dep, ainodeconfs, newversion, overbw, force_die, seg_kube_app_name, seg_kube_app_managed))
-        if len(futures1):
-            await asyncio.gather(*futures1)
-        if len(futures2):
-            await asyncio.gather(*futures2)
-        if len(futures3):
-            await asyncio.gather(*futures3)
-    else:
-        for dep in deployments:
-            await upgrade_deployment(dep, ainodeconfs, newversion, overbw, force_die, seg_kube_app_name, seg_kube_app_managed)
+    # One wait slot per deployment upgraded at the same time (the canary soak runs alone).
+    init_wait_executor(get_upgrade_slots(deployments, max_per_group, max_parallel) if parallel else 1)
+
+    async def upgrade_deployments(deps, max_parallel):
+        if parallel is True:
+            await upgrade_groups(deps,
+                                 lambda dep: upgrade_deployment(dep, upstream_index, newversion, overbw, force_die, seg_kube_app_name, seg_kube_app_managed, ready_timeout, ainode_client, drain_batch),
+                                 max_per_group, max_parallel)
+        else:
+            for dep in deps:
+                await upgrade_deployment(dep, upstream_index, newversion, overbw, force_die, seg_kube_app_name, seg_kube_app_managed, ready_timeout, ainode_client)
+
+    # Canary: the priority units are upgraded and watched during the soak window before the rest of the fleet.
+    # Without canary deployment, there is nothing to soak (as in the plan).
+    canaries = list()
+    if canary:
+        canaries = get_canaries(deployments, id_prio_name, newversion, canary_count)
+        if not canaries:
+            LOGGER.warning(f"No canary deployment matching {id_prio_name}, skipping the canary soak")
+    if canaries:
+        LOGGER.info(f"Canary upgrade of {len(canaries)} deployments: {','.join(dep.metadata.name for dep in canaries)}")
+        await upgrade_deployments(canaries, canary_parallel)
+
+        LOGGER.info(f"Canary soak during {canary_soak} seconds")
+        problems = await kube_wait(soak_deployments, canaries, canary_soak, canary_probe, canary_max_restarts)
+        if problems:
+            for problem in problems:
+                LOGGER.error(f"Canary failure: {problem}")
+            string_info = f"Canary failure, upgrade stopped: {'; '.join(problems)}"
+            print(string_info, file=INFO_STREAM)
+            active = False
+            return
+        LOGGER.info("Canary soak succeeded, upgrading the other deployments")
+        canary_names = set((dep.metadata.namespace, dep.metadata.name) for dep in canaries)
+        deployments = [dep for dep in deployments if (dep.metadata.namespace, dep.metadata.name) not in canary_names]
+
+    await upgrade_deployments(deployments, max_parallel)
 
     # End of deployment, stop other processes.
     string_info = "Upgrade is finished..."
     LOGGER.info(string_info)
-    print(string_info)
+    print(string_info, file=INFO_STREAM)
+    active = False
+
+
+async def resume_deployment(deployment, state, rollback, upstream_index, overbw, force_die=False, kube_app_name="segmenter-unit",
+                            kube_app_managed="segmenter-daemon", ready_timeout=None, ainode_client=None):
+    # Bring an interrupted deployment to its final state: new version (or initial version on rollback) and initial
+    # replicas. Each step is only done when the deployment is not already in the expected state.
+    version = state["version"] if rollback else state["newversion"]
+    LOGGER.info(f"{'Rolling back' if rollback else 'Resuming'} deployment {deployment.metadata.name} to version {version} "
+                f"(journal steps: {','.join(state['steps'])})")
+
+    svcname = get_service_name(deployment.metadata.name)
+    replicas = deployment.spec.replicas
+    _baseimage, curversion = extract_name(deployment.spec.template.spec.containers[0].image)
+    if curversion != version:
+        # The steps missing before the image patch are replayed: drain, then scale down for the overbandwidth.
+        if "drained" not in state["steps"]:
+            # The upstreamgroups already drained (journaled one by one) are kept with the ones drained now.
+            refs = upstream_index.get_refs(svcname)
+            removed = dict(state.get("upstreams", dict()))
+            if ainode_client is not None and refs:
+                drained = await kube_call(ainode_client.drain_service, svcname, list(refs.keys()), journal_drained(deployment))
+                if drained:
+                    LOGGER.info(f"Removed upstreams of {svcname} from upstreamgroups {','.join(drained.keys())}")
+                removed.update(drained)
+            journal_record(deployment, "drained", upstreams=removed)
+            state["steps"].append("drained")
+            state["upstreams"] = removed
+
+        scale_down, nbupstream, used = get_scale_down(upstream_index, svcname, overbw)
+        if scale_down and replicas != 0:
+            LOGGER.info(f"Set to O replica: OverBandwidth={overbw} NbUpstreams={nbupstream} (used={used}) InitReplica={state['replicas']}")
+            await put_deployment_replicas(deployment, 0, force_die, ready_timeout)
+            journal_record(deployment, "scaled_down")
+            replicas = 0
+
+        await put_deployment_version(deployment, version, kube_app_name, kube_app_managed, ready_timeout)
+        journal_record(deployment, "image_patched", patched_version=version)
+
+    if replicas != state["replicas"]:
+        LOGGER.info(f"Restore replica to {state['replicas']}")
+        await put_deployment_replicas(deployment, state["replicas"], force_die, ready_timeout)
+        journal_record(deployment, "restored")
+
+    if state.get("upstreams") and "upstreams_restored" not in state["steps"]:
+        LOGGER.info(f"Restore upstreams of upstreamgroups {','.join(state['upstreams'].keys())}")
+        await kube_call(ainode_client.restore_upstreams, state["upstreams"])
+        journal_record(deployment, "upstreams_restored")
+
+    journal_record(deployment, "done", rollback=rollback)
+
+async def resume_upgrade(user_args):
+    global active
+
+    # Get user arguments.
+    rollback=user_args.rollback
+    force_die=user_args.force_die
+    seg_kube_app_name=user_args.kube_app_name
+    seg_kube_app_managed=user_args.kube_app_manged
+    ready_timeout=user_args.ready_timeout
+    overbw=user_args.overbandwidth
+    ainode_client=get_ainode_client(user_args.ainodename)
+    upstream_index = UpstreamIndex(await kube_call(get_ainode_all_conf, seg_ainode_name=user_args.ainodename))
+
+    # Deployments whose upgrade is not done according to the journal.
+    states = UpgradeJournal.load(user_args.journal)
+    clientappsv1 = client.AppsV1Api()
+    for (namespace, depname), state in states.items():
+        if "done" in state["steps"]:
+            continue
+        deployment = await kube_call(clientappsv1.read_namespaced_deployment, depname, namespace)
+        await resume_deployment(deployment, state, rollback, upstream_index, overbw, force_die, seg_kube_app_name, seg_kube_app_managed, ready_timeout, ainode_client)
+
+    string_info = f"{'Rollback' if rollback else 'Resume'} is finished..."
+    LOGGER.info(string_info)
+    print(string_info, file=INFO_STREAM)
     active = False
 
 
@@ -717,13 +1935,34 @@ if __name__ == '__main__':
     required.add_argument("-u", "--upgrade",        default=False,                          help="Do upgrade",                              action='store_true')
     required.add_argument("-o", "--overbandwidth",  default=False,                          help="Allow overbandwidth for mono segmenter",  action='store_true')
     required.add_argument("-p", "--parallel",       default=False,                          help="Allow parallel update of segmenters",     action='store_true')
+    required.add_argument("--max-per-group",        default=1,                              help="Maximum number of segmenters of a group updated at the same time in parallel mode (default is 1)", type=int)
+    required.add_argument("--max-parallel",         default=0,                              help="Maximum number of segmenters updated at the same time in parallel mode (default is 0: no limit)", type=int)
+    required.add_argument("--canary",               default=False,                          help="Upgrade the priority units (--id-prio) first and check their health before the others", action='store_true')
+    required.add_argument("--canary-count",         default=0,                              help="Maximum number of priority units upgraded in the canary stage (default is 0: all)", type=int)
+    required.add_argument("--canary-parallel",      default=1,                              help="Maximum number of units updated at the same time in the canary stage in parallel mode (default is 1)", type=int)
+    required.add_argument("--canary-soak",          default=300,                            help="Duration in seconds of the health check of the canary units (default is 300)", type=int)
+    required.add_argument("--canary-probe",         default=None,                           help="HTTP path probed on the canary unit services through the kubernetes proxy during the soak")
+    required.add_argument("--canary-max-restarts",  default=0,                              help="Maximum number of container restarts of a canary pod during the soak (default is 0)", type=int)
     required.add_argument("-a", "--ainodename",     default=DEFAULT_SVC_SEGMENTER_AINODE,   help="Specify the ainode name in charge")
     required.add_argument("-g", "--group",          default=None,                           help="Specify the list of group to update",     nargs='+')
+    required.add_argument("--namespace",            default=None,                           help="Only discover the segmenters of this namespace (default is all namespaces)")
+    required.add_argument("--group-label-format",   default=DEFAULT_GROUP_LABEL_FORMAT,     help=f"Format of the group label value selected server side, legacy labels are filtered client side (default is {DEFAULT_GROUP_LABEL_FORMAT})")
     required.add_argument("-i", "--id-prio",        default=None,                           help="Specify the id of the segmenter to execute the upgrade first (th2, pa3, pri, sec")
     required.add_argument("-l", "--log-file",       default=None,                           help="Enable the file log and specify the name of the log file")
     required.add_argument("-f", "--force-die",      default=False,                          help="Force sending a DIE command on a Terminating pod for a faster upgrade", action='store_true')
     required.add_argument("-k", "--kube-app-name",  default="segmenter-unit",               help="Specify kube app name of the segmenter to set on pod labels (default is segmenter-unit")
     required.add_argument("-m", "--kube-app-manged",default="segmenter-daemon",             help="Specify kube name of manging pod of the segmenter to set on pod labels (default is segmenter-daemon")
+    required.add_argument("-t", "--ready-timeout",  default=None,                           help="Timeout in seconds of the wait for the pods of an upgraded segmenter (default is no timeout)", type=int)
+    required.add_argument("-c", "--api-concurrency",default=DEFAULT_API_CONCURRENCY,        help=f"Maximum number of kubernetes API calls running at the same time (default is {DEFAULT_API_CONCURRENCY})", type=int)
+    required.add_argument("--output",               default=None,                           help="Export the status on stdout: json (one snapshot) or ndjson (snapshot then change events)", choices=["json", "ndjson"])
+    required.add_argument("--metrics-port",         default=None,                           help="Enable the prometheus /metrics endpoint on this port", type=int)
+    required.add_argument("--metrics-address",      default="127.0.0.1",                    help="Listening address of the metrics endpoint (default is 127.0.0.1)")
+    required.add_argument("-j", "--journal",        default=None,                           help="Record the upgrade steps in this journal file (appended)")
+    required.add_argument("-r", "--resume",         default=False,                          help="Finish the upgrades interrupted according to the journal", action='store_true')
+    required.add_argument("--rollback",             default=False,                          help="With --resume, roll back the interrupted upgrades to their initial version", action='store_true')
+    required.add_argument("--plan",                 default=False,                          help="Print the upgrade order and its estimated duration without upgrading", action='store_true')
+    required.add_argument("--stats-file",           default=DEFAULT_STATS_FILE,             help=f"History of the upgrade phases durations, used by --plan (default is {DEFAULT_STATS_FILE})")
+    required.add_argument("--ainode-refresh",       default=10,                             help="Refresh period in seconds of the ainode configuration on display (default is 10)", type=int)
 
     # Get arguments
     args = parser.parse_args()
@@ -740,11 +1979,50 @@ if __name__ == '__main__':
         print("Cannot upgrade without version")
         sys.exit(-1)
 
+    # Canary units are the priority ones.
+    if args.canary and args.id_prio is None:
+        print("Cannot upgrade with canary without priority id")
+        sys.exit(-1)
+
+    # At least one unit of each group is upgraded at a time.
+    if args.max_per_group < 1:
+        print("Cannot upgrade with less than 1 unit per group")
+        sys.exit(-1)
+
+    # Resume needs the journal of the interrupted upgrade.
+    if args.resume and not args.journal:
+        print("Cannot resume without journal")
+        sys.exit(-1)
+    if args.resume and args.upgrade:
+        print("Cannot upgrade and resume at the same time")
+        sys.exit(-1)
+    if args.rollback and not args.resume:
+        print("Cannot rollback without resume")
+        sys.exit(-1)
+
+    # Display and export both use the standard output.
+    if args.output and args.display:
+        print("Cannot display and export the status at the same time")
+        sys.exit(-1)
+    if args.output:
+        INFO_STREAM = sys.stderr
+
     # Logging configuration.
     if args.log_file:
         LOGGER.init(args.log_file)
     LOGGER.info(f"Launching Segmenter upgrade with parameters: {args}")
 
+    # Kubernetes calls are run in bounded executors out of the event loop.
+    init_kube_executors(args.api_concurrency)
+
+    # Metrics endpoint.
+    if args.metrics_port is not None:
+        try:
+            init_metrics(args.metrics_port, args.metrics_address)
+        except RuntimeError as e:
+            print(e)
+            sys.exit(-1)
+
     futures = list()
 
     # If display enable, add display coroutine
@@ -760,25 +2038,54 @@ if __name__ == '__main__':
         window = curses.newwin(20, 10, 0, 0)
         window.keypad(True)
         window.nodelay(True)
+        signal.signal(signal.SIGWINCH, on_resize)
         futures.append(interract(args, window=window))
         futures.append(display_status(args, window=window))
 
-    # If upgrade enabled, add upgrade coroutine
+    # If export enabled, add export coroutine
+    if args.output:
+        futures.append(export_status(args))
+
+    # Journal of the upgrade steps.
+    if args.journal:
+        JOURNAL = UpgradeJournal(args.journal)
+
+    # If upgrade enabled, add upgrade coroutine (phases durations are recorded for the plan).
     if args.upgrade:
+        STATS = PhaseStats(args.stats_file)
         futures.append(upgrade_version(args))
 
-    # Start coroutines
-    try:
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(asyncio.gather(*futures))
-    except KeyboardInterrupt:
-        active = False
-        print("<CTRL+C> entered by the user, stopping ....")
+    # If plan enabled, add plan coroutine
+    if args.plan:
+        futures.append(plan_upgrade(args))
+
+    # If resume enabled, add resume coroutine
+    if args.resume:
+        futures.append(resume_upgrade(args))
 
-    # Wait for stop processes.
+    # Start coroutines
     try:
-        if not active and args.display:
-            loop.run_until_complete(display_status(args, window=window))
-    except Exception as e:
-        print(f"Exception while waiting end of display loop: {e}")
-    print(f"End of upgrade process")
\ No newline at end of file
+        try:
+            loop = asyncio.get_event_loop()
+            loop.run_until_complete(asyncio.gather(*futures))
+        except KeyboardInterrupt:
+            print("<CTRL+C> entered by the user, stopping ....", file=INFO_STREAM)
+        except TimeoutError as e:
+            LOGGER.error(str(e))
+            print(f"{e}, stopping ....", file=INFO_STREAM)
+        finally:
+            # On any error too, the waits running in the executor threads stop on it.
+            active = False
+
+        # Wait for stop processes.
+        try:
+            if args.display:
+                loop.run_until_complete(display_status(args, window=window))
+        except Exception as e:
+            print(f"Exception while waiting end of display loop: {e}")
+    finally:
+        if JOURNAL is not None:
+            JOURNAL.close()
+        KUBE_EXECUTOR.shutdown(wait=False)
+        WAIT_EXECUTOR.shutdown(wait=False)
+    print(f"End of upgrade process", file=INFO_STREAM)
\ No newline at end of file